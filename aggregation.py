@@ -0,0 +1,161 @@
+import logging
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация агрегации
+TITLE_SIMILARITY = 0.85  # С какой похожестью названия одного исполнителя считаются одним треком
+ALTERNATIVE_WEIGHT = 0.25  # Вес голоса альтернативы относительно основного результата
+DEFAULT_SCORE = 50  # Оценка, если провайдер её не вернул
+MIN_CONFIDENCE = 0.3  # Группы слабее этого (сумма весов) считаются шумом
+
+# Хвосты, которые отличают версии одного трека, а не разные треки
+_BRACKETS = re.compile(r"[(\[{][^)\]}]*[)\]}]")
+_VERSION_SUFFIX = re.compile(
+    r"\s+-\s+.*\b(remaster(ed)?|radio edit|single version|album version|original mix|edit|mono|stereo|live)\b.*$"
+)
+_FEATURING = re.compile(r"\s+(feat\.?|ft\.?|featuring)\s+.*$")
+# Словесные разделители (and, x, vs) — только между двумя именами: «X Ambassadors» — одно имя
+_ARTIST_SEPARATORS = re.compile(r"\s*(?:,|&|;|/)\s*|(?<=\S)\s+(?:and|x|vs\.?)\s+(?=\S)")
+_NON_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def _fold(text: str) -> str:
+    """Нижний регистр без диакритики"""
+    text = unicodedata.normalize("NFKD", text or "")
+    return "".join(ch for ch in text if not unicodedata.combining(ch)).lower().strip()
+
+
+def normalize_title(title: str) -> str:
+    """Название без скобок, «feat.» и пометок версии (remaster, radio edit...)"""
+    title = _fold(title)
+    title = _BRACKETS.sub(" ", title)
+    title = _VERSION_SUFFIX.sub("", title)
+    title = _FEATURING.sub("", title)
+    return _SPACES.sub(" ", _NON_WORD.sub(" ", title)).strip()
+
+
+def normalize_artist(artist: str) -> str:
+    """Основной исполнитель: первый из перечисленных, без приглашённых"""
+    artist = _FEATURING.sub("", _BRACKETS.sub(" ", _fold(artist)))
+    primary = _ARTIST_SEPARATORS.split(artist)[0]
+    return _SPACES.sub(" ", _NON_WORD.sub(" ", primary)).strip()
+
+
+def normalized_key(track: dict) -> str:
+    """Ключ трека, устойчивый к регистру, «feat.» и пометкам версии"""
+    return f"{normalize_artist(track.get('artist'))}_{normalize_title(track.get('title'))}"
+
+
+class TrackGroup:
+    """Все упоминания одного трека по сегментам файла"""
+    __slots__ = ("artist", "title", "best", "best_weight", "weight", "segments", "start", "end")
+
+    def __init__(self, artist: str, title: str):
+        self.artist = artist
+        self.title = title
+        self.best = None  # Основной результат с наибольшей оценкой — источник метаданных
+        self.best_weight = 0.0
+        self.weight = 0.0
+        self.segments = set()
+        self.start = None
+        self.end = None
+
+    def add(self, track: dict, segment, weight: float, primary: bool) -> None:
+        if segment in self.segments:
+            return  # Один сегмент голосует за трек один раз
+        self.segments.add(segment)
+        self.weight += weight
+        if not primary:
+            return
+        if weight > self.best_weight:
+            self.best, self.best_weight = track, weight
+        if track.get("start") is not None:
+            self.start = track["start"] if self.start is None else min(self.start, track["start"])
+        if track.get("end") is not None:
+            self.end = track["end"] if self.end is None else max(self.end, track["end"])
+
+    def result(self) -> dict:
+        track = dict(self.best)
+        track.pop("alternative", None)
+        track.pop("segment", None)
+        track["start"], track["end"] = self.start, self.end
+        track["votes"] = len(self.segments)
+        track["confidence"] = round(self.weight, 3)
+        return track
+
+
+def _weight(track: dict) -> float:
+    score = track.get("score")
+    try:
+        score = float(score) if score is not None else DEFAULT_SCORE
+    except (TypeError, ValueError):
+        score = DEFAULT_SCORE
+    weight = max(0.0, min(score, 100.0)) / 100
+    return weight * ALTERNATIVE_WEIGHT if track.get("alternative") else weight
+
+
+def _segment(track: dict):
+    return track["segment"] if track.get("segment") is not None else track.get("start")
+
+
+def aggregate_tracks(tracks: list, order: str = "time") -> list:
+    """Объединяет результаты всех сегментов в список уникальных треков
+
+    Треки нормализуются и группируются (точный ключ, затем похожие названия
+    того же исполнителя). Каждый сегмент — один голос с весом по оценке;
+    альтернативы только поддерживают группы, найденные основными результатами.
+    Сегмент определяется по полю segment (без него — по start). order: time — по времени звучания,
+    votes — по весу голосов.
+    """
+    groups = {}  # нормализованный ключ -> группа
+    by_artist = {}  # исполнитель -> [группы] — блоки для нечёткого сравнения
+    pending = []  # альтернативы: голосуют после того, как известны все группы
+
+    def find_group(artist: str, title: str, key: str):
+        group = groups.get(key)
+        if group is not None:
+            return group
+        for candidate in by_artist.get(artist, ()):
+            matcher = SequenceMatcher(None, title, candidate.title)
+            if matcher.real_quick_ratio() >= TITLE_SIMILARITY and matcher.ratio() >= TITLE_SIMILARITY:
+                groups[key] = candidate  # Запоминаем вариант написания
+                return candidate
+        return None
+
+    for track in tracks:
+        if not track.get("title") or not track.get("artist"):
+            continue
+        artist, title = normalize_artist(track["artist"]), normalize_title(track["title"])
+        if not title:
+            continue
+        key = f"{artist}_{title}"
+        if track.get("alternative"):
+            pending.append((track, artist, title, key))
+            continue
+
+        group = find_group(artist, title, key)
+        if group is None:
+            group = groups[key] = TrackGroup(artist, title)
+            by_artist.setdefault(artist, []).append(group)
+        group.add(track, _segment(track), _weight(track), primary=True)
+
+    for track, artist, title, key in pending:
+        group = find_group(artist, title, key)
+        if group is not None:
+            group.add(track, _segment(track), _weight(track), primary=False)
+
+    unique = {id(group): group for group in groups.values()}.values()
+    results = [group.result() for group in unique if group.weight >= MIN_CONFIDENCE]
+    dropped = len(unique) - len(results)
+    if dropped:
+        logger.info(f"Отброшено слабых совпадений: {dropped}")
+
+    if order == "votes":
+        results.sort(key=lambda track: (-track["confidence"], track["start"] if track["start"] is not None else 0))
+    else:
+        results.sort(key=lambda track: track["start"] if track["start"] is not None else float("inf"))
+    return results
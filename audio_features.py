@@ -0,0 +1,93 @@
+import numpy as np
+
+# Конфигурация предфильтра сегментов
+ANALYSIS_RATE = 11025  # До какой частоты прореживается сигнал перед анализом (Гц)
+FRAME_SIZE = 1024
+HOP_SIZE = 512
+BANDS = 24  # Число полос спектрального профиля
+MIN_SEGMENT_DURATION = 5  # Более короткие хвосты не отправляются (сек)
+SILENCE_DB = -45  # Средний уровень ниже — тишина (dBFS)
+MAX_FLATNESS = 0.45  # Выше — шум/аплодисменты (спектр почти плоский)
+SPEECH_LOW_ENERGY_RATIO = 0.55  # Доля тихих кадров, характерная для речи с паузами
+SPEECH_ZCR_STD = 0.06  # Разброс ZCR, характерный для чередования гласных и согласных
+MERGE_SIMILARITY = 0.995  # Соседние сегменты с таким сходством профиля считаются одним треком
+
+
+def to_mono(pcm: bytes, sample_rate: int, channels: int) -> tuple:
+    """PCM s16le -> моно float32 в [-1, 1], прореженное до ANALYSIS_RATE"""
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    mono = samples.mean(axis=1, dtype=np.float32) / 32768.0
+    step = max(1, sample_rate // ANALYSIS_RATE)
+    return mono[::step], sample_rate / step
+
+
+def frame_signal(signal: np.ndarray, frame_size: int = FRAME_SIZE, hop_size: int = HOP_SIZE) -> np.ndarray:
+    """Нарезает сигнал на перекрывающиеся кадры без копирования"""
+    if len(signal) < frame_size:
+        signal = np.pad(signal, (0, frame_size - len(signal)))
+    return np.lib.stride_tricks.sliding_window_view(signal, frame_size)[::hop_size]
+
+
+def band_edges(n_bins: int, bands: int = BANDS) -> np.ndarray:
+    """Логарифмически расположенные границы полос по бинам спектра"""
+    return np.unique(np.geomspace(1, n_bins, bands + 1).astype(int))
+
+
+def band_energies(frames: np.ndarray) -> np.ndarray:
+    """Энергии кадров в логарифмических полосах: (кадры, полосы)"""
+    power = np.abs(np.fft.rfft(frames * np.hanning(frames.shape[1]), axis=1)) ** 2 + 1e-12
+    edges = band_edges(power.shape[1])
+    return np.add.reduceat(power, edges[:-1], axis=1)
+
+
+def analyze_segment(pcm: bytes, sample_rate: int, channels: int) -> dict:
+    """Считает признаки сегмента: RMS, спектральную плоскость, ZCR и спектральный профиль"""
+    signal, rate = to_mono(pcm, sample_rate, channels)
+    frames = frame_signal(signal)
+
+    rms = np.sqrt(np.mean(frames ** 2, axis=1) + 1e-12)
+    rms_db = 20 * np.log10(np.mean(rms) + 1e-12)
+    low_energy_ratio = float(np.mean(rms < 0.5 * np.mean(rms)))
+
+    signs = np.signbit(frames)
+    zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+
+    power = np.abs(np.fft.rfft(frames * np.hanning(frames.shape[1]), axis=1)) ** 2 + 1e-12
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    # Плоскость считаем только по звучащим кадрам, паузы её искажают
+    voiced = rms > 0.1 * np.max(rms)
+
+    edges = band_edges(power.shape[1])
+    profile = np.log(np.add.reduceat(power.mean(axis=0), edges[:-1]))
+    profile -= profile.mean()
+
+    return {
+        "duration": len(signal) / rate,
+        "rms_db": float(rms_db),
+        "flatness": float(np.mean(flatness[voiced])) if voiced.any() else 1.0,
+        "zcr_mean": float(np.mean(zcr)),
+        "zcr_std": float(np.std(zcr)),
+        "low_energy_ratio": low_energy_ratio,
+        "profile": profile,
+    }
+
+
+def profile_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Косинусное сходство спектральных профилей"""
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+
+
+def classify_segment(features: dict, previous: dict = None) -> str:
+    """Возвращает music, либо причину пропуска: short, silence, noise, speech, duplicate"""
+    if features["duration"] < MIN_SEGMENT_DURATION:
+        return "short"
+    if features["rms_db"] < SILENCE_DB:
+        return "silence"
+    if features["flatness"] > MAX_FLATNESS:
+        return "noise"
+    if features["low_energy_ratio"] > SPEECH_LOW_ENERGY_RATIO and features["zcr_std"] > SPEECH_ZCR_STD:
+        return "speech"
+    if previous is not None and profile_similarity(features["profile"], previous["profile"]) > MERGE_SIMILARITY:
+        return "duplicate"
+    return "music"
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+from contextlib import aclosing
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация декодирования
+FFMPEG_PATH = "ffmpeg"
+SAMPLE_RATE = 44100  # Частота дискретизации PCM (Гц)
+CHANNELS = 2
+SAMPLE_WIDTH = 2  # s16le
+STDIN_CHUNK = 64 * 1024  # Порция записи в stdin ffmpeg (байт)
+DEFAULT_PROFILE = "mp3_mono_16k"  # Профиль загрузки в API, если провайдер не задал свой
+
+
+class Segment:
+    """Сегмент декодированного аудио (сырой PCM s16le)"""
+    __slots__ = ("index", "start", "pcm", "end", "sample_rate", "channels")
+
+    def __init__(self, index: int, start: float, pcm: bytes, end: float = None,
+                 sample_rate: int = None, channels: int = None):
+        self.index = index
+        self.start = start  # Смещение от начала файла (сек)
+        self.pcm = pcm
+        self.sample_rate = sample_rate or SAMPLE_RATE
+        self.channels = channels or CHANNELS
+        # Конец участка файла, который представляет сегмент (для проб — конец региона)
+        self.end = end if end is not None else start + self.duration
+
+    @property
+    def duration(self) -> float:
+        return len(self.pcm) / (self.sample_rate * self.channels * SAMPLE_WIDTH)
+
+
+class EncodingProfile:
+    """Формат, в котором фрагмент загружается в API распознавания
+
+    Сервисам хватает моно-сигнала с низкой частотой дискретизации, поэтому
+    размер загрузки и время кодирования можно сильно сократить.
+    """
+    __slots__ = ("name", "codec", "fmt", "sample_rate", "channels", "bitrate", "extension", "content_type")
+
+    def __init__(self, name: str, codec: str, fmt: str, sample_rate: int, channels: int,
+                 bitrate: str = None, extension: str = None, content_type: str = "audio/mpeg"):
+        self.name = name
+        self.codec = codec
+        self.fmt = fmt
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bitrate = bitrate  # None — без сжатия (PCM в WAV)
+        self.extension = extension or fmt
+        self.content_type = content_type
+
+    def output_args(self) -> list:
+        """Аргументы ffmpeg для выходного потока"""
+        args = ["-ac", str(self.channels), "-ar", str(self.sample_rate), "-c:a", self.codec]
+        if self.bitrate:
+            args += ["-b:a", self.bitrate]
+        return args + ["-f", self.fmt]
+
+    def filename(self, stem: str) -> str:
+        return f"{stem}.{self.extension}"
+
+
+PROFILES = {profile.name: profile for profile in (
+    EncodingProfile("mp3_stereo", "libmp3lame", "mp3", 44100, 2, "128k"),  # Прежний формат загрузки
+    EncodingProfile("mp3_mono_16k", "libmp3lame", "mp3", 16000, 1, "32k"),
+    EncodingProfile("opus_mono_16k", "libopus", "ogg", 16000, 1, "24k", content_type="audio/ogg"),
+    EncodingProfile("wav_mono_16k", "pcm_s16le", "wav", 16000, 1, content_type="audio/wav"),
+)}
+
+
+def get_profile(name: str = None) -> EncodingProfile:
+    """Профиль по имени; неизвестное имя — ошибка конфигурации"""
+    try:
+        return PROFILES[name or DEFAULT_PROFILE]
+    except KeyError:
+        raise ValueError(f"Неизвестный профиль кодирования: {name}") from None
+
+
+# Контейнеры, которые узнаются по сигнатуре: формат -> (расширение, content-type)
+CONTAINERS = {
+    "mp3": ("mp3", "audio/mpeg"),
+    "ogg": ("ogg", "audio/ogg"),  # Голосовые сообщения Telegram — Opus в Ogg
+    "wav": ("wav", "audio/wav"),
+    "flac": ("flac", "audio/flac"),
+    "aac": ("aac", "audio/aac"),
+    "mp4": ("mp4", "video/mp4"),  # Видеосообщения и m4a
+    "webm": ("webm", "video/webm"),
+}
+
+
+def sniff_format(data) -> str:
+    """Контейнер по сигнатуре в начале файла (расширению у голосовых верить нельзя); None — не узнан"""
+    head = bytes(data[:12])
+    if head.startswith(b"OggS"):
+        return "ogg"
+    if head.startswith(b"ID3"):
+        return "mp3"
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head.startswith(b"fLaC"):
+        return "flac"
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "webm"
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # Синхрослово кадра MPEG: layer 00 бывает только у ADTS (AAC)
+        return "aac" if head[1] & 0x06 == 0 else "mp3"
+    return None
+
+
+def pcm_args(sample_rate: int = None, channels: int = None) -> list:
+    """Аргументы ffmpeg, описывающие формат PCM"""
+    return ["-f", "s16le", "-ac", str(channels or CHANNELS), "-ar", str(sample_rate or SAMPLE_RATE)]
+
+
+def is_buffer(source) -> bool:
+    """Источник — файл в памяти, а не путь на диске"""
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+
+def is_stream(source) -> bool:
+    """Источник — асинхронный поток порций файла (скачивается по мере чтения)"""
+    return hasattr(source, "__aiter__")
+
+
+def is_piped(source) -> bool:
+    """Источник подаётся в ffmpeg через stdin"""
+    return is_buffer(source) or is_stream(source)
+
+
+def input_args(source) -> list:
+    """Аргументы ffmpeg для источника: путь, буфер или поток, подаваемые через stdin"""
+    return ["-i", "pipe:0"] if is_piped(source) else ["-i", source]
+
+
+async def feed_stdin(process, data) -> None:
+    """Пишет буфер или поток в stdin ffmpeg порциями, не копируя его целиком в буфер транспорта"""
+    try:
+        if is_stream(data):
+            async for chunk in data:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        else:
+            view = memoryview(data)
+            for offset in range(0, len(view), STDIN_CHUNK):
+                process.stdin.write(view[offset:offset + STDIN_CHUNK])
+                await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # ffmpeg прочитал всё, что ему нужно (-t), и закрыл вход
+    finally:
+        try:
+            process.stdin.close()
+        except Exception:
+            pass
+        if is_stream(data) and hasattr(data, "aclose"):
+            await data.aclose()  # Остаток потока не читается — загрузка останавливается
+
+
+async def run_ffmpeg(cmd: list, source=None, stdout=asyncio.subprocess.PIPE):
+    """Запускает ffmpeg; для буфера запускает задачу записи в stdin"""
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if is_piped(source) else asyncio.subprocess.DEVNULL,
+        stdout=stdout,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    feeder = asyncio.create_task(feed_stdin(process, source)) if is_piped(source) else None
+    return process, feeder
+
+
+async def stream_segments(source, segment_duration: int, max_segments: int = None, every: int = 1):
+    """Декодирует файл одним процессом ffmpeg и по мере чтения отдаёт сегменты
+
+    В памяти одновременно находится не больше одного сегмента, поэтому
+    потребление не зависит от длины файла. source — путь, буфер или поток.
+    every > 1 — отдаётся каждое every-е окно, чтобы сегменты покрывали весь файл.
+    """
+    # При ограничении ffmpeg сам остановится после нужного фрагмента
+    duration = max_segments * segment_duration * every if max_segments else None
+    index = 0
+    async with aclosing(read_pcm_blocks(source, segment_duration, duration=duration)) as blocks:
+        async for pcm in blocks:
+            if index % every == 0:
+                yield Segment(index, index * segment_duration, pcm)
+            index += 1
+
+
+async def read_pcm_blocks(source, block_seconds: float, sample_rate: int = None,
+                          channels: int = None, duration: float = None):
+    """Потоково декодирует файл в PCM заданного формата и отдаёт блоки фиксированной длины"""
+    sample_rate = sample_rate or SAMPLE_RATE
+    channels = channels or CHANNELS
+
+    cmd = [FFMPEG_PATH, "-v", "error"] + input_args(source) + ["-vn"]
+    if duration:
+        cmd += ["-t", str(duration)]
+    cmd += ["-f", "s16le", "-ac", str(channels), "-ar", str(sample_rate), "pipe:1"]
+
+    process, feeder = await run_ffmpeg(cmd, source)
+    block_bytes = int(block_seconds * sample_rate) * channels * SAMPLE_WIDTH
+
+    try:
+        while True:
+            try:
+                block = await process.stdout.readexactly(block_bytes)
+            except asyncio.IncompleteReadError as e:
+                block = e.partial
+            if not block:
+                break
+            yield block
+            if len(block) < block_bytes:
+                break
+
+        stderr = await process.stderr.read()
+        if await process.wait() != 0:
+            raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}: {stderr.decode(errors='replace').strip()}")
+        if feeder is not None and feeder.done() and not feeder.cancelled() and feeder.exception() is not None:
+            # Оборванная загрузка для ffmpeg выглядит как конец файла — не выдаём обрезанный файл за целый
+            raise RuntimeError(f"Ошибка чтения источника: {feeder.exception()}")
+    finally:
+        if feeder is not None:
+            feeder.cancel()
+            # Поток закрывается вместе с записью — до того, как его владелец закроет загрузку
+            await asyncio.gather(feeder, return_exceptions=True)
+        if process.returncode is None:
+            process.kill()
+            # Не wait(): чтение stdout могло быть приостановлено переполненным буфером,
+            # тогда конец пайпа не замечается и wait() не возвращается. communicate() дочитывает пайпы
+            await process.communicate()
+
+
+async def encode_segment(pcm: bytes, profile: str = None, sample_rate: int = None, channels: int = None) -> bytes:
+    """Кодирует PCM в формат для загрузки в API (через пайпы, без временных файлов)"""
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-v", "error", *pcm_args(sample_rate, channels), "-i", "pipe:0",
+        *get_profile(profile).output_args(), "pipe:1",
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    data, stderr = await process.communicate(pcm)
+    if process.returncode != 0:
+        raise RuntimeError(f"Ошибка кодирования сегмента: {stderr.decode(errors='replace').strip()}")
+    return data
+
+
+async def encode_segments(pcm: bytes, profiles, stem: str = "segment", sample_rate: int = None,
+                          channels: int = None) -> dict:
+    """Кодирует PCM во все нужные провайдерам профили: имя профиля -> (данные, имя файла, content-type)"""
+    names = list(dict.fromkeys(profiles))
+    encoded = await asyncio.gather(*(encode_segment(pcm, name, sample_rate, channels) for name in names))
+    return {
+        name: (data, get_profile(name).filename(stem), get_profile(name).content_type)
+        for name, data in zip(names, encoded)
+    }
+
+
+async def transcode(source, max_duration: float = None, profile: str = None) -> bytes:
+    """Перекодирует файл отдельным процессом ffmpeg через пайпы, не блокируя event loop"""
+    cmd = [FFMPEG_PATH, "-v", "error"] + input_args(source) + ["-vn"]
+    if max_duration:
+        cmd += ["-t", str(max_duration)]
+    cmd += get_profile(profile).output_args() + ["pipe:1"]
+
+    process, feeder = await run_ffmpeg(cmd, source)
+    try:
+        data = await process.stdout.read()
+        stderr = await process.stderr.read()
+        if await process.wait() != 0:
+            raise RuntimeError(f"Ошибка перекодирования: {stderr.decode(errors='replace').strip()}")
+        return data
+    finally:
+        if feeder is not None:
+            feeder.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.communicate()
@@ -0,0 +1,162 @@
+"""Бенчмарк профилей кодирования загрузок: время и CPU кодирования, объём, точность, задержка
+
+Для каждого профиля из audio_stream.PROFILES сегменты кодируются через ffmpeg,
+загружаются в фейковый AudD с ограниченным каналом (--uplink-mbps) и
+декодируются обратно. Точность оценивается локальным индексом отпечатков:
+какая доля хэшей исходного сегмента пережила кодирование и узнаётся ли трек.
+С --audd-token сегменты дополнительно отправляются в настоящий AudD и
+результат сравнивается с профилем mp3_stereo.
+
+Запуск: python benchmarks/bench_encoding.py --file mix.mp3 --segments 8 --uplink-mbps 2
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audio_stream  # noqa: E402
+import recognition  # noqa: E402
+from audio_stream import PROFILES, encode_segment, get_profile, read_pcm_blocks  # noqa: E402
+from fake_servers import FakeAudD  # noqa: E402
+from fingerprint import FingerprintIndex, fingerprint_pcm  # noqa: E402
+from providers import AudDProvider  # noqa: E402
+
+REFERENCE_PROFILE = "mp3_stereo"
+
+
+def synthetic_segments(count: int, seconds: float) -> list:
+    """Сегменты из аккордов с шумом — если файл не указан"""
+    rng = np.random.default_rng(0)
+    rate, channels = audio_stream.SAMPLE_RATE, audio_stream.CHANNELS
+    segments = []
+    for _ in range(count):
+        t = np.arange(int(seconds * rate)) / rate
+        notes = rng.uniform(100, 3000, size=(int(seconds * 4), 3))
+        signal = np.zeros_like(t)
+        step = len(t) // len(notes)
+        for i, freqs in enumerate(notes):
+            part = slice(i * step, (i + 1) * step)
+            signal[part] = sum(np.sin(2 * np.pi * f * t[part]) for f in freqs)
+        signal = signal / np.abs(signal).max() * 0.5 + rng.normal(0, 0.02, len(t))
+        segments.append((np.repeat(signal[:, None], channels, axis=1) * 32767).astype(np.int16).tobytes())
+    return segments
+
+
+async def file_segments(path: str, count: int, seconds: float) -> list:
+    segments = []
+    async for block in read_pcm_blocks(path, seconds, duration=count * seconds):
+        segments.append(block)
+    return segments
+
+
+async def decode(data: bytes) -> bytes:
+    """Декодирует загрузку обратно в PCM бота — так её «услышит» сервис"""
+    blocks = [block async for block in read_pcm_blocks(data, 3600)]
+    return b"".join(blocks)
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def bench_profile(name: str, segments: list, index: FingerprintIndex, reference: list,
+                        provider: AudDProvider, real: AudDProvider) -> dict:
+    profile = get_profile(name)
+    cpu = children_cpu()
+    started = time.perf_counter()
+    encoded = [await encode_segment(pcm, name) for pcm in segments]
+    encode_seconds = time.perf_counter() - started
+    encode_cpu = children_cpu() - cpu
+
+    survived = []
+    found = 0
+    for i, data in enumerate(encoded):
+        hashes, offsets = fingerprint_pcm(await decode(data), audio_stream.SAMPLE_RATE, audio_stream.CHANNELS)
+        match = index.lookup(hashes, offsets)
+        found += match is not None and match["title"] == f"segment_{i}"
+        survived.append((match or {}).get("matches", 0) / max(1, len(reference[i])))
+
+    latencies = []
+    for i, data in enumerate(encoded):
+        started = time.perf_counter()
+        await provider.recognize(data, profile.filename(f"segment_{i}"), profile.content_type)
+        latencies.append(time.perf_counter() - started)
+
+    agreement = None
+    if real is not None:
+        titles = []
+        for i, data in enumerate(encoded):
+            results = await real.recognize(data, profile.filename(f"segment_{i}"), profile.content_type)
+            titles.append(results[0].get("title") if results else None)
+        agreement = titles
+
+    return {
+        "encode_ms": encode_seconds / len(segments) * 1000,
+        "cpu_ms": encode_cpu / len(segments) * 1000,
+        "kb": sum(len(data) for data in encoded) / len(segments) / 1024,
+        "found": found,
+        "survived": sum(survived) / len(survived),
+        "rtt_ms": sorted(latencies)[len(latencies) // 2] * 1000,
+        "titles": agreement,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="аудиофайл для нарезки (по умолчанию — синтетический сигнал)")
+    parser.add_argument("--segments", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=12, help="длительность сегмента (сек)")
+    parser.add_argument("--profiles", default=",".join(PROFILES), help="профили через запятую")
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка фейкового API (сек)")
+    parser.add_argument("--uplink-mbps", type=float, default=2.0, help="имитируемая скорость загрузки")
+    parser.add_argument("--audd-token", help="проверить точность на настоящем AudD (тратит запросы)")
+    parser.add_argument("--ffmpeg", default=audio_stream.FFMPEG_PATH)
+    args = parser.parse_args()
+
+    audio_stream.FFMPEG_PATH = args.ffmpeg
+    if args.file:
+        segments = await file_segments(args.file, args.segments, args.seconds)
+    else:
+        segments = synthetic_segments(args.segments, args.seconds)
+
+    # Эталон точности: отпечатки несжатых сегментов
+    index = FingerprintIndex(tempfile.mkdtemp(prefix="bench_encoding_"))
+    reference = []
+    for i, pcm in enumerate(segments):
+        hashes, offsets = fingerprint_pcm(pcm, audio_stream.SAMPLE_RATE, audio_stream.CHANNELS)
+        index.add({"title": f"segment_{i}", "artist": "bench"}, hashes, offsets)
+        reference.append(hashes)
+
+    server = FakeAudD(latency=args.latency, uplink_mbps=args.uplink_mbps)
+    provider = AudDProvider("fake-token", api_url=await server.start())
+    real = AudDProvider(args.audd_token) if args.audd_token else None
+
+    print(f"segments={len(segments)}x{args.seconds:g}s uplink={args.uplink_mbps:g}Mbit/s latency={args.latency:g}s")
+    print(f"{'profile':>14} {'encode, ms':>10} {'cpu, ms':>8} {'KB/seg':>7} {'found':>6} {'hashes':>7} {'rtt, ms':>8}")
+    rows = {}
+    try:
+        for name in args.profiles.split(","):
+            row = rows[name] = await bench_profile(name, segments, index, reference, provider, real)
+            print(f"{name:>14} {row['encode_ms']:>10.1f} {row['cpu_ms']:>8.1f} {row['kb']:>7.1f} "
+                  f"{row['found']:>3}/{len(segments):<2} {row['survived']:>6.0%} {row['rtt_ms']:>8.0f}")
+    finally:
+        await recognition.close_session()
+        await server.stop()
+
+    if real is not None and REFERENCE_PROFILE in rows:
+        reference_titles = rows[REFERENCE_PROFILE]["titles"]
+        for name, row in rows.items():
+            same = sum(a == b for a, b in zip(row["titles"], reference_titles))
+            print(f"AudD {name}: {same}/{len(segments)} совпадает с {REFERENCE_PROFILE}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+"""Бенчмарк: размер локального индекса отпечатков и задержка поиска
+
+Индекс строится из синтетических хэшей (равномерно по 24 битам) в формате
+FingerprintIndex и открывается через memory map, как в боте. Запрос —
+часть хэшей трека со сдвигом во времени плюс случайные хэши шума.
+
+Запуск: python benchmarks/bench_fingerprint.py --tracks 100000 --hashes-per-track 1000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audio_stream  # noqa: E402
+from fingerprint import FingerprintIndex, fingerprint_pcm  # noqa: E402
+
+HASH_SPACE = 1 << 24
+
+
+def build_index(path: str, tracks: int, hashes_per_track: int, seed: int) -> tuple:
+    """Записывает синтетический индекс на диск; возвращает (время построения, байт на диске)"""
+    rng = np.random.default_rng(seed)
+    started = time.perf_counter()
+    hashes = rng.integers(0, HASH_SPACE, tracks * hashes_per_track, dtype=np.uint32)
+    ids = np.repeat(np.arange(tracks, dtype=np.uint32), hashes_per_track)
+    offsets = rng.integers(0, 600, tracks * hashes_per_track, dtype=np.uint32)
+    order = np.argsort(hashes, kind="stable")
+
+    # Раскладка как у FingerprintIndex._merge: поколение массивов и указатель на него
+    generation = os.path.join(path, "gen-00000001")
+    os.makedirs(generation, exist_ok=True)
+    np.save(os.path.join(generation, "hashes.npy"), hashes[order])
+    np.save(os.path.join(generation, "ids.npy"), ids[order])
+    np.save(os.path.join(generation, "offsets.npy"), offsets[order])
+    with open(os.path.join(path, "current"), "w", encoding="utf-8") as f:
+        f.write("gen-00000001")
+    with open(os.path.join(path, "tracks.jsonl"), "w", encoding="utf-8") as f:
+        for track_id in range(tracks):
+            f.write(json.dumps({"title": f"track_{track_id}", "artist": "bench", "score": 100}) + "\n")
+    elapsed = time.perf_counter() - started
+
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return elapsed, size
+
+
+def make_query(index: FingerprintIndex, track_id: int, matched: int, noise: int, rng) -> tuple:
+    """Хэши трека track_id (со сдвигом во времени) вперемешку со случайными"""
+    positions = np.nonzero(np.asarray(index._ids) == track_id)[0]
+    positions = rng.choice(positions, min(matched, len(positions)), replace=False)
+    shift = int(rng.integers(0, 100))
+    offsets = np.asarray(index._offsets)[positions].astype(np.int64) + shift
+    hashes = np.concatenate([np.asarray(index._hashes)[positions],
+                             rng.integers(0, HASH_SPACE, noise, dtype=np.uint32)])
+    offsets = np.concatenate([offsets, rng.integers(0, 600, noise)]).astype(np.uint32)
+    return hashes, offsets
+
+
+def fingerprint_time(repeat: int) -> tuple:
+    """Время вычисления отпечатка 12-секундной пробы (синтетический сигнал)"""
+    rng = np.random.default_rng(1)
+    t = np.arange(12 * audio_stream.SAMPLE_RATE) / audio_stream.SAMPLE_RATE
+    signal = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(100, 3000, 6))
+    signal = signal / np.abs(signal).max() * 0.5 + rng.normal(0, 0.02, len(t))
+    pcm = (np.repeat(signal[:, None], audio_stream.CHANNELS, axis=1) * 32767).astype(np.int16).tobytes()
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        hashes, _ = fingerprint_pcm(pcm, audio_stream.SAMPLE_RATE, audio_stream.CHANNELS)
+        timings.append(time.perf_counter() - started)
+    return min(timings), len(hashes)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tracks", type=int, default=100_000, help="треков в индексе")
+    parser.add_argument("--hashes-per-track", type=int, default=1000, help="хэшей на трек (~одна 12-секундная проба)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--matched", type=int, default=300, help="совпадающих хэшей в запросе")
+    parser.add_argument("--noise", type=int, default=700, help="случайных хэшей в запросе")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", help="каталог для индекса (по умолчанию временный, удаляется)")
+    args = parser.parse_args()
+
+    path = args.keep or tempfile.mkdtemp(prefix="fingerprints_")
+    try:
+        build_seconds, size = build_index(path, args.tracks, args.hashes_per_track, args.seed)
+        index = FingerprintIndex(path)
+        started = time.perf_counter()
+        index.load()
+        load_seconds = time.perf_counter() - started
+
+        rng = np.random.default_rng(args.seed + 1)
+        timings = []
+        correct = 0
+        for _ in range(args.queries):
+            track_id = int(rng.integers(0, args.tracks))
+            hashes, offsets = make_query(index, track_id, args.matched, args.noise, rng)
+            started = time.perf_counter()
+            match = index.lookup(hashes, offsets)
+            timings.append(time.perf_counter() - started)
+            correct += match is not None and match["title"] == f"track_{track_id}"
+
+        misses = []
+        for _ in range(args.queries):
+            hashes = rng.integers(0, HASH_SPACE, args.matched + args.noise, dtype=np.uint32)
+            offsets = rng.integers(0, 600, len(hashes)).astype(np.uint32)
+            misses.append(index.lookup(hashes, offsets) is None)
+
+        timings.sort()
+        fp_seconds, fp_hashes = fingerprint_time(5)
+        entries = args.tracks * args.hashes_per_track
+        print(f"tracks={args.tracks} hashes/track={args.hashes_per_track} entries={entries:,}")
+        print(f"index on disk: {size / 2**20:.1f} MiB ({size / args.tracks:.0f} B/track), "
+              f"build {build_seconds:.1f}s, open {load_seconds * 1000:.1f}ms")
+        print(f"lookup: p50 {timings[len(timings) // 2] * 1000:.2f}ms, "
+              f"p95 {timings[int(len(timings) * 0.95)] * 1000:.2f}ms, max {timings[-1] * 1000:.2f}ms")
+        print(f"accuracy: {correct}/{args.queries} found, {sum(misses)}/{args.queries} random queries rejected")
+        print(f"fingerprint of a 12s probe: {fp_seconds * 1000:.1f}ms, {fp_hashes} hashes")
+    finally:
+        if not args.keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Бенчмарк: задержка распознавания файла в зависимости от параллелизма
+
+Запуск: python benchmarks/bench_recognition.py --segments 10 --latency 0.8
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import recognition  # noqa: E402
+from fake_servers import FakeAudD  # noqa: E402
+from providers import AudDProvider  # noqa: E402
+
+
+async def run_once(url: str, segments: list, concurrency: int) -> float:
+    recognition.configure_provider("audd", concurrency)
+    provider = AudDProvider("fake-token", api_url=url)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        provider.recognize(data, filename=f"segment_{i}.mp3")
+        for i, data in enumerate(segments)
+    ))
+    elapsed = time.perf_counter() - started
+
+    titles = [r[0]["title"] for r in results if r]
+    assert titles == sorted(titles, key=lambda t: int(t.rsplit("_", 1)[1].split(".")[0])), \
+        "результаты должны идти в порядке сегментов"
+    return elapsed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segments", type=int, default=10, help="сегментов в файле")
+    parser.add_argument("--segment-kb", type=int, default=480, help="размер сегмента (КБ)")
+    parser.add_argument("--latency", type=float, default=0.8, help="задержка фейкового API (сек)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="случайная добавка к задержке (сек)")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="уровни параллелизма")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    server = FakeAudD(latency=args.latency, jitter=args.jitter)
+    url = await server.start()
+    segments = [os.urandom(args.segment_kb * 1024) for _ in range(args.segments)]
+
+    print(f"segments={args.segments} latency={args.latency}s jitter={args.jitter}s")
+    print(f"{'concurrency':>11} {'best, s':>8} {'mean, s':>8} {'speedup':>8}")
+    baseline = None
+    try:
+        for level in [int(x) for x in args.concurrency.split(",")]:
+            timings = [await run_once(url, segments, level) for _ in range(args.repeat)]
+            mean = sum(timings) / len(timings)
+            baseline = baseline or mean
+            print(f"{level:>11} {min(timings):>8.2f} {mean:>8.2f} {baseline / mean:>7.1f}x")
+    finally:
+        await recognition.close_session()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
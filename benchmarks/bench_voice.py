@@ -0,0 +1,122 @@
+"""Бенчмарк коротких клипов: загрузка как есть против перекодирования и полного анализа
+
+Генерирует клипы, похожие на голосовые (Opus в Ogg) и видеосообщения (H.264 +
+AAC в MP4), и распознаёт их через фейковый AudD тремя путями бота:
+    passthrough — сигнатура контейнера и загрузка файла без ffmpeg
+    transcode   — одно перекодирование клипа в профиль провайдера
+    probes      — полный путь длинных файлов (analyze_file: разметка, пробы, кодирование)
+Для каждого пути выводятся p50/p95 времени до ответа, время подготовки загрузки,
+объём загрузки и число запросов к API.
+
+Запуск: python benchmarks/bench_voice.py --clips 20 --durations 3,8,15 --api-latency 0.3
+"""
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import recognition  # noqa: E402
+from audio_stream import sniff_format  # noqa: E402
+from fake_servers import FakeAudD  # noqa: E402
+from load_test import GENERATE_RATE, configure_bot, percentile, synthetic_pcm  # noqa: E402
+
+# Как Telegram кодирует голосовые и видеосообщения
+CLIP_FORMATS = {
+    "voice": (["-c:a", "libopus", "-b:a", "32k", "-ar", "48000", "-f", "ogg"], False),
+    "video_note": (["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac", "-b:a", "64k",
+                    "-movflags", "+faststart", "-f", "mp4"], True),
+}
+PATHS = ("passthrough", "transcode", "probes")
+
+
+def encode_clip(pcm: bytes, kind: str, ffmpeg: str):
+    args, video = CLIP_FORMATS[kind]
+    cmd = [ffmpeg, "-v", "error", "-f", "s16le", "-ac", "1", "-ar", str(GENERATE_RATE), "-i", "pipe:0"]
+    if video:
+        seconds = len(pcm) / 2 / GENERATE_RATE
+        cmd += ["-f", "lavfi", "-i", f"testsrc=size=240x240:rate=30:duration={seconds}", "-shortest"]
+    # MP4 не пишется в пайп (moov в начале требует seek), поэтому через временный файл
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "clip")
+        try:
+            subprocess.run(cmd + args + ["-y", path], input=pcm, stderr=subprocess.PIPE, check=True)
+        except subprocess.CalledProcessError:
+            return None  # Нет нужного кодировщика в этой сборке ffmpeg
+        with open(path, "rb") as f:
+            return f.read()
+
+
+async def run_path(bot, path: str, data: bytes) -> tuple:
+    """(секунд до ответа, секунд на подготовку загрузки)"""
+    started = time.perf_counter()
+    if path == "probes":
+        await bot.analyze_file(data)
+        return time.perf_counter() - started, None
+    uploads = await bot.clip_uploads(data, passthrough=path == "passthrough")
+    prepared = time.perf_counter()
+    await bot.router.recognize_uploads(uploads)
+    return time.perf_counter() - started, prepared - started
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clips", type=int, default=20, help="клипов на каждый путь и формат")
+    parser.add_argument("--durations", default="3,8,15", help="длительности клипов (сек)")
+    parser.add_argument("--kinds", default="voice,video_note")
+    parser.add_argument("--api-latency", type=float, default=0.3)
+    parser.add_argument("--uplink-mbps", type=float, default=None, help="ограничить канал загрузки в фейковый AudD")
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_voice_")
+    os.chdir(workdir)
+    bot = importlib.import_module("bot")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    audd = FakeAudD(latency=args.api_latency, uplink_mbps=args.uplink_mbps)
+    config = SimpleNamespace(ffmpeg=args.ffmpeg, acrcloud=False, cache=False, prefilter=False, fingerprints=False)
+    configure_bot(bot, config, await audd.start(), None, workdir)
+
+    durations = [float(d) for d in args.durations.split(",")]
+    print(f"{'вид':>10} {'путь':>12} {'p50, мс':>8} {'p95, мс':>8} {'подготовка, мс':>15} {'КБ':>6} {'api':>5}")
+    try:
+        for kind in args.kinds.split(","):
+            clips = [encode_clip(synthetic_pcm(durations[i % len(durations)], i), kind, args.ffmpeg)
+                     for i in range(args.clips)]
+            if clips[0] is None:
+                print(f"{kind:>10}: ffmpeg не умеет кодировать этот формат, пропускаем")
+                continue
+            fmt = sniff_format(clips[0])
+
+            for path in PATHS:
+                if path == "passthrough" and not bot.router.accepts(fmt):
+                    print(f"{kind:>10} {path:>12}   контейнер {fmt} провайдер не принимает — будет перекодирован")
+                    continue
+                requests, received = audd.requests, audd.bytes_received
+                totals, prepares = [], []
+                for data in clips:
+                    total, prepare = await run_path(bot, path, data)
+                    totals.append(total)
+                    if prepare is not None:
+                        prepares.append(prepare)
+                calls = audd.requests - requests
+                prepare = f"{percentile(prepares, 0.5) * 1000:.1f}" if prepares else "—"
+                print(f"{kind:>10} {path:>12} {percentile(totals, 0.5) * 1000:>8.0f} "
+                      f"{percentile(totals, 0.95) * 1000:>8.0f} {prepare:>15} "
+                      f"{(audd.bytes_received - received) / max(calls, 1) / 1024:>6.1f} {calls / len(clips):>5.1f}")
+    finally:
+        await recognition.close_session()
+        await audd.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
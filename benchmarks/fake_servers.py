@@ -0,0 +1,199 @@
+"""Локальные фейковые серверы API для бенчмарков"""
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeAudD:
+    """Фейковый AudD: отвечает с заданной задержкой и долей ошибок
+
+    uplink_mbps имитирует канал загрузки: к задержке добавляется время
+    передачи тела запроса с такой скоростью.
+    """
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0, error_rate: float = 0.0, uplink_mbps: float = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.uplink_mbps = uplink_mbps
+        self.bytes_received = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._runner = None
+        self.url = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            form = await request.post()
+            size = request.content_length or 0
+            self.bytes_received += size
+            transfer = size * 8 / (self.uplink_mbps * 1_000_000) if self.uplink_mbps else 0.0
+            await asyncio.sleep(self.latency + transfer + random.uniform(0, self.jitter))
+
+            if random.random() < self.error_rate:
+                return web.Response(status=503, text="unavailable")
+
+            upload = form.get("file")
+            name = getattr(upload, "filename", "segment")
+            return web.Response(
+                text=json.dumps({
+                    "status": "success",
+                    "result": {
+                        "artist": "Fake Artist",
+                        "title": f"Track {name}",
+                        "album": "Fake Album",
+                        "score": 90,
+                    },
+                }),
+                content_type="application/json",
+            )
+        finally:
+            self.in_flight -= 1
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class FakeACRCloud:
+    """Фейковый ACRCloud (/v1/identify) с задержкой и долей ошибок"""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self._runner = None
+        self.url = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        form = await request.post()
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if random.random() < self.error_rate:
+            return web.Response(status=503, text="unavailable")
+
+        name = getattr(form.get("sample"), "filename", "sample")
+        return web.json_response({
+            "status": {"code": 0, "msg": "Success"},
+            "metadata": {"music": [{
+                "title": f"Track {name}",
+                "artists": [{"name": "Fake Artist"}],
+                "album": {"name": "Fake Album"},
+                "score": 85,
+            }]},
+        })
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/identify", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class FakeTelegram:
+    """Фейковый Bot API: методы бота и раздача файлов из памяти
+
+    Бот подключается через base_url=f"{url}bot" и base_file_url=f"{url}file/bot".
+    error_rate — доля ответов 502 на методы (файлы отдаются всегда).
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.files = {}  # file_id -> bytes
+        self.calls = {}  # метод -> число вызовов
+        self._message_ids = itertools.count(1000)
+        self._runner = None
+        self.url = None
+
+    def add_file(self, file_id: str, data: bytes) -> None:
+        self.files[file_id] = data
+
+    def _message(self, params) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def method(self, request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post()) if request.can_read_body else {}
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if name != "getMe" and random.random() < self.error_rate:
+            return web.Response(status=502, text="bad gateway")
+
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        elif name == "getFile":
+            file_id = params.get("file_id")
+            data = self.files.get(file_id)
+            if data is None:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: file not found"})
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data),
+                      "file_path": f"music/{file_id}"}
+        elif name in ("sendMessage", "editMessageText"):
+            result = self._message(params)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def download(self, request: web.Request) -> web.Response:
+        data = self.files.get(request.match_info["file_id"])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.method)
+        app.router.add_get("/file/bot{token}/music/{file_id}", self.download)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
@@ -0,0 +1,67 @@
+"""Генераторы JSON-обновлений Telegram для тестовых прогонов"""
+import itertools
+import time
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def _chat(user_id: int) -> dict:
+    return {"id": user_id, "type": "private", "first_name": f"User{user_id}"}
+
+
+def command_update(user_id: int, text: str = "/start") -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": _chat(user_id),
+            "from": _user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+
+def audio_update(user_id: int, file_id: str, file_unique_id: str = None, duration: int = 180,
+                 file_size: int = 3_000_000, mime_type: str = "audio/mpeg", voice: bool = False) -> dict:
+    media = {
+        "file_id": file_id,
+        "file_unique_id": file_unique_id or file_id,
+        "duration": duration,
+        "mime_type": mime_type,
+        "file_size": file_size,
+    }
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": _chat(user_id),
+            "from": _user(user_id),
+            "voice" if voice else "audio": media,
+        },
+    }
+
+
+def callback_update(user_id: int, data: str, message_id: int = 1) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": _chat(user_id),
+                "text": "track card",
+            },
+        },
+    }
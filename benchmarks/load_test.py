@@ -0,0 +1,368 @@
+"""Нагрузочный тест бота целиком: handle_audio и button_callback на фейковых серверах
+
+Бот (bot.py или bot2.py) работает с фейковыми Telegram, AudD и ACRCloud, у
+которых настраиваются задержка и доля ошибок. Аудио генерируется заранее:
+синтетические «треки» разной длины в нескольких форматах (нужен ffmpeg).
+Для каждого уровня параллелизма выводятся пропускная способность,
+p50/p95/p99 задержки файла и нажатия кнопки, пик RSS и задержка event loop.
+
+Базовая линия: --save-baseline сохраняет результаты в JSON, --baseline
+сравнивает с ними и завершается с кодом 1 при регрессии больше --tolerance.
+Без --baseline запуск с параметрами по умолчанию сравнивается с baseline.json
+рядом со скриптом. Базовая линия с другой машины (поле machine) не сравнивается:
+на своей машине её нужно переснять.
+
+Запуск:
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --save-baseline benchmarks/baseline.json
+    python benchmarks/load_test.py --concurrency 1,4,16 --files 32 --baseline my_baseline.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, CallbackContext  # noqa: E402
+
+import audio_stream  # noqa: E402
+import recognition  # noqa: E402
+from fake_servers import FakeACRCloud, FakeAudD, FakeTelegram  # noqa: E402
+from fake_updates import audio_update, callback_update  # noqa: E402
+from fingerprint import FingerprintIndex  # noqa: E402
+from job_queue import create_queue  # noqa: E402
+from providers import ACRCloudProvider, AudDProvider, ProviderRouter  # noqa: E402
+from rate_limit import create_limiter  # noqa: E402
+from session_store import create_store  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+REPORT_ONLY = ("save_baseline", "baseline", "json", "ffmpeg", "verbose")  # Не влияют на сравнимость результатов
+GENERATE_RATE = 22050
+TRACK_SECONDS = 60  # Длина одного синтетического «трека» внутри файла
+FORMATS = {
+    "mp3": (["-c:a", "libmp3lame", "-b:a", "192k", "-f", "mp3"], "audio/mpeg"),
+    "ogg": (["-c:a", "libopus", "-b:a", "96k", "-f", "ogg"], "audio/ogg"),
+    "wav": (["-f", "wav"], "audio/wav"),
+    "aac": (["-c:a", "aac", "-b:a", "128k", "-f", "adts"], "audio/aac"),
+}
+# Что сравнивается с базовой линией: метрика -> True, если больше — лучше
+BASELINE_METRICS = {"throughput": True, "audio_p95": False, "audio_p99": False, "click_p95": False,
+                    "loop_lag_p99": False, "rss_peak_mb": False}
+
+
+class NoCache:
+    """Кэш результатов, который ничего не хранит: каждый файл проходит весь конвейер"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+def synthetic_pcm(duration: float, seed: int) -> bytes:
+    """Моно PCM: каждые TRACK_SECONDS новый набор нот, аккорды по четверти секунды и шум"""
+    rng = np.random.default_rng(seed)
+    chunks = []
+    for track_start in range(0, int(duration), TRACK_SECONDS):
+        length = min(TRACK_SECONDS, duration - track_start)
+        palette = rng.uniform(110, 1760, 12)
+        t = np.arange(int(length * GENERATE_RATE)) / GENERATE_RATE
+        notes = palette[rng.integers(0, len(palette), size=(int(length * 4) + 1, 3))]
+        step = (t * 4).astype(int)
+        signal = sum(np.sin(2 * np.pi * notes[step, i] * t) for i in range(3))
+        signal = signal / 3 * 0.6 + rng.normal(0, 0.02, len(t))
+        chunks.append((signal * 32767).astype(np.int16).tobytes())
+    return b"".join(chunks)
+
+
+def encode_file(pcm: bytes, fmt: str, ffmpeg: str) -> bytes:
+    args, _ = FORMATS[fmt]
+    return subprocess.run(
+        [ffmpeg, "-v", "error", "-f", "s16le", "-ac", "1", "-ar", str(GENERATE_RATE), "-i", "pipe:0", *args, "pipe:1"],
+        input=pcm, stdout=subprocess.PIPE, check=True
+    ).stdout
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LoopMonitor:
+    """Фоновая задача: задержка event loop и RSS процесса"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags = []
+        self.rss_peak = 0.0
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+            self.rss_peak = max(self.rss_peak, current_rss_mb())
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def configure_bot(module, args, audd_url: str, acr_url: str, workdir: str) -> None:
+    """Подключает бота к фейковым сервисам и изолирует его состояние во временном каталоге"""
+    audio_stream.FFMPEG_PATH = args.ffmpeg
+    module.router = ProviderRouter([
+        AudDProvider("fake-token", api_url=audd_url),
+        ACRCloudProvider("fake-key", "fake-secret", acr_url) if args.acrcloud else None,
+    ], module.RECOGNITION_STRATEGY)
+    module.sessions = create_store("memory")
+    module.limiter = create_limiter("memory", user_burst=10 ** 6, global_burst=10 ** 6,
+                                    daily_budget=10 ** 9, user_daily_budget=10 ** 9)
+    if not args.cache:
+        module.cache = NoCache()
+    if hasattr(module, "SKIP_NON_MUSIC"):
+        module.SKIP_NON_MUSIC = args.prefilter
+    if hasattr(module, "jobs"):
+        module.jobs = create_queue("memory")
+    if hasattr(module, "USE_FINGERPRINTS"):
+        module.USE_FINGERPRINTS = args.fingerprints
+        module.fingerprints = FingerprintIndex(os.path.join(workdir, "fingerprints"))
+
+
+async def wait_job(module, key: str) -> None:
+    """Ждёт, пока воркер бота закончит задание файла (у бота без очереди — сразу)"""
+    if not hasattr(module, "jobs"):
+        return
+    while True:
+        job = module.jobs.find(key)
+        if job is None or job.status in ("done", "dead"):
+            return
+        await asyncio.sleep(0.02)
+
+
+async def run_level(module, application, telegram: FakeTelegram, files: list, args, level: int,
+                    counters: list) -> dict:
+    """Прогон одного уровня параллелизма: args.files сессий «файл + нажатия кнопок»"""
+    semaphore = asyncio.Semaphore(level)
+    audio_latencies, click_latencies = [], []
+    clicks = ["next_track", "next_track", "prev_track"] if hasattr(module, "refresh_card") else ["next_track"]
+    monitor = LoopMonitor()
+    calls_before = sum(counter() for counter in counters)
+
+    async def session(n: int) -> None:
+        data, fmt, duration = files[n % len(files)]
+        user_id = 10_000 * level + n
+        file_id = f"load-{level}-{n}.{fmt}"
+        telegram.add_file(file_id, data)
+
+        async with semaphore:
+            update = Update.de_json(audio_update(user_id, file_id, duration=int(duration), file_size=len(data),
+                                                 mime_type=FORMATS[fmt][1]), application.bot)
+            started = time.perf_counter()
+            await module.handle_audio(update, CallbackContext.from_update(update, application))
+            await wait_job(module, f"{update.effective_chat.id}:{update.message.message_id}")
+            audio_latencies.append(time.perf_counter() - started)
+
+            for i in range(args.clicks):
+                update = Update.de_json(callback_update(user_id, clicks[i % len(clicks)]), application.bot)
+                started = time.perf_counter()
+                await module.button_callback(update, CallbackContext.from_update(update, application))
+                click_latencies.append(time.perf_counter() - started)
+        telegram.files.pop(file_id, None)
+
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(session(n) for n in range(args.files)))
+    elapsed = time.perf_counter() - started
+    await monitor.stop()
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {
+        "throughput": args.files / elapsed,
+        "audio_p50": percentile(audio_latencies, 0.5),
+        "audio_p95": percentile(audio_latencies, 0.95),
+        "audio_p99": percentile(audio_latencies, 0.99),
+        "click_p50": percentile(click_latencies, 0.5),
+        "click_p95": percentile(click_latencies, 0.95),
+        "click_p99": percentile(click_latencies, 0.99),
+        "loop_lag_p99": percentile(monitor.lags, 0.99),
+        "loop_lag_max": max(monitor.lags, default=0.0),
+        "rss_peak_mb": monitor.rss_peak,
+        "ffmpeg_rss_peak_mb": children,
+        "api_calls": sum(counter() for counter in counters) - calls_before,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Регрессии относительно базовой линии: [(уровень, метрика, было, стало)]"""
+    regressions = []
+    for level, row in results.items():
+        previous = baseline.get("levels", {}).get(level)
+        if previous is None:
+            continue
+        for metric, higher_is_better in BASELINE_METRICS.items():
+            old, new = previous.get(metric), row.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append((level, metric, old, new))
+    return regressions
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", default="bot", choices=["bot", "bot2"], help="какой бот нагружать")
+    parser.add_argument("--concurrency", default="1,4,16", help="уровни параллелизма (одновременных пользователей)")
+    parser.add_argument("--files", type=int, default=16, help="файлов на уровень")
+    parser.add_argument("--durations", default="20,90,300", help="длительности генерируемых файлов (сек)")
+    parser.add_argument("--formats", default="mp3,ogg,wav,aac")
+    parser.add_argument("--clicks", type=int, default=3, help="нажатий кнопок после каждого файла")
+    parser.add_argument("--api-latency", type=float, default=0.5)
+    parser.add_argument("--api-jitter", type=float, default=0.3)
+    parser.add_argument("--api-errors", type=float, default=0.02, help="доля ответов 503 от API")
+    parser.add_argument("--tg-latency", type=float, default=0.05)
+    parser.add_argument("--tg-errors", type=float, default=0.0, help="доля ответов 502 от Telegram")
+    parser.add_argument("--acrcloud", action="store_true", help="добавить второй провайдер (фейковый ACRCloud)")
+    parser.add_argument("--prefilter", action="store_true", help="включить отсев тишины и речи")
+    parser.add_argument("--fingerprints", action="store_true", help="включить локальный индекс отпечатков")
+    parser.add_argument("--cache", action="store_true", help="включить кэш результатов (по умолчанию выключен)")
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", help="сохранить результаты как базовую линию (JSON)")
+    parser.add_argument("--baseline", help="сравнить с базовой линией (JSON)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    parser.add_argument("--json", help="записать результаты в файл")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    for name in ("save_baseline", "baseline", "json"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    # Бот пишет кэши и базы в текущий каталог — изолируем их
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    os.chdir(workdir)
+    module = importlib.import_module(args.bot)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    print("Генерация аудио...")
+    files = []
+    for i, duration in enumerate(float(d) for d in args.durations.split(",")):
+        pcm = synthetic_pcm(duration, args.seed + i)
+        for fmt in args.formats.split(","):
+            files.append((encode_file(pcm, fmt, args.ffmpeg), fmt, duration))
+    random.shuffle(files)
+
+    telegram = FakeTelegram(latency=args.tg_latency, error_rate=args.tg_errors)
+    audd = FakeAudD(latency=args.api_latency, jitter=args.api_jitter, error_rate=args.api_errors)
+    acr = FakeACRCloud(latency=args.api_latency, jitter=args.api_jitter, error_rate=args.api_errors)
+    tg_url = await telegram.start()
+    configure_bot(module, args, await audd.start(), await acr.start(), workdir)
+
+    application = (
+        Application.builder().token("123456:LOADTEST").base_url(f"{tg_url}bot")
+        .base_file_url(f"{tg_url}file/bot").concurrent_updates(True).build()
+    )
+    await application.initialize()
+    if hasattr(module, "start_workers"):
+        # Задания выполняются в этом же процессе, слотов хватает на самый высокий уровень
+        module.start_workers(application.bot, max(int(x) for x in args.concurrency.split(",")))
+
+    results = {}
+    try:
+        print(f"{args.bot}: {args.files} файлов на уровень, форматы {args.formats}, длительности {args.durations} с")
+        print(f"{'conc':>4} {'files/s':>8} {'file p50/p95/p99, s':>22} {'click p50/p95/p99, ms':>24} "
+              f"{'lag p99/max, ms':>16} {'RSS, MB':>8} {'api':>5}")
+        for level in [int(x) for x in args.concurrency.split(",")]:
+            row = await run_level(module, application, telegram, files, args, level,
+                                  [lambda: audd.requests, lambda: acr.requests])
+            results[str(level)] = row
+            print(f"{level:>4} {row['throughput']:>8.2f} "
+                  f"{row['audio_p50']:>8.2f}/{row['audio_p95']:.2f}/{row['audio_p99']:.2f} "
+                  f"{row['click_p50'] * 1000:>10.0f}/{row['click_p95'] * 1000:.0f}/{row['click_p99'] * 1000:.0f} "
+                  f"{row['loop_lag_p99'] * 1000:>9.1f}/{row['loop_lag_max'] * 1000:.1f} "
+                  f"{row['rss_peak_mb']:>8.0f} {row['api_calls']:>5}")
+    finally:
+        if getattr(module, "worker", None) is not None:
+            await module.worker.stop()
+        await application.shutdown()
+        await recognition.close_session()
+        for server in (telegram, audd, acr):
+            await server.stop()
+
+    report = {"bot": args.bot, "config": {k: v for k, v in vars(args).items() if k not in REPORT_ONLY},
+              "machine": {"python": platform.python_version(), "system": platform.system(),
+                          "cpus": os.cpu_count()},
+              "levels": results}
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            print(f"Результаты записаны в {path}")
+
+    path = args.baseline or (BASELINE_FILE if not args.save_baseline and os.path.exists(BASELINE_FILE) else None)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("machine") != report["machine"]:
+            print(f"Базовая линия {path} снята на другой машине ({baseline.get('machine')}) — сравнение пропущено; "
+                  f"переснимите её через --save-baseline")
+            return 0
+        if baseline.get("config") != report["config"]:
+            if not args.baseline:
+                print(f"Параметры запуска отличаются от {path} — сравнение с базовой линией пропущено")
+                return 0
+            print("Внимание: базовая линия снята с другими параметрами, сравнение неточное")
+        regressions = compare(results, baseline, args.tolerance)
+        for level, metric, old, new in regressions:
+            print(f"РЕГРЕССИЯ conc={level} {metric}: {old:.3f} -> {new:.3f}")
+        if regressions:
+            return 1
+        print(f"Регрессий относительно {path} нет (допуск {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,73 @@
+"""Отправляет фейковые обновления Telegram на локальный webhook бота
+
+Бот запускается отдельно; WEBHOOK_REGISTER=0 — чтобы не вызывать setWebhook:
+    WEBHOOK_URL=http://localhost WEBHOOK_REGISTER=0 WEBHOOK_SECRET=test python bot.py
+
+Запуск: python benchmarks/webhook_harness.py --url http://127.0.0.1:8080 --secret test --count 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_updates import audio_update, callback_update, command_update  # noqa: E402
+
+
+def make_update(kind: str, user_id: int) -> dict:
+    if kind == "start":
+        return command_update(user_id)
+    if kind == "audio":
+        return audio_update(user_id, file_id=f"fake-{random.randrange(10 ** 9)}")
+    return callback_update(user_id, random.choice(["next_track", "prev_track"]))
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--path", default="/telegram")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--kinds", default="start,callback", help="типы обновлений: start, audio, callback")
+    parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    kinds = args.kinds.split(",")
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with aiohttp.ClientSession() as session:
+        for endpoint in ("/healthz", "/readyz"):
+            async with session.get(args.url + endpoint) as response:
+                print(f"{endpoint}: {response.status} {await response.text()}")
+
+        async def post_one(i: int) -> None:
+            update = make_update(kinds[i % len(kinds)], 1000 + i % args.users)
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(args.url + args.path, json=update, headers=headers) as response:
+                    statuses[response.status] += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post_one(i) for i in range(args.count)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"отправлено {args.count} обновлений за {elapsed:.2f} с ({args.count / elapsed:.0f}/с)")
+    print(f"статусы: {dict(statuses)}")
+    print(f"приём: p50={latencies[len(latencies) // 2] * 1000:.1f} мс, "
+          f"p95={latencies[int(len(latencies) * 0.95)] * 1000:.1f} мс")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
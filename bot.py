@@ -1,11 +1,37 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackContext, CallbackQueryHandler, filters
-from pydub import AudioSegment
 import logging
-import os
-import requests
-from collections import defaultdict
-import tempfile
+import asyncio
+import functools
+import itertools
+import math
+import multiprocessing
+import signal
+import sys
+from collections import Counter, defaultdict
+from contextlib import aclosing
+import audio_stream
+import downloads
+from audio_stream import (Segment, CONTAINERS, stream_segments, encode_segments, transcode,
+                          get_profile, is_buffer, sniff_format)
+from recognition import close_session
+from providers import AudDProvider, ACRCloudProvider, ProviderRouter
+from transcode_pool import pool as transcode_pool, QueueFullError
+from result_cache import cache, file_key, pcm_key
+from audio_features import analyze_segment, classify_segment
+from segmentation import plan_probes
+from scheduler import SamplingScheduler, MAX_API_CALLS_PER_FILE, track_key
+from aggregation import aggregate_tracks
+from progress import LiveStatus, ThrottledEdit
+from session_store import TrackRecord, create_store
+from webhook import WEBHOOK_URL, inflight, run_webhook
+from downloads import FileTooLargeError, StreamedFile, get_file, check_size, downloaded, streamed, too_large_text
+from fingerprint import fingerprint_pcm, index as fingerprints
+from pcm_cache import DecodedAudio, decoded
+from metrics import FILES, METRICS_PORT, stage, trace, observe, start_metrics_server, close_trace
+from rate_limit import create_limiter
+from job_queue import JobWorker, RetryLater, create_queue
+from rendering import RenderCache, new_version, page_keyboard, register_metrics
 
 # Настройка логирования
 logging.basicConfig(
@@ -16,198 +42,710 @@ logger = logging.getLogger(__name__)
 
 # Конфигурация
 AUDD_API_KEY = "your key from AUDD"
+ACR_ACCESS_KEY = ""  # Необязательный второй провайдер (ACRCloud); пусто — только AudD
+ACR_SECRET_KEY = ""
+ACR_HOST = ""
+RECOGNITION_STRATEGY = "hedged"  # primary, fastest, merge или hedged
+# Формат загрузки для каждого провайдера: mp3_mono_16k, opus_mono_16k, wav_mono_16k или mp3_stereo
+AUDD_UPLOAD_PROFILE = "mp3_mono_16k"
+ACR_UPLOAD_PROFILE = "mp3_mono_16k"
 TELEGRAM_TOKEN = "your telegram token for bot"
+BOT_API_URL = ""  # Локальный Bot API сервер (например http://localhost:8081); пусто — api.telegram.org
+BOT_API_LOCAL_MODE = False  # Сервер запущен с --local: файлы без предела 20 МБ, читаются с диска
 FFMPEG_PATH = r"your path to ffmpeg"
 SEGMENT_DURATION = 30  # Длительность сегмента для анализа (сек)
-MAX_SEGMENTS = 10  # Максимальное количество сегментов
-
-AudioSegment.converter = FFMPEG_PATH
-user_data = defaultdict(dict)
+MAX_PENDING_SEGMENTS = 4  # Сколько декодированных сегментов может ждать кодирования
+SKIP_NON_MUSIC = True  # Не отправлять в API тишину, речь и шум
+SEGMENTATION_MODE = "adaptive"  # adaptive — пробы по найденным границам треков, fixed — окна подряд,
+# stream — окна по всему файлу прямо во время скачивания, без разметки; набран бюджет — загрузка прекращается
+SESSION_BACKEND = "sqlite"  # memory — LRU в памяти процесса, sqlite — переживает перезапуск
+USE_FINGERPRINTS = True  # Узнавать уже распознанные треки по локальному индексу отпечатков, без API
+RESULT_ORDER = "votes"  # votes — сначала треки, за которые проголосовало больше фрагментов; time — в порядке звучания
+RATE_LIMIT_BACKEND = "sqlite"  # memory — в процессе, sqlite — общий для нескольких процессов (лимиты в rate_limit.py)
+JOB_QUEUE_BACKEND = "sqlite"  # memory — задания теряются при перезапуске, sqlite — переживают его и общие для воркеров
+JOB_CONCURRENCY = 8  # Сколько файлов один процесс распознаёт одновременно; 0 — процесс бота только ставит задания
+WORKER_PROCESSES = 0  # Сколько процессов-воркеров запустить рядом с ботом (то же, что python bot.py worker)
+QUEUE_FULL_RETRY_DELAY = 15  # Через сколько вернуться к заданию, если перекодирование перегружено (сек)
+CLIP_MAX_DURATION = 30  # Голосовые и файлы не длиннее (сек) распознаются сразу одним запросом, без очереди и проб
+CLIP_MAX_SIZE = 5 * 1024 * 1024  # ... и не больше (байт)
+
+audio_stream.FFMPEG_PATH = FFMPEG_PATH
+downloads.LOCAL_MODE = BOT_API_LOCAL_MODE
+sessions = create_store(SESSION_BACKEND)
+limiter = create_limiter(RATE_LIMIT_BACKEND)
+jobs = create_queue(JOB_QUEUE_BACKEND)
+worker = None  # Воркер этого процесса (JobWorker), если он выполняет задания
+router = ProviderRouter([
+    AudDProvider(AUDD_API_KEY, encoding=AUDD_UPLOAD_PROFILE),
+    ACRCloudProvider(ACR_ACCESS_KEY, ACR_SECRET_KEY, ACR_HOST, encoding=ACR_UPLOAD_PROFILE) if ACR_ACCESS_KEY else None,
+], RECOGNITION_STRATEGY)
+# Кодирование сегментов для API: не больше процессов ffmpeg, чем слотов пула перекодирования
+encode_slots = asyncio.Semaphore(transcode_pool.size)
+
+observe("jobs", "Задания в очереди по статусам", lambda: jobs.stats(), ("status",))
+observe("jobs_active", "Задания, которые выполняет этот процесс", lambda: worker.active if worker else 0)
 
 
 async def start(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text(
-        "🎵 Отправьте аудиофайл, и я найду все треки в нём!\n"
+        "🎵 Отправьте аудиофайл или голосовое сообщение, и я найду все треки в нём!\n"
         "Анализирую файл по частям для лучшего результата."
     )
 
 
-def split_audio(input_path: str) -> list:
-    """Разбивает аудио на сегменты и возвращает пути к временным файлам"""
+async def split_audio(source, user_id=None, on_queued=None, max_segments: int = MAX_API_CALLS_PER_FILE,
+                      every: int = 1):
+    """Потоково разбивает аудио на фиксированные сегменты (ffmpeg декодирует файл один раз)"""
     try:
-        audio = AudioSegment.from_file(input_path)
-        duration = len(audio)
-        segments = []
-
-        # Создаем временную папку
-        temp_dir = tempfile.mkdtemp()
-
-        # Разбиваем на сегменты с перекрытием
-        for i in range(0, min(MAX_SEGMENTS * SEGMENT_DURATION * 1000, duration), SEGMENT_DURATION * 1000):
-            start_time = i
-            end_time = min(i + SEGMENT_DURATION * 1000, duration)
-            segment = audio[start_time:end_time]
+        async with transcode_pool.slot(user_id, on_queued):
+            async with aclosing(stream_segments(source, SEGMENT_DURATION, max_segments, every)) as segments:
+                async for segment in segments:
+                    yield segment
+    except QueueFullError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка разделения аудио: {str(e)}")
+        raise
 
-            segment_path = os.path.join(temp_dir, f"segment_{i // 1000}.mp3")
-            segment.export(segment_path, format="mp3")
-            segments.append(segment_path)
 
-        return segments
+async def recognize_segment(segment, pending: asyncio.Semaphore = None, usage: Counter = None) -> list:
+    """Кодирует сегмент и отправляет его провайдерам (или берёт результат из кэша / индекса отпечатков)
 
+    usage["api"] считает реальные запросы к провайдерам (их считают сами провайдеры) — для суточного бюджета,
+    usage["failed"] — сегменты, которые не удалось распознать из-за ошибки.
+    """
+    try:
+        key = pcm_key(segment.pcm)
+        results = await asyncio.to_thread(cache.get, key)
+        if results is not None:
+            segment.pcm = None
+        else:
+            hashes = offsets = match = None
+            try:
+                if USE_FINGERPRINTS:
+                    with stage("fingerprint"):
+                        hashes, offsets = await asyncio.to_thread(
+                            fingerprint_pcm, segment.pcm, segment.sample_rate, segment.channels
+                        )
+                        match = await asyncio.to_thread(fingerprints.lookup, hashes, offsets)
+                if match is None:
+                    # Кодируем сразу во все профили, нужные провайдерам (обычно один)
+                    async with encode_slots:
+                        with stage("encode"):
+                            uploads = await encode_segments(segment.pcm, router.profiles(), f"segment_{segment.start}",
+                                                            segment.sample_rate, segment.channels)
+            finally:
+                # PCM больше не нужен: освобождаем память и место в окне
+                segment.pcm = None
+                if pending is not None:
+                    pending.release()
+                    pending = None
+
+            if match is not None:
+                results = [match]
+            else:
+                with stage("recognize", start=segment.start):
+                    results = await router.recognize_uploads(uploads, usage)
+                # Уверенно распознанный сегмент пополняет локальный индекс
+                top = results[0] if results else None
+                if hashes is not None and top and top.get("title") and top.get("artist") and not top.get("alternative"):
+                    await asyncio.to_thread(fingerprints.add, top, hashes, offsets)
+            await asyncio.to_thread(cache.set, key, results)
+
+        # Привязываем треки к участку файла, где они прозвучали, и к сегменту, который за них голосует
+        return [dict(track, start=segment.start, end=segment.end, segment=segment.index) for track in results]
     except Exception as e:
-        logger.error(f"Ошибка разделения аудио: {str(e)}")
+        logger.error(f"Ошибка анализа сегмента: {str(e)}")
+        if usage is not None:
+            usage["failed"] += 1
+        return []
+    finally:
+        if pending is not None:
+            pending.release()
+
+
+async def recognize_audio_segments(segments, usage: Counter = None, on_track=None, budget: int = None,
+                                   on_progress=None) -> list:
+    """Анализирует сегменты по мере их появления и возвращает уникальные треки
+
+    budget — сколько сегментов (и запросов к API из usage) потратить; когда он набран,
+    чтение segments прекращается (вместе с декодированием и скачиванием файла).
+    on_progress(done, sent) вызывается после каждого распознанного сегмента.
+    """
+    pending = asyncio.Semaphore(MAX_PENDING_SEGMENTS)
+    tasks = []
+    skipped = defaultdict(int)
+    announced = set()
+    previous_music = None
+    total = 0
+    done = 0
+
+    async def recognize(segment) -> list:
+        nonlocal done
+        tracks = await recognize_segment(segment, pending, usage)
+        top = tracks[0] if tracks else None
+        if on_track is not None and top and top.get("title") and top.get("artist") and not top.get("alternative"):
+            key = track_key(top)
+            if key not in announced:
+                announced.add(key)
+                await on_track(top)
+        done += 1
+        if on_progress is not None:
+            await on_progress(done, len(tasks))
+        return tracks
+
+    try:
+        async with aclosing(segments):
+            async for segment in segments:
+                total += 1
+                if SKIP_NON_MUSIC:
+                    features = await asyncio.to_thread(
+                        analyze_segment, segment.pcm, segment.sample_rate, segment.channels
+                    )
+                    kind = classify_segment(features, previous_music)
+                    if kind != "music":
+                        skipped[kind] += 1
+                        logger.debug(f"Сегмент {segment.index} пропущен: {kind}")
+                        continue
+                    previous_music = features
+
+                await pending.acquire()
+                tasks.append(asyncio.create_task(recognize(segment)))
+                if budget and max(len(tasks), usage["api"] if usage is not None else 0) >= budget:
+                    # Останавливаемся сразу, не дожидаясь следующего сегмента из ffmpeg
+                    logger.info(f"Бюджет из {budget} сегментов набран, остаток файла не читается")
+                    break
+    except BaseException:
+        for task in tasks:
+            task.cancel()
         raise
 
+    logger.info(
+        f"Создано {total} сегментов, в API отправлено {len(tasks)}; "
+        f"сэкономлено запросов: {sum(skipped.values())} {dict(skipped)}"
+    )
 
-async def recognize_audio_segments(segment_paths: list) -> list:
-    """Анализирует все сегменты и возвращает уникальные треки"""
-    all_results = []
+    # gather сохраняет порядок сегментов независимо от порядка ответов
+    segment_results = await asyncio.gather(*tasks)
+    with stage("dedupe"):
+        return aggregate_tracks([track for results in segment_results for track in results], RESULT_ORDER)
 
-    for segment_path in segment_paths:
-        try:
-            with open(segment_path, "rb") as f:
-                response = requests.post(
-                    "https://api.audd.io/",
-                    data={
-                        "api_token": AUDD_API_KEY,
-                        "return": "apple_music,spotify",
-                        "include_alternatives": "true"
-                    },
-                    files={"file": f}
-                )
-            data = response.json()
 
-            if data.get("status") == "success":
-                if data.get("result"):
-                    all_results.append(data["result"])
-                if data.get("alternatives"):
-                    all_results.extend(data["alternatives"])
+def window_step(duration: float, budget: int) -> int:
+    """Шаг фиксированных окон, при котором budget окон распределены по всему файлу"""
+    return max(1, math.ceil(duration / (budget * SEGMENT_DURATION))) if duration and budget else 1
 
-        except Exception as e:
-            logger.error(f"Ошибка анализа сегмента: {str(e)}")
 
-    # Удаляем дубликаты (по artist + title)
-    unique_results = []
-    seen = set()
+async def decode_file(source, user_id=None, on_queued=None, file_unique_id: str = None) -> DecodedAudio:
+    """Декодирует файл одним проходом ffmpeg в моно PCM; с file_unique_id — в кэш для повторов"""
+    async with transcode_pool.slot(user_id, on_queued):
+        with stage("decode"):
+            return await decoded.decode(source, file_unique_id)
 
-    for track in all_results:
-        if not track.get("title") or not track.get("artist"):
-            continue
 
-        key = f"{track['artist'].lower()}_{track['title'].lower()}"
-        if key not in seen:
-            seen.add(key)
-            unique_results.append(track)
+async def analyze_file(source, user_id=None, on_queued=None, on_track=None, on_progress=None,
+                       budget: int = MAX_API_CALLS_PER_FILE, usage: Counter = None, duration: float = None) -> list:
+    """Распознаёт файл любой длины пробами в пределах бюджета запросов
 
-    return unique_results
+    source — DecodedAudio; путь, буфер или StreamedFile сначала декодируются
+    (поток — по мере скачивания). Разметка и пробы читают уже декодированный сигнал.
+    on_track(track) вызывается для каждого нового трека сразу, как только он найден;
+    on_progress(done, planned) — после каждой пробы. duration — длительность из
+    сообщения Telegram (для режима stream).
+    """
+    stream = source if isinstance(source, StreamedFile) else None
+    if SEGMENTATION_MODE == "stream":
+        # Окна равномерно по файлу известной длины, иначе подряд с начала
+        every = window_step(duration, budget)
+        if isinstance(source, DecodedAudio):
+            segments = source.segments(SEGMENT_DURATION, every=every)
+        else:
+            segments = split_audio(stream.chunks() if stream else source, user_id, on_queued, None, every)
+        return await recognize_audio_segments(segments, usage, on_track, budget, on_progress)
 
+    if not isinstance(source, DecodedAudio):
+        source = await decode_file(stream.chunks() if stream else source, user_id, on_queued)
 
-async def handle_audio(update: Update, context: CallbackContext) -> None:
-    """Обработка аудиофайлов"""
     try:
-        # Скачиваем файл
-        file = await update.message.audio.get_file()
-        original_path = "original_audio"
-        await file.download_to_drive(original_path)
+        with stage("split"):
+            probes, duration = await plan_probes(
+                source, SEGMENT_DURATION, adaptive=SEGMENTATION_MODE == "adaptive"
+            )
+    except Exception as e:
+        logger.warning(f"Анализ структуры файла не удался, используем фиксированные окна: {str(e)}")
+        segments = source.segments(SEGMENT_DURATION, every=window_step(source.duration, budget))
+        return await recognize_audio_segments(segments, usage, on_track, budget, on_progress)
 
-        # Разбиваем на сегменты
-        segment_paths = split_audio(original_path)
-        logger.info(f"Создано {len(segment_paths)} сегментов для анализа")
+    skipped = defaultdict(int)
+    announced = set()
+    segment_ids = itertools.count()
+    done = 0
 
-        # Анализируем каждый сегмент
-        results = await recognize_audio_segments(segment_paths)
-        logger.info(f"Найдено уникальных треков: {len(results)}")
+    async def recognize_probe(probe) -> list:
+        # Проба — срез декодированного сигнала: ни ffmpeg, ни слота пула.
+        # Сегмент представляет весь регион пробы, а не только прослушанный фрагмент
+        pcm = source.clip(probe.start, probe.duration)
+        segment = Segment(next(segment_ids), probe.region_start, pcm, end=probe.region_end,
+                          sample_rate=source.sample_rate, channels=source.channels)
 
-        if not results:
-            await update.message.reply_text("❌ Совпадений не найдено")
-            return
+        if SKIP_NON_MUSIC:
+            features = await asyncio.to_thread(
+                analyze_segment, pcm, segment.sample_rate, segment.channels
+            )
+            kind = classify_segment(features)
+            if kind != "music":
+                skipped[kind] += 1
+                return []
+
+        return await recognize_segment(segment, usage=usage)
+
+    async def on_result(probe, tracks: list) -> None:
+        nonlocal done
+        done += 1
+
+        # Сообщаем только о главном результате пробы, альтернативы ждут финального списка
+        if tracks and tracks[0].get("title") and tracks[0].get("artist"):
+            key = track_key(tracks[0])
+            if key not in announced and on_track is not None:
+                announced.add(key)
+                await on_track(tracks[0])
+
+        if on_progress is not None:
+            await on_progress(done, scheduler.used)
 
-        # Сохраняем результаты
-        user_data[update.effective_chat.id] = {
-            'tracks': results,
-            'current_index': 0
-        }
+    scheduler = SamplingScheduler(probes, duration, budget,
+                                  spent=(lambda: usage["api"]) if usage is not None else None)
+    results = await scheduler.run(recognize_probe, on_result)
+    logger.info(f"Пропущено проб без музыки: {sum(skipped.values())} {dict(skipped)}")
 
-        # Показываем первый результат
-        await show_track_result(update, context)
+    with stage("dedupe"):
+        return aggregate_tracks([track for _, tracks in results for track in tracks], RESULT_ORDER)
 
+
+def message_media(message):
+    """Аудиофайл, голосовое или видеосообщение из сообщения"""
+    return message.audio or message.voice or message.video_note
+
+
+def is_short_clip(media) -> bool:
+    """Клип целиком укладывается в один запрос к API (по длительности из метаданных Telegram)"""
+    return media.duration is not None and media.duration <= CLIP_MAX_DURATION and \
+        (media.file_size or 0) <= CLIP_MAX_SIZE
+
+
+@inflight.tracked
+async def handle_audio(update: Update, context: CallbackContext) -> None:
+    """Обработка аудио: ответ из кэша, короткий клип — сразу, длинный файл — через очередь заданий"""
+    media = message_media(update.message)
+    clip = is_short_clip(media)
+    with trace("handle_audio", user=update.effective_user.id, file=media.file_unique_id, size=media.file_size,
+               clip=clip), stage("total" if clip else "enqueue"):
+        outcome = await answer_early(update, context, media)
+        if outcome is None:
+            outcome = await process_clip(update, context, media) if clip else await enqueue_file(update, context, media)
+        if outcome is not None:
+            FILES.inc(outcome=outcome)
+
+
+async def answer_early(update: Update, context: CallbackContext, media) -> str:
+    """Размер, лимит частоты и кэш по файлу; исход для метрик или None, если файл нужно распознавать"""
+    try:
+        check_size(media.file_size)
+    except FileTooLargeError:
+        await update.message.reply_text(too_large_text(media.file_size))
+        return "too_large"
+
+    retry_after = await asyncio.to_thread(limiter.check_file, update.effective_user.id)
+    if retry_after:
+        await update.message.reply_text(f"⏳ Слишком много файлов подряд, попробуйте через {math.ceil(retry_after)} с")
+        return "limited"
+
+    results = await asyncio.to_thread(cache.get, file_key(media.file_unique_id))
+    if results is not None:
+        logger.info(f"Результат для файла {media.file_unique_id} взят из кэша ({cache.stats()})")
+        with stage("render"):
+            await show_results(context.bot, update.effective_chat.id, results)
+        return "cached"
+    return None
+
+
+async def process_clip(update: Update, context: CallbackContext, media) -> str:
+    """Короткий клип: один запрос к API прямо в обработчике, обычно без декодирования"""
+    user_id = update.effective_user.id
+    if not await asyncio.to_thread(limiter.reserve, user_id, 1):
+        await update.message.reply_text("⏳ Суточный лимит распознаваний исчерпан, попробуйте завтра")
+        return "limited"
+
+    usage = Counter()
+    try:
+        file = await get_file(context.bot, media.file_id, media.file_size)
+        async with downloaded(file, media.file_size) as source:
+            uploads = await clip_uploads(source, user_id)
+        with stage("recognize"):
+            results = await router.recognize_uploads(uploads, usage)
+    except QueueFullError:
+        logger.warning(f"Очередь переполнена: {transcode_pool.stats()}")
+        await update.message.reply_text("⏳ Бот перегружен, попробуйте отправить файл чуть позже")
+        return "rejected"
     except Exception as e:
-        logger.error(f"Ошибка обработки аудио: {str(e)}")
+        logger.error(f"Ошибка обработки клипа: {str(e)}")
         await update.message.reply_text("⚠️ Ошибка обработки файла")
+        return "error"
+    finally:
+        # Зарезервирован один запрос; merge и хеджирование могут отправить больше
+        await asyncio.to_thread(limiter.refund, user_id, 1 - usage["api"])
+
+    if results:
+        # Пустой ответ может быть ошибкой API, его не кэшируем
+        await asyncio.to_thread(cache.set, file_key(media.file_unique_id), results)
+    with stage("render"):
+        await show_results(context.bot, update.effective_chat.id, results)
+    return "found" if results else "empty"
+
+
+async def clip_uploads(source, user_id=None, passthrough: bool = True) -> dict:
+    """Загрузки для короткого клипа: файл как есть, если провайдеры принимают его контейнер, иначе одно перекодирование"""
+    fmt = sniff_format(source) if is_buffer(source) else None
+    if passthrough and fmt is not None and router.accepts(fmt):
+        extension, content_type = CONTAINERS[fmt]
+        original = (bytes(source), f"clip.{extension}", content_type)
+        return {profile: original for profile in router.profiles()}
+
+    uploads = {}
+    async with transcode_pool.slot(user_id):
+        for profile in router.profiles():
+            with stage("encode", profile=profile, source=fmt or "unknown"):
+                data = await transcode(source, max_duration=CLIP_MAX_DURATION, profile=profile)
+            uploads[profile] = (data, get_profile(profile).filename("clip"), get_profile(profile).content_type)
+    return uploads
+
+
+async def enqueue_file(update: Update, context: CallbackContext, media) -> str:
+    """Ставит файл в очередь заданий; исход для метрик появится, когда воркер его обработает"""
+    chat_id = update.effective_chat.id
+    # Ключ задания — сообщение: повторная доставка того же обновления не создаёт второе задание
+    key = f"{chat_id}:{update.message.message_id}"
+    if await asyncio.to_thread(jobs.find, key) is not None:
+        return None
+    status = await update.message.reply_text("⏳ Файл в очереди на распознавание...")
+    await asyncio.to_thread(jobs.enqueue, key, {
+        'chat_id': chat_id,
+        'user_id': update.effective_user.id,
+        'file_id': media.file_id,
+        'file_unique_id': media.file_unique_id,
+        'file_size': media.file_size,
+        'duration': media.duration,
+        'status_message_id': status.message_id,
+    })
+    if worker is not None:
+        worker.notify()
+    return None
+
+
+async def run_job(bot, job) -> None:
+    """Выполняет задание из очереди; исключение — повод для повтора"""
+    payload = job.payload
+    with trace("job", job=job.id, attempt=job.attempts, user=payload['user_id'],
+               file=payload['file_unique_id'], size=payload['file_size']), stage("total"):
+        try:
+            outcome = await process_file(bot, job)
+        except RetryLater:
+            raise
+        except Exception:
+            FILES.inc(outcome="error")
+            raise
+        FILES.inc(outcome=outcome)
+
+
+async def process_file(bot, job) -> str:
+    """Распознаёт файл задания и отправляет результат в чат; возвращает исход для метрик"""
+    payload = job.payload
+    chat_id = payload['chat_id']
+    status = LiveStatus(bot, chat_id)
+    status.attach(payload['status_message_id'])
+
+    results = await asyncio.to_thread(cache.get, file_key(payload['file_unique_id']))
+    if results is None:
+        status.update("⏳ Скачиваю файл..." if job.attempts == 1 else f"⏳ Повторная попытка ({job.attempts})...")
+        try:
+            results = await recognize_file(bot, job, status)
+        except FileTooLargeError as e:
+            await status.finish(too_large_text(e.size))
+            return "too_large"
+        if results is None:
+            return "limited"
+
+    # Результат отправляется один раз, даже если задание выполнялось повторно
+    if not await asyncio.to_thread(jobs.mark_delivered, job):
+        return "found" if results else "empty"
+    try:
+        with stage("render"):
+            if not results:
+                await status.finish("❌ Совпадений не найдено")
+                return "empty"
+            await status.finish(f"✅ Готово, найдено треков: {len(results)}")
+            if job.state.get('card') is None:
+                await show_results(bot, chat_id, results)
+            else:
+                await refresh_card(bot, chat_id, job.state['card'], results)
+        return "found"
+    except BaseException:
+        await asyncio.to_thread(jobs.unmark_delivered, job)
+        raise
+
 
+async def recognize_file(bot, job, status: LiveStatus) -> list:
+    """Скачивает и анализирует файл задания; None — суточный бюджет исчерпан"""
+    payload = job.payload
+    chat_id = payload['chat_id']
+    user_id = payload['user_id']
+    found = []
+
+    async def notify_queued(position: int) -> None:
+        status.update(f"⏳ Сейчас много запросов, вы #{position} в очереди")
+
+    async def update_card() -> None:
+        card = await current_card(chat_id)
+        if card is not None:
+            await edit_card(bot, chat_id, job.state['card'], card)
+
+    # Счётчик и кнопки карточки догоняют новые треки не чаще, чем позволяет интервал правок
+    card_refresh = ThrottledEdit(update_card)
+
+    # Пробы волны заканчиваются одновременно: сессию и первую карточку создаёт только первый трек
+    card_lock = asyncio.Lock()
+    started = job.state.get('card') is not None  # Повтор задания дополняет сессию прошлой попытки
+
+    async def on_track(track: dict) -> None:
+        nonlocal started
+        found.append(track)
+        record = TrackRecord.from_dict(track)
+        async with card_lock:
+            if not started:
+                started = True
+                # Карточка с навигацией появляется с первым треком и работает, пока идёт анализ
+                await asyncio.to_thread(
+                    sessions.set, chat_id, {'tracks': [record], 'current_index': 0, 'version': new_version()}
+                )
+                with stage("render"):
+                    card = await send_track_card(bot, chat_id)
+                if card is not None:
+                    # Повтор задания продолжит обновлять эту же карточку, а не пришлёт новую
+                    job.state['card'] = card.message_id
+                    await asyncio.to_thread(jobs.save_state, job)
+                return
+
+            data = await asyncio.to_thread(sessions.get, chat_id)
+            data = data or {'tracks': [], 'current_index': 0, 'version': new_version()}
+            if record.key not in {track.key for track in data['tracks']}:
+                data['tracks'].append(record)
+                await asyncio.to_thread(sessions.set, chat_id, data)
+                if job.state.get('card') is not None:
+                    card_refresh.request()
+
+    async def on_progress(done: int, planned: int) -> None:
+        status.update(f"🔎 Проба {done}/{planned}, найдено треков: {len(found)}")
+
+    # Бюджет файла резервируется заранее: при тающем суточном остатке проб будет меньше
+    budget = await asyncio.to_thread(limiter.reserve, user_id, MAX_API_CALLS_PER_FILE)
+    if not budget:
+        await status.finish("⏳ Суточный лимит распознаваний исчерпан, попробуйте завтра")
+        return None
+    usage = Counter()
+
+    try:
+        if SEGMENTATION_MODE == "stream":
+            file = await get_file(bot, payload['file_id'], payload['file_size'])
+            async with streamed(file, payload['file_size']) as source:
+                status.update("🔎 Распознаю по мере загрузки...")
+                results = await analyze_file(source, user_id, notify_queued, on_track, on_progress, budget, usage,
+                                             payload.get('duration'))
+        else:
+            # Повтор задания берёт декодированный сигнал из кэша, не скачивая файл снова
+            audio = decoded.get(payload['file_unique_id'])
+            if audio is None:
+                audio = await download_audio(bot, payload, notify_queued)
+            status.update("🔎 Ищу границы треков...")
+            # Пробы распознаются волнами, найденные треки показываются сразу
+            results = await analyze_file(audio, user_id, notify_queued, on_track, on_progress, budget, usage)
+    except QueueFullError:
+        logger.warning(f"Очередь перекодирования переполнена: {transcode_pool.stats()}")
+        status.update("⏳ Бот перегружен, файл будет обработан чуть позже")
+        raise RetryLater(QUEUE_FULL_RETRY_DELAY)
     finally:
-        # Очистка временных файлов
-        if 'original_path' in locals() and os.path.exists(original_path):
-            try:
-                os.remove(original_path)
-            except Exception as e:
-                logger.warning(f"Ошибка удаления файла: {str(e)}")
+        # Итоговую карточку выставит run_job
+        card_refresh.cancel()
+        # Пробы, закрытые кэшем, отпечатками или фильтром тишины, бюджет не тратят
+        await asyncio.to_thread(limiter.refund, user_id, budget - usage["api"])
+    logger.info(
+        f"Найдено уникальных треков: {len(results)}; кэш: {cache.stats()}; "
+        f"отпечатки: {fingerprints.stats()}; провайдеры: {router.stats()}"
+    )
+    if usage["failed"]:
+        # Неполный результат не кэшируем: повторная отправка файла распознает его заново
+        logger.warning(f"Сегментов с ошибкой: {usage['failed']}, результат файла не кэшируется")
+    else:
+        await asyncio.to_thread(cache.set, file_key(payload['file_unique_id']), results)
+    return results
 
 
-async def show_track_result(update: Update, context: CallbackContext, is_callback: bool = False):
-    """Показывает текущий трек с кнопками навигации"""
-    chat_id = update.effective_chat.id
-    data = user_data.get(chat_id, {})
+async def download_audio(bot, payload: dict, on_queued=None) -> DecodedAudio:
+    """Скачивает файл задания и по мере скачивания декодирует его в кэш PCM"""
+    file = await get_file(bot, payload['file_id'], payload['file_size'])
+    async with streamed(file, payload['file_size']) as source:
+        return await decode_file(source.chunks() if isinstance(source, StreamedFile) else source,
+                                 payload['user_id'], on_queued, payload['file_unique_id'])
 
-    if not data or not data.get('tracks'):
-        if not is_callback:
-            await update.message.reply_text("❌ Результаты не найдены")
-        return
 
-    tracks = data['tracks']
-    current_index = data['current_index']
-    total = len(tracks)
+async def notify_failed(bot, job) -> None:
+    """Задание ушло в dead-letter — сообщаем пользователю один раз"""
+    if await asyncio.to_thread(jobs.mark_delivered, job):
+        await bot.edit_message_text(
+            "⚠️ Ошибка обработки файла",
+            chat_id=job.payload['chat_id'], message_id=job.payload['status_message_id']
+        )
+
+
+async def refresh_card(bot, chat_id: int, card_id: int, results: list) -> None:
+    """Заменяет промежуточный список итоговым, сохраняя трек, который сейчас открыт"""
+    data = await asyncio.to_thread(sessions.get, chat_id) or {}
+    current = data.get('tracks', [])[data.get('current_index', 0):][:1]
+    tracks = [TrackRecord.from_dict(track) for track in results]
+    keys = [track.key for track in tracks]
+    index = keys.index(current[0].key) if current and current[0].key in keys else 0
+
+    data = {'tracks': tracks, 'current_index': index, 'version': new_version()}
+    await asyncio.to_thread(sessions.set, chat_id, data)
+    try:
+        await edit_card(bot, chat_id, card_id, renders.card(chat_id, data))
+    except Exception as e:
+        logger.debug(f"Карточка не обновлена: {str(e)}")
+
 
-    if current_index >= total:
-        await context.bot.send_message(chat_id, "🎉 Это все найденные треки!")
+async def show_results(bot, chat_id: int, results: list) -> None:
+    """Сохраняет результаты в сессию и показывает первый трек"""
+    if not results:
+        await bot.send_message(chat_id, "❌ Совпадений не найдено")
         return
 
-    track = tracks[current_index]
-    message = format_track_info(track, current_index + 1, total)
-    keyboard = create_navigation_keyboard(current_index, total)
+    # Сохраняем в сессию только компактные записи
+    await asyncio.to_thread(sessions.set, chat_id, {
+        'tracks': [TrackRecord.from_dict(track) for track in results],
+        'current_index': 0,
+        'version': new_version(),
+    })
+
+    # Показываем первый результат
+    await send_track_card(bot, chat_id)
+
+
+async def current_card(chat_id: int, data: dict = None):
+    """Текст и клавиатура карточки текущего трека сессии; None — показывать нечего"""
+    data = data if data is not None else await asyncio.to_thread(sessions.view, chat_id)
+    if not data or not data.get('tracks') or data['current_index'] >= len(data['tracks']):
+        return None
+    return renders.card(chat_id, data)
+
+
+async def send_track_card(bot, chat_id: int):
+    """Отправляет карточку текущего трека с кнопками навигации"""
+    card = await current_card(chat_id)
+    if card is None:
+        return None
+    message, keyboard = card
+    sent = await bot.send_message(
+        chat_id=chat_id,
+        text=message,
+        reply_markup=keyboard,
+        disable_web_page_preview=True
+    )
+    renders.unchanged(chat_id, sent.message_id, card)
+    return sent
 
-    if is_callback:
-        await update.callback_query.edit_message_text(
-            text=message,
-            reply_markup=keyboard,
-            disable_web_page_preview=True
-        )
-    else:
-        await context.bot.send_message(
+
+async def edit_card(bot, chat_id: int, message_id: int, card: tuple) -> None:
+    """Правит сообщение, только если его содержимое действительно меняется"""
+    if renders.unchanged(chat_id, message_id, card):
+        return
+    message, keyboard = card
+    try:
+        await bot.edit_message_text(
             chat_id=chat_id,
+            message_id=message_id,
             text=message,
             reply_markup=keyboard,
             disable_web_page_preview=True
         )
+    except Exception:
+        renders.forget(chat_id, message_id)
+        raise
+
+
+async def show_track_result(update: Update, context: CallbackContext, data: dict = None) -> None:
+    """Показывает текущий трек в сообщении, на кнопке которого нажали"""
+    chat_id = update.effective_chat.id
+    card = await current_card(chat_id, data)
+    if card is not None:
+        await edit_card(context.bot, chat_id, update.callback_query.message.message_id, card)
+
+
+async def show_track_list(update: Update, context: CallbackContext, data: dict, page: int = None) -> None:
+    """Список всех треков по страницам: новое сообщение или листание уже показанного"""
+    chat_id = update.effective_chat.id
+    pages = renders.pages(chat_id, data, "📋 Найденные треки:\n\n")
+    if page is None:
+        sent = await context.bot.send_message(chat_id, pages[0], reply_markup=page_keyboard(0, len(pages)),
+                                              disable_web_page_preview=True)
+        renders.unchanged(chat_id, sent.message_id, (pages[0], page_keyboard(0, len(pages))))
+        return
+    page = min(page, len(pages) - 1)
+    await edit_card(context.bot, chat_id, update.callback_query.message.message_id,
+                    (pages[page], page_keyboard(page, len(pages))))
+
 
+def format_time(seconds: float) -> str:
+    """Форматирует смещение в файле как [Ч:]ММ:СС"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
 
-def format_track_info(track: dict, position: int, total: int) -> str:
+
+def format_track_info(track: TrackRecord, position: int, total: int) -> str:
     """Форматирует информацию о треке"""
     info = [f"🔍 Трек {position} из {total}:"]
 
-    if track.get('title'):
-        info.append(f"🎵 Название: {track['title']}")
-    if track.get('artist'):
-        info.append(f"🎤 Исполнитель: {track['artist']}")
-    if track.get('album'):
-        info.append(f"💿 Альбом: {track['album']}")
-    if track.get('release_date'):
-        info.append(f"📅 Дата выхода: {track['release_date']}")
-    if track.get('score'):
-        info.append(f"🔢 Точность: {track['score']:.0f}%")
+    if track.title:
+        info.append(f"🎵 Название: {track.title}")
+    if track.artist:
+        info.append(f"🎤 Исполнитель: {track.artist}")
+    if track.album:
+        info.append(f"💿 Альбом: {track.album}")
+    if track.release_date:
+        info.append(f"📅 Дата выхода: {track.release_date}")
+    if track.score:
+        info.append(f"🔢 Точность: {float(track.score):.0f}%")
+    if track.start is not None:
+        info.append(f"⏱ Звучит: {format_time(track.start)}–{format_time(track.end)}")
+    if track.votes and track.votes > 1:
+        info.append(f"🗳 Совпадений по фрагментам: {track.votes}")
 
     # Ссылки
-    spotify_url = track.get('spotify', {}).get('external_urls', {}).get('spotify')
-    if spotify_url:
-        info.append(f"🔗 Spotify: {spotify_url}")
-
-    apple_music_url = track.get('apple_music', {}).get('url')
-    if apple_music_url:
-        info.append(f"🔗 Apple Music: {apple_music_url}")
+    if track.spotify_url:
+        info.append(f"🔗 Spotify: {track.spotify_url}")
+    if track.apple_music_url:
+        info.append(f"🔗 Apple Music: {track.apple_music_url}")
 
     return "\n".join(info)
 
 
+def format_track_entry(track: TrackRecord, index: int) -> str:
+    """Строка трека в общем списке"""
+    line = f"{index + 1}. {track.artist or '?'} — {track.title or '?'}"
+    if track.start is not None:
+        line += f" ({format_time(track.start)}–{format_time(track.end)})"
+    return line
+
+
 def create_navigation_keyboard(current_index: int, total: int) -> InlineKeyboardMarkup:
     """Создает клавиатуру навигации"""
     buttons = []
@@ -220,39 +758,160 @@ def create_navigation_keyboard(current_index: int, total: int) -> InlineKeyboard
     if current_index < total - 1:
         buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data="next_track"))
 
-    return InlineKeyboardMarkup([buttons]) if buttons else None
+    rows = [buttons]
+    if total > 1:
+        rows.append([InlineKeyboardButton("📋 Все треки", callback_data="show_all")])
+    return InlineKeyboardMarkup(rows)
+
+
+def render_card(tracks: list, index: int) -> tuple:
+    return format_track_info(tracks[index], index + 1, len(tracks)), create_navigation_keyboard(index, len(tracks))
+
+
+# Карточки форматируются один раз на набор результатов; нажатие кнопки берёт готовую
+renders = RenderCache(render_card, format_track_entry)
+register_metrics(renders)
 
 
 async def button_callback(update: Update, context: CallbackContext) -> None:
     """Обработка нажатий кнопок"""
     query = update.callback_query
     await query.answer()
+    if query.data in ("position", "page_position"):
+        return  # Счётчики только показывают номер
 
     chat_id = update.effective_chat.id
-    data = user_data.get(chat_id, {})
+    # Список треков не разбирается: карточки берутся из кэша рендеринга
+    data = await asyncio.to_thread(sessions.view, chat_id)
 
-    if not data:
+    if not data or not data.get('tracks'):
         return
 
-    current_index = data['current_index']
+    with stage("render"):
+        if query.data == "show_all":
+            await show_track_list(update, context, data)
+            return
+        if query.data.startswith("page:"):
+            await show_track_list(update, context, data, int(query.data.split(":", 1)[1]))
+            return
+
+        current_index = data['current_index']
+        if query.data == "prev_track" and current_index > 0:
+            current_index -= 1
+        elif query.data == "next_track" and current_index < len(data['tracks']) - 1:
+            current_index += 1
+        if current_index != data['current_index']:
+            # Меняется только индекс — список треков не перезаписывается
+            data['current_index'] = current_index
+            await asyncio.to_thread(sessions.set_index, chat_id, current_index)
+        await show_track_result(update, context, data)
+
+
+def start_workers(bot, concurrency: int = JOB_CONCURRENCY) -> JobWorker:
+    """Запускает выполнение заданий очереди в этом процессе"""
+    global worker
+    worker = JobWorker(jobs, functools.partial(run_job, bot), concurrency,
+                       on_dead=functools.partial(notify_failed, bot))
+    worker.start()
+    return worker
+
+
+async def on_startup(application: Application) -> None:
+    """Поднимает локальный /metrics и воркер заданий"""
+    application.bot_data['metrics_server'] = await start_metrics_server()
+    if JOB_CONCURRENCY:
+        start_workers(application.bot)
+
+
+async def on_stop(application: Application) -> None:
+    """Останавливает воркер, пока бот ещё может отправлять сообщения; незавершённые задания вернутся в очередь"""
+    if worker is not None:
+        await worker.stop()
+
+
+async def on_shutdown(application: Application) -> None:
+    """Закрывает общий HTTP-пул, сервер метрик и сохраняет индекс отпечатков при остановке"""
+    await close_session()
+    await asyncio.to_thread(fingerprints.flush)
+    if application.bot_data.get('metrics_server') is not None:
+        await application.bot_data['metrics_server'].cleanup()
+    close_trace()
+
+
+async def worker_main(number: int) -> None:
+    """Процесс-воркер: только выполняет задания очереди, обновления Telegram не получает"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async with Bot(TELEGRAM_TOKEN, **bot_api_options()) as bot:
+        # У каждого процесса свой /metrics на следующем порту
+        metrics_server = await start_metrics_server(port=METRICS_PORT + number if METRICS_PORT else 0)
+        start_workers(bot, max(JOB_CONCURRENCY, 1))
+        logger.info(f"Воркер {number} запущен")
+        try:
+            await stop.wait()
+        finally:
+            await worker.stop()
+            await close_session()
+            await asyncio.to_thread(fingerprints.flush)
+            if metrics_server is not None:
+                await metrics_server.cleanup()
+            close_trace()
+
 
-    if query.data == "prev_track" and current_index > 0:
-        user_data[chat_id]['current_index'] -= 1
-    elif query.data == "next_track" and current_index < len(data['tracks']) - 1:
-        user_data[chat_id]['current_index'] += 1
+def bot_api_options() -> dict:
+    """Адрес Bot API для Bot и Application.builder: облачный по умолчанию или локальный сервер"""
+    if not BOT_API_URL:
+        return {}
+    url = BOT_API_URL.rstrip("/")
+    return {"base_url": f"{url}/bot", "base_file_url": f"{url}/file/bot", "local_mode": BOT_API_LOCAL_MODE}
 
-    await show_track_result(update, context, is_callback=True)
+
+def run_worker(number: int = 1) -> None:
+    asyncio.run(worker_main(number))
 
 
 def main() -> None:
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    if sys.argv[1:2] == ["worker"]:
+        run_worker(int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+        return
+
+    # Воркеры — отдельные процессы со своими ffmpeg и пулом перекодирования; задания берут из общей очереди
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(number,), name=f"worker-{number}")
+               for number in range(1, WORKER_PROCESSES + 1)]
+    for process in workers:
+        process.start()
+
+    # concurrent_updates: длинное распознавание одного пользователя не задерживает остальных
+    builder = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True)
+    options = bot_api_options()
+    if options:
+        builder = builder.base_url(options["base_url"]).base_file_url(options["base_file_url"]) \
+            .local_mode(options["local_mode"])
+    application = builder.post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build()
 
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.AUDIO, handle_audio))
+    application.add_handler(MessageHandler(filters.AUDIO | filters.VOICE | filters.VIDEO_NOTE, handle_audio))
     application.add_handler(CallbackQueryHandler(button_callback))
 
-    logger.info("Бот запущен")
-    application.run_polling()
+    try:
+        if WEBHOOK_URL:
+            logger.info("Бот запущен (webhook)")
+            asyncio.run(run_webhook(application))
+        else:
+            logger.info("Бот запущен")
+            application.run_polling()
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
 
 
 if __name__ == "__main__":
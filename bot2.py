@@ -1,19 +1,27 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackContext, CallbackQueryHandler, filters
-from pydub import AudioSegment
+import html
 import logging
 import os
-import aiohttp
-import time
-import base64
-import hmac
-import hashlib
 import asyncio
-import json
-from aiohttp import FormData
-
-# THAT'S THE VERSION FOR ACRCloud but i don't know if it's working properly, also in this version u will never get multiple results, cause i didn't implement it, it's just an example of how u can use ACRCloud API, also here is a bug
-# if u try to put different MAX_DURATION u will get different results, in the version for AUDd i made a segmentation of the audio file so u can get multiple results.
+import math
+from collections import Counter
+import audio_stream
+from audio_stream import CONTAINERS, transcode, get_profile, is_buffer, sniff_format
+from transcode_pool import pool as transcode_pool, QueueFullError
+from result_cache import cache, file_key
+from session_store import TrackRecord, create_store
+from webhook import WEBHOOK_URL, inflight, run_webhook
+from recognition import close_session
+from providers import AudDProvider, ACRCloudProvider, ProviderRouter
+from downloads import FileTooLargeError, check_size, downloaded, get_file, too_large_text
+from metrics import FILES, stage, trace, start_metrics_server, close_trace
+from rate_limit import create_limiter
+from rendering import RenderCache, new_version, page_keyboard, register_metrics, truncate_html
+
+# THAT'S THE VERSION FOR ACRCloud (AudD is an optional fallback through the same provider router). ACRCloud returns up to 5 candidates
+# for the clip (multi=5), so u can get several results, but only the first MAX_DURATION * 3 seconds of the file are recognized: there is no
+# segmentation here, so a different MAX_DURATION gives different results. For whole files with many tracks use bot.py, it splits the file.
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,94 +34,62 @@ logger = logging.getLogger(__name__)
 ACR_ACCESS_KEY = "your access key"
 ACR_SECRET_KEY = "your secret key"
 ACR_HOST = "your host"
+AUDD_API_KEY = ""  # Необязательный второй провайдер (AudD); пусто — только ACRCloud
+RECOGNITION_STRATEGY = "hedged"  # primary, fastest, merge или hedged
+# Формат перекодирования для каждого провайдера: mp3_mono_16k, opus_mono_16k, wav_mono_16k или mp3_stereo
+ACR_UPLOAD_PROFILE = "mp3_mono_16k"
+AUDD_UPLOAD_PROFILE = "mp3_mono_16k"
 TELEGRAM_TOKEN = "your token"
 FFMPEG_PATH = r"your ffmpeg path"
 MAX_DURATION = 30  # Оптимальное время для анализа
+SESSION_BACKEND = "sqlite"  # memory — LRU в памяти процесса, sqlite — переживает перезапуск
+RATE_LIMIT_BACKEND = "sqlite"  # memory — в процессе, sqlite — общий для нескольких процессов (лимиты в rate_limit.py)
 
-AudioSegment.converter = FFMPEG_PATH
-user_data = {}
-
-
-def get_acrcloud_signature():
-    """Генерация подписи для ACRCloud API"""
-    timestamp = str(int(time.time()))
-    string_to_sign = f"POST\n/v1/identify\n{ACR_ACCESS_KEY}\n{timestamp}"
-    signature = base64.b64encode(
-        hmac.new(ACR_SECRET_KEY.encode(), string_to_sign.encode(), hashlib.sha1).digest()
-    ).decode()
-    return timestamp, signature
+audio_stream.FFMPEG_PATH = FFMPEG_PATH
+sessions = create_store(SESSION_BACKEND)
+limiter = create_limiter(RATE_LIMIT_BACKEND)
+router = ProviderRouter([
+    ACRCloudProvider(ACR_ACCESS_KEY, ACR_SECRET_KEY, ACR_HOST, encoding=ACR_UPLOAD_PROFILE),
+    AudDProvider(AUDD_API_KEY, encoding=AUDD_UPLOAD_PROFILE) if AUDD_API_KEY else None,
+], RECOGNITION_STRATEGY)
 
 
-async def process_audio(input_path: str) -> str:
-    """Обработка аудиофайлов с минимальной конвертацией"""
+async def process_audio(source, duration: float = None, user_id=None, on_queued=None) -> dict:
+    """Обработка аудио с минимальной конвертацией; возвращает {профиль: (данные, имя файла, content-type)}"""
     try:
-        ext = os.path.splitext(input_path)[1].lower()
-        if ext in ['.mp3', '.ogg', '.wav']:
-            logger.info(f"Используется оригинальный формат: {ext}")
-            return input_path
-
-        output_path = f"temp_{int(time.time())}.mp3"
-        audio = AudioSegment.from_file(input_path)
-        audio = audio[:MAX_DURATION * 3000]
-        audio.export(output_path, format="mp3")
-        return output_path
+        # Формат определяется по содержимому: у голосовых сообщений расширения в file_path может не быть
+        fmt = sniff_format(source) if is_buffer(source) else None
+        if fmt is not None and router.accepts(fmt) and duration is not None and duration <= MAX_DURATION * 3:
+            logger.info(f"Используется оригинальный формат: {fmt}")
+            extension, content_type = CONTAINERS[fmt]
+            original = (bytes(source), f"sample.{extension}", content_type)
+            return {profile: original for profile in router.profiles()}
+
+        uploads = {}
+        async with transcode_pool.slot(user_id, on_queued):
+            # Каждому провайдеру — свой формат; обычно профиль один и перекодирование тоже одно
+            for profile in router.profiles():
+                with stage("encode", profile=profile):
+                    data = await transcode(source, max_duration=MAX_DURATION * 3, profile=profile)
+                uploads[profile] = (data, get_profile(profile).filename("sample"), get_profile(profile).content_type)
+        return uploads
+    except QueueFullError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка обработки аудио: {str(e)}")
         raise
 
 
-async def recognize_audio(file_path: str) -> list:
-    """Запрос к ACRCloud API"""
+async def recognize_audio(uploads: dict, usage: Counter = None) -> list:
+    """Распознавание через настроенных провайдеров; usage["api"] — сколько запросов ушло"""
     try:
-        timestamp, signature = get_acrcloud_signature()
-        url = f"https://{ACR_HOST}/v1/identify"
-
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15)) as session:
-            data = FormData()
-            content_type = "audio/mpeg" if file_path.endswith('.mp3') else "audio/ogg"
-
-            with open(file_path, 'rb') as f:
-                data.add_field(
-                    'sample',
-                    f,
-                    filename=os.path.basename(file_path),
-                    content_type=content_type
-                )
-                data.add_field('multi', '5')
-
-                response = await session.post(
-                    url,
-                    headers={
-                        "Authorization": f"ACR {ACR_ACCESS_KEY}:{signature}",
-                        "Date": timestamp
-                    },
-                    data=data
-                )
-
-                logger.info(f"Статус ответа: {response.status}")
-                raw_response = await response.text()
-                logger.debug(f"Сырой ответ: {raw_response}")
-
-                try:
-                    result = json.loads(raw_response)
-                except Exception as e:
-                    logger.error(f"Ошибка парсинга JSON: {str(e)}")
-                    return []
-
-        if result.get("status", {}).get("code") != 0:
-            logger.error(f"Ошибка API: {result.get('status', {}).get('msg', 'Неизвестная ошибка')}")
-            return []
-
-        return result.get("metadata", {}).get("music", [])
+        with stage("recognize"):
+            results = await router.recognize_uploads(uploads, usage)
+        logger.info(f"Найдено треков: {len(results)}; провайдеры: {router.stats()}")
+        return results
     except Exception as e:
         logger.error(f"Ошибка запроса: {str(e)}", exc_info=True)
         return []
-    finally:
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                logger.warning(f"Ошибка удаления файла: {str(e)}")
 
 
 async def start(update: Update, context: CallbackContext) -> None:
@@ -125,68 +101,107 @@ async def start(update: Update, context: CallbackContext) -> None:
     )
 
 
+@inflight.tracked
 async def handle_audio(update: Update, context: CallbackContext) -> None:
     """Обработка входящих аудио сообщений"""
+    with trace("handle_audio", user=update.effective_user.id), stage("total"):
+        FILES.inc(outcome=await process_message(update, context))
+
+
+async def process_message(update: Update, context: CallbackContext) -> str:
+    """Распознаёт аудио из сообщения; возвращает исход для метрик"""
     try:
         logger.info(f"Получен аудиофайл от пользователя {update.effective_user.id}")
 
-        if update.message.audio:
-            file = await update.message.audio.get_file()
-        elif update.message.voice:
-            file = await update.message.voice.get_file()
-        else:
+        media = update.message.audio or update.message.voice or update.message.video_note
+        if not media:
             await update.message.reply_text("⚠️ Пожалуйста, отправьте аудиофайл или голосовое сообщение")
-            return
+            return "invalid"
 
-        original_path = f"temp_{int(time.time())}_{update.update_id}"
-        await file.download_to_drive(custom_path=original_path)
+        check_size(media.file_size)
 
-        processed_path = await process_audio(original_path)
-        results = await recognize_audio(processed_path)
+        retry_after = await asyncio.to_thread(limiter.check_file, update.effective_user.id)
+        if retry_after:
+            await update.message.reply_text(f"⏳ Слишком много файлов подряд, попробуйте через {math.ceil(retry_after)} с")
+            return "limited"
+
+        results = await asyncio.to_thread(cache.get, file_key(media.file_unique_id))
+        outcome = "cached" if results else "found"
+        if results:
+            logger.info(f"Результат для файла {media.file_unique_id} взят из кэша ({cache.stats()})")
+        else:
+            # Один файл — один запрос к API из суточного бюджета
+            if not await asyncio.to_thread(limiter.reserve, update.effective_user.id, 1):
+                await update.message.reply_text("⏳ Суточный лимит распознаваний исчерпан, попробуйте завтра")
+                return "limited"
+            usage = Counter()
+            try:
+                results = await download_and_recognize(update, media, usage)
+            finally:
+                # Зарезервирован один запрос; стратегия merge может отправить больше
+                await asyncio.to_thread(limiter.refund, update.effective_user.id, 1 - usage["api"])
+            if results:
+                # Пустой ответ может быть ошибкой API, его не кэшируем
+                await asyncio.to_thread(cache.set, file_key(media.file_unique_id), results)
 
         if not results:
             await update.message.reply_text("❌ Совпадений не найдено")
-            return
-
-        user_data[update.effective_chat.id] = {
-            'tracks': results,
-            'current_index': 0
-        }
-        await show_next_result(update, context)
-
+            return "empty"
+
+        await asyncio.to_thread(sessions.set, update.effective_chat.id, {
+            'tracks': [TrackRecord.from_dict(track) for track in results],
+            'current_index': 0,
+            'version': new_version()
+        })
+        with stage("render"):
+            await show_next_result(update, context)
+        return outcome
+
+    except FileTooLargeError as e:
+        await update.message.reply_text(too_large_text(e.size))
+        return "too_large"
+    except QueueFullError:
+        logger.warning(f"Очередь переполнена: {transcode_pool.stats()}")
+        await update.message.reply_text("⏳ Бот перегружен, попробуйте отправить файл чуть позже")
+        return "rejected"
     except Exception as e:
         logger.error(f"Критическая ошибка: {str(e)}", exc_info=True)
         await update.message.reply_text("⚠️ Произошла ошибка при обработке файла")
-    finally:
-        if os.path.exists(original_path):
-            try:
-                os.remove(original_path)
-            except Exception as e:
-                logger.warning(f"Ошибка очистки: {str(e)}")
+        return "error"
+
+
+async def download_and_recognize(update: Update, media, usage: Counter = None) -> list:
+    """Скачивание, подготовка и распознавание файла без промежуточных файлов на диске"""
+    file = await get_file(update.get_bot(), media.file_id, media.file_size)
 
+    async def notify_queued(position: int) -> None:
+        await update.message.reply_text(f"⏳ Сейчас много запросов, вы #{position} в очереди")
 
-def format_track_info(track: dict) -> str:
+    async with downloaded(file, media.file_size) as source:
+        uploads = await process_audio(source, media.duration, update.effective_user.id, notify_queued)
+    return await recognize_audio(uploads, usage)
+
+
+def format_track_info(track: TrackRecord) -> str:
     """Форматирование информации о треке"""
     info = []
-    title = track.get('title', 'Неизвестно')
-    artists = ', '.join([a.get('name', '') for a in track.get('artists', [])]) or 'Неизвестен'
+    # Метаданные приходят от провайдеров как есть: без экранирования «<» или «&» ломают HTML-разметку
+    escape = html.escape
 
-    info.append(f"🎵 <b>Название:</b> {title}")
-    info.append(f"🎤 <b>Исполнитель:</b> {artists}")
+    info.append(f"🎵 <b>Название:</b> {escape(track.title or 'Неизвестно')}")
+    info.append(f"🎤 <b>Исполнитель:</b> {escape(track.artist or 'Неизвестен')}")
 
-    if track.get('album'):
-        info.append(f"💿 <b>Альбом:</b> {track['album'].get('name', 'Неизвестен')}")
+    if track.album:
+        info.append(f"💿 <b>Альбом:</b> {escape(track.album)}")
 
-    if track.get('release_date'):
-        info.append(f"📅 <b>Год выпуска:</b> {track['release_date']}")
+    if track.release_date:
+        info.append(f"📅 <b>Год выпуска:</b> {escape(str(track.release_date))}")
 
-    if track.get('external_metadata', {}).get('spotify', {}).get('track', {}).get('id'):
-        spotify_id = track['external_metadata']['spotify']['track']['id']
-        info.append(f"🔗 <a href='https://open.spotify.com/track/{spotify_id}'>Слушать в Spotify</a>")
+    if track.spotify_url:
+        info.append(f"🔗 <a href='{escape(track.spotify_url)}'>Слушать в Spotify</a>")
 
-    if track.get('external_metadata', {}).get('youtube', {}).get('vid'):
-        youtube_id = track['external_metadata']['youtube']['vid']
-        info.append(f"📺 <a href='https://youtu.be/{youtube_id}'>Смотреть на YouTube</a>")
+    if track.youtube_url:
+        info.append(f"📺 <a href='{escape(track.youtube_url)}'>Смотреть на YouTube</a>")
 
     return "\n".join(info)
 
@@ -210,10 +225,23 @@ def create_keyboard(current_index: int, total: int) -> InlineKeyboardMarkup:
     ])
 
 
+def render_card(tracks: list, index: int) -> tuple:
+    return format_track_info(tracks[index]), create_keyboard(index, len(tracks))
+
+
+def render_entry(track: TrackRecord, index: int) -> str:
+    return f"{index + 1}. {format_track_info(track)}"
+
+
+# Карточки и страницы списка рендерятся один раз на набор результатов
+renders = RenderCache(render_card, render_entry, truncate=truncate_html)
+register_metrics(renders)
+
+
 async def show_next_result(update: Update, context: CallbackContext, is_callback: bool = False):
     """Отображение следующего результата"""
     chat_id = update.effective_chat.id
-    data = user_data.get(chat_id)
+    data = await asyncio.to_thread(sessions.view, chat_id)
 
     if not data or not data.get('tracks'):
         await context.bot.send_message(chat_id, "❌ Нет активных результатов")
@@ -226,9 +254,7 @@ async def show_next_result(update: Update, context: CallbackContext, is_callback
         await context.bot.send_message(chat_id, "🎉 Вы просмотрели все результаты!")
         return
 
-    track = tracks[current_index]
-    message = format_track_info(track)
-    keyboard = create_keyboard(current_index, len(tracks))
+    message, keyboard = renders.card(chat_id, data, current_index)
 
     try:
         if is_callback:
@@ -247,32 +273,50 @@ async def show_next_result(update: Update, context: CallbackContext, is_callback
                 disable_web_page_preview=True
             )
 
-        user_data[chat_id]['current_index'] = current_index + 1
+        # Меняется только индекс — список треков не перезаписывается
+        await asyncio.to_thread(sessions.set_index, chat_id, current_index + 1)
 
     except Exception as e:
         logger.error(f"Ошибка отображения: {str(e)}")
 
 
-async def show_all_results(update: Update, context: CallbackContext):
-    """Отображение всех результатов"""
+async def show_all_results(update: Update, context: CallbackContext, page: int = None):
+    """Отображение всех результатов по страницам: новое сообщение или листание уже показанного"""
     chat_id = update.effective_chat.id
-    data = user_data.get(chat_id)
+    data = await asyncio.to_thread(sessions.view, chat_id)
 
     if not data or not data.get('tracks'):
         await context.bot.send_message(chat_id, "❌ Нет доступных результатов")
         return
 
-    tracks = data['tracks']
-    message = "<b>Все найденные треки:</b>\n\n" + "\n\n".join(
-        [f"{i + 1}. {format_track_info(track)}" for i, track in enumerate(tracks)]
-    )
+    pages = renders.pages(chat_id, data, "<b>Все найденные треки:</b>\n\n")
+
+    if page is None:
+        sent = await context.bot.send_message(
+            chat_id=chat_id,
+            text=pages[0],
+            reply_markup=page_keyboard(0, len(pages)),
+            parse_mode='HTML',
+            disable_web_page_preview=True
+        )
+        renders.unchanged(chat_id, sent.message_id, (pages[0], page_keyboard(0, len(pages))))
+        return
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=message,
-        parse_mode='HTML',
-        disable_web_page_preview=True
-    )
+    page = min(page, len(pages) - 1)
+    content = (pages[page], page_keyboard(page, len(pages)))
+    message_id = update.callback_query.message.message_id
+    if renders.unchanged(chat_id, message_id, content):
+        return
+    try:
+        await update.callback_query.edit_message_text(
+            text=content[0],
+            reply_markup=content[1],
+            parse_mode='HTML',
+            disable_web_page_preview=True
+        )
+    except Exception:
+        renders.forget(chat_id, message_id)
+        raise
 
 
 async def button_callback(update: Update, context: CallbackContext) -> None:
@@ -282,7 +326,8 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
 
     try:
         if query.data == "next_track":
-            await show_next_result(update, context, is_callback=True)
+            with stage("render"):
+                await show_next_result(update, context, is_callback=True)
         elif query.data == "new_search":
             await context.bot.send_message(
                 query.message.chat_id,
@@ -290,6 +335,8 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
             )
         elif query.data == "show_all":
             await show_all_results(update, context)
+        elif query.data.startswith("page:"):
+            await show_all_results(update, context, int(query.data.split(":", 1)[1]))
         elif query.data == "close":
             await query.message.delete()
     except Exception as e:
@@ -302,13 +349,27 @@ async def main():
     if os.name == 'nt':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # concurrent_updates: длинное распознавание одного пользователя не задерживает остальных
+    application = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
 
     # Регистрация обработчиков
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.AUDIO | filters.VOICE, handle_audio))
+    application.add_handler(MessageHandler(filters.AUDIO | filters.VOICE | filters.VIDEO_NOTE, handle_audio))
     application.add_handler(CallbackQueryHandler(button_callback))
 
+    metrics_server = await start_metrics_server()
+
+    if WEBHOOK_URL:
+        logger.info("Бот успешно запущен (webhook)")
+        try:
+            await run_webhook(application)
+        finally:
+            await close_session()
+            if metrics_server is not None:
+                await metrics_server.cleanup()
+            close_trace()
+        return
+
     logger.info("Бот успешно запущен")
 
     try:
@@ -325,6 +386,10 @@ async def main():
     finally:
         await application.stop()
         await application.shutdown()
+        await close_session()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        close_trace()
 
 
 if __name__ == "__main__":
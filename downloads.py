@@ -0,0 +1,160 @@
+import logging
+import os
+import tempfile
+from contextlib import asynccontextmanager
+
+import aiohttp
+from telegram.error import BadRequest
+
+from metrics import counter, stage
+from recognition import get_session
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация загрузки файлов
+SPILL_THRESHOLD = 32 * 1024 * 1024  # Файлы больше этого размера скачиваются на диск (байт)
+SPILL_DIR = None  # Каталог для больших файлов; None — системный временный
+DOWNLOAD_LIMIT = 20 * 1024 * 1024  # Больше облачный Bot API ботам не отдаёт (байт)
+LOCAL_DOWNLOAD_LIMIT = None  # Предел для локального Bot API сервера (--local); None — без ограничения
+LOCAL_MODE = False  # Бот работает через локальный Bot API сервер в режиме --local: file_path — путь на диске
+DOWNLOAD_CHUNK = 256 * 1024  # Порция потокового скачивания (байт)
+DOWNLOAD_READ_TIMEOUT = 60  # Таймаут чтения очередной порции (сек)
+
+DOWNLOAD_BYTES = counter("download_bytes_total", "Байты файлов: скачанные и не скачанные из-за досрочной остановки",
+                         ("outcome",))
+
+
+class FileTooLargeError(Exception):
+    """Файл больше, чем Bot API разрешает скачать"""
+
+    def __init__(self, size: int = None, limit: int = None):
+        self.size = size
+        self.limit = limit
+        super().__init__(f"Файл {size} байт больше предела {limit} байт")
+
+
+def download_limit() -> int:
+    """Сколько байт бот может скачать; None — без ограничения"""
+    return LOCAL_DOWNLOAD_LIMIT if LOCAL_MODE else DOWNLOAD_LIMIT
+
+
+def check_size(size: int) -> None:
+    """FileTooLargeError, если файл заведомо не скачать (по размеру из сообщения)"""
+    limit = download_limit()
+    if size and limit and size > limit:
+        raise FileTooLargeError(size, limit)
+
+
+async def get_file(bot, file_id: str, size: int = None):
+    """getFile с понятной ошибкой вместо «File is too big» от Bot API"""
+    check_size(size)
+    try:
+        return await bot.get_file(file_id)
+    except BadRequest as e:
+        if "too big" in e.message.lower():
+            raise FileTooLargeError(size, download_limit()) from e
+        raise
+
+
+def too_large_text(size: int = None) -> str:
+    """Сообщение пользователю о файле, который бот не может скачать"""
+    limit = download_limit()
+    text = "📦 Файл слишком большой" + (f" ({size / 2 ** 20:.0f} МБ)" if size else "")
+    return text + (f": бот может скачать не больше {limit / 2 ** 20:.0f} МБ" if limit else "")
+
+
+def is_local(file) -> bool:
+    """Локальный Bot API сервер отдаёт вместо ссылки путь к файлу на диске"""
+    return bool(file.file_path) and not file.file_path.startswith(("http://", "https://"))
+
+
+@asynccontextmanager
+async def downloaded(file, file_size: int = None):
+    """Скачивает файл Telegram в память, а большие — во временный файл с уникальным именем
+
+    Возвращает источник для ffmpeg: буфер или путь. Временный файл удаляется при выходе.
+    Файл локального Bot API сервера не копируется: ffmpeg читает его по пути.
+    """
+    size = file_size or file.file_size
+    if is_local(file):
+        yield file.file_path
+        return
+
+    if not size or size <= SPILL_THRESHOLD:
+        with stage("download", bytes=size):
+            data = await file.download_as_bytearray()
+        yield data
+        return
+
+    fd, path = tempfile.mkstemp(prefix="audio_", dir=SPILL_DIR)
+    os.close(fd)
+    try:
+        logger.info(f"Файл {size} байт больше порога, скачиваем на диск")
+        with stage("download", bytes=size):
+            await file.download_to_drive(path)
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Ошибка удаления файла: {str(e)}")
+
+
+class StreamedFile:
+    """Файл, который скачивается порциями по мере чтения
+
+    chunks() подаётся в ffmpeg: декодирование начинается с первых порций, а не
+    после загрузки всего файла. Если ffmpeg остановился раньше конца файла,
+    остаток при выходе из streamed() не скачивается.
+    """
+
+    def __init__(self, url: str, size: int = None):
+        self.url = url
+        self.size = size
+        self.received = 0
+        self._response = None
+        self._finished = False
+
+    async def open(self) -> None:
+        session = await get_session()
+        self._response = await session.get(
+            self.url, timeout=aiohttp.ClientTimeout(total=None, sock_read=DOWNLOAD_READ_TIMEOUT)
+        )
+        self._response.raise_for_status()
+        self.size = self.size or self._response.content_length
+
+    async def chunks(self):
+        """Порции файла по мере скачивания; читать можно один раз"""
+        while True:
+            chunk = await self._response.content.read(DOWNLOAD_CHUNK)
+            if not chunk:
+                self._finished = True
+                return
+            self.received += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        if self._response is not None:
+            self._response.close()
+        DOWNLOAD_BYTES.inc(self.received, outcome="downloaded")
+        if self.size and not self._finished:
+            DOWNLOAD_BYTES.inc(self.size - self.received, outcome="skipped")
+            logger.info(f"Загрузка остановлена досрочно: скачано {self.received} из {self.size} байт")
+
+
+@asynccontextmanager
+async def streamed(file, file_size: int = None):
+    """Источник, который ffmpeg начинает читать до конца загрузки: StreamedFile
+
+    Для локального Bot API сервера файл уже на диске — возвращается путь.
+    """
+    if is_local(file):
+        yield file.file_path
+        return
+
+    stream = StreamedFile(file.file_path, file_size or file.file_size)
+    try:
+        await stream.open()
+        yield stream
+    finally:
+        stream.close()
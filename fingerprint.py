@@ -0,0 +1,376 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+
+from aggregation import normalized_key
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация локальных отпечатков
+FP_SAMPLE_RATE = 8000  # Частота, к которой приводится сигнал (Гц)
+FP_FFT = 1024  # Окно STFT: 512 частотных бинов (9 бит в хэше)
+FP_HOP = 256
+PEAK_FREQ_NEIGHBORHOOD = 15  # Окрестность локального максимума по частоте (бины)
+PEAK_TIME_NEIGHBORHOOD = 15  # ... и по времени (кадры)
+PEAKS_PER_SECOND = 20  # Плотность созвездия: сколько самых сильных пиков оставлять на секунду
+FAN_OUT = 8  # Со сколькими следующими пиками образует пару каждый якорь
+MAX_DT = 63  # Максимальный разнос пары по времени (кадры, 6 бит в хэше)
+MIN_MATCHES = 15  # Минимум совпавших пар с одинаковым сдвигом для уверенного ответа
+MAX_HASH_BUCKET = 2000  # Слишком частые хэши при поиске пропускаются
+MERGE_THRESHOLD = 200_000  # Сколько новых хэшей копить в памяти до слияния с индексом
+MAX_SEGMENTS_PER_TRACK = 3  # Сколько распознанных сегментов одного трека добавлять в индекс
+GENERATION_RETRIES = 3  # Сколько раз перечитывать указатель, если поколение удалили во время открытия
+INDEX_DIR = "fingerprints"
+
+
+def to_fingerprint_signal(pcm: bytes, sample_rate: int, channels: int) -> np.ndarray:
+    """PCM s16le -> моно float32 с частотой FP_SAMPLE_RATE (сглаживание + линейная интерполяция)"""
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    mono = samples.mean(axis=1, dtype=np.float32) / 32768.0
+
+    ratio = sample_rate / FP_SAMPLE_RATE
+    if ratio > 1:
+        width = int(round(ratio))
+        if width > 1:
+            mono = np.convolve(mono, np.full(width, 1.0 / width, dtype=np.float32), mode="same")
+        positions = np.arange(0, len(mono) - 1, ratio)
+        mono = np.interp(positions, np.arange(len(mono)), mono).astype(np.float32)
+    return mono
+
+
+def spectrogram(signal: np.ndarray) -> np.ndarray:
+    """Логарифмическая амплитудная спектрограмма: (кадры, 512 бинов)"""
+    if len(signal) < FP_FFT:
+        return np.empty((0, FP_FFT // 2), dtype=np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(signal, FP_FFT)[::FP_HOP]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FP_FFT).astype(np.float32), axis=1))[:, :FP_FFT // 2]
+    return np.log(spectrum + 1e-6)
+
+
+def _max_filter(values: np.ndarray, size: int, axis: int) -> np.ndarray:
+    """Скользящий максимум вдоль оси (окно size, по центру)"""
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (size // 2, size // 2)
+    padded = np.pad(values, pad, mode="constant", constant_values=-np.inf)
+    return np.lib.stride_tricks.sliding_window_view(padded, size, axis=axis).max(axis=-1)
+
+
+def find_peaks(spec: np.ndarray) -> tuple:
+    """Пики созвездия: локальные максимумы спектрограммы; возвращает (кадры, бины) по времени"""
+    if spec.size == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+    # Прямоугольный максимум раскладывается на два одномерных прохода
+    local_max = _max_filter(_max_filter(spec, PEAK_FREQ_NEIGHBORHOOD, 1), PEAK_TIME_NEIGHBORHOOD, 0)
+    # Плато тишины тоже «максимум» — отсекаем всё, что не громче среднего уровня
+    candidates = (spec == local_max) & (spec > spec.mean())
+    if not candidates.any():
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+    # В каждой секунде оставляем только самые сильные пики: шум добавляет много слабых максимумов
+    times, freqs = np.nonzero(candidates)
+    block = times // max(1, FP_SAMPLE_RATE // FP_HOP)
+    order = np.lexsort((-spec[times, freqs], block))
+    block = block[order]
+    first = np.searchsorted(block, block, side="left")
+    keep = order[np.arange(len(order)) - first < PEAKS_PER_SECOND]
+    keep.sort()  # np.nonzero отдаёт пики по времени — возвращаем этот порядок
+    return times[keep].astype(np.int32), freqs[keep].astype(np.int32)
+
+
+def landmark_hashes(times: np.ndarray, freqs: np.ndarray) -> tuple:
+    """Хэши пар пиков (f1:9 | f2:9 | dt:6) и время якоря каждой пары"""
+    hashes = []
+    offsets = []
+    for k in range(1, FAN_OUT + 1):
+        if len(times) <= k:
+            break
+        dt = times[k:] - times[:-k]
+        valid = (dt > 0) & (dt <= MAX_DT)
+        f1 = freqs[:-k][valid].astype(np.uint32)
+        f2 = freqs[k:][valid].astype(np.uint32)
+        hashes.append((f1 << 15) | (f2 << 6) | dt[valid].astype(np.uint32))
+        offsets.append(times[:-k][valid].astype(np.uint32))
+
+    if not hashes:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+    return np.concatenate(hashes), np.concatenate(offsets)
+
+
+def fingerprint_pcm(pcm: bytes, sample_rate: int, channels: int) -> tuple:
+    """Отпечаток фрагмента: (хэши, смещения якорей в кадрах)"""
+    times, freqs = find_peaks(spectrogram(to_fingerprint_signal(pcm, sample_rate, channels)))
+    return landmark_hashes(times, freqs)
+
+
+class FingerprintIndex:
+    """Индекс отпечатков на массивах numpy, отсортированных по хэшу
+
+    Основная часть хранится в .npy и открывается через memory map; новые
+    хэши копятся в памяти и периодически сливаются с основной частью.
+    Индекс могут пополнять несколько процессов (воркеры очереди): запись
+    идёт под файловой блокировкой, track_id — номер строки в tracks.jsonl,
+    а слияние читает массивы с диска, а не из памяти своего процесса.
+    Каждое слияние пишет новое поколение массивов в отдельный каталог и
+    атомарно переключает на него файл-указатель current, поэтому читатель
+    всегда видит три массива одного поколения.
+    """
+
+    def __init__(self, path: str = INDEX_DIR):
+        self.path = path
+        self.tracks = []  # track_id -> нормализованный словарь трека
+        self.track_ids = {}  # нормализованный ключ трека (aggregation.normalized_key) -> track_id
+        self.segments_added = {}  # track_id -> сколько сегментов уже добавлено
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._hashes = np.empty(0, dtype=np.uint32)
+        self._ids = np.empty(0, dtype=np.uint32)
+        self._offsets = np.empty(0, dtype=np.uint32)
+        self._pending = []  # [(хэши, id, смещения)]
+        self._pending_count = 0
+        self._pending_view = None
+        self._tracks_read = 0  # Сколько байт tracks.jsonl уже прочитано
+        self._generation = None  # Поколение массивов, открытое через memory map
+        self._loaded = False
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _file_lock(self):
+        """Блокировка индекса между процессами на время записи"""
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file("index.lock"), "a+b") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def load(self) -> None:
+        """Открывает индекс с диска (массивы — через memory map)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        self._sync()
+        logger.info(f"Индекс отпечатков: {len(self.tracks)} треков, {self.size} хэшей")
+
+    def _sync(self) -> None:
+        """Подхватывает треки и слияния, записанные другими процессами"""
+        try:
+            with open(self._file("tracks.jsonl"), "rb") as f:
+                f.seek(self._tracks_read)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Строка ещё дописывается
+                    self._register(json.loads(line))
+                    self._tracks_read += len(line)
+        except FileNotFoundError:
+            pass
+        self._open_arrays()
+
+    def _current(self) -> str | None:
+        """Имя текущего поколения массивов из файла-указателя"""
+        try:
+            with open(self._file("current"), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _open_arrays(self) -> None:
+        for _ in range(GENERATION_RETRIES):
+            generation = self._current()
+            if generation is None or generation == self._generation:
+                return
+            try:
+                self._hashes, self._ids, self._offsets = self._read_arrays(generation)
+            except FileNotFoundError:
+                continue  # Поколение уже удалено следующим слиянием: перечитываем указатель
+            self._generation = generation
+            return
+
+    def _read_arrays(self, generation: str | None) -> tuple:
+        """Массивы индекса одного поколения на диске"""
+        if generation is None:
+            empty = np.empty(0, dtype=np.uint32)
+            return empty, empty, empty
+        arrays = tuple(
+            np.load(os.path.join(self._file(generation), f"{name}.npy"), mmap_mode="r")
+            for name in ("hashes", "ids", "offsets")
+        )
+        if len({len(array) for array in arrays}) != 1:
+            raise ValueError(f"Поколение индекса {generation} повреждено: длины массивов различаются")
+        return arrays
+
+    @property
+    def size(self) -> int:
+        return len(self._hashes) + self._pending_count
+
+    def _register(self, track: dict) -> int:
+        track_id = len(self.tracks)
+        self.tracks.append(track)
+        self.track_ids.setdefault(normalized_key(track), track_id)
+        return track_id
+
+    def add(self, track: dict, hashes: np.ndarray, offsets: np.ndarray) -> bool:
+        """Добавляет отпечаток распознанного сегмента; False, если трек уже покрыт"""
+        if len(hashes) == 0:
+            return False
+        with self._lock:
+            self.load()
+            key = normalized_key(track)
+            track_id = self.track_ids.get(key)
+            if track_id is None:
+                with self._file_lock():
+                    self._sync()  # Трек мог добавить другой процесс; номер следующего — по файлу
+                    track_id = self.track_ids.get(key)
+                    if track_id is None:
+                        stored = {k: v for k, v in track.items() if k not in ("start", "end", "segment", "alternative")}
+                        line = (json.dumps(stored, ensure_ascii=False) + "\n").encode("utf-8")
+                        with open(self._file("tracks.jsonl"), "ab") as f:
+                            f.write(line)
+                        track_id = self._register(stored)
+                        self._tracks_read += len(line)
+            if self.segments_added.get(track_id, 0) >= MAX_SEGMENTS_PER_TRACK:
+                return False
+
+            self.segments_added[track_id] = self.segments_added.get(track_id, 0) + 1
+            self._pending.append((hashes, np.full(len(hashes), track_id, dtype=np.uint32), offsets))
+            self._pending_count += len(hashes)
+            self._pending_view = None
+            if self._pending_count >= MERGE_THRESHOLD:
+                self._merge()
+        return True
+
+    def flush(self) -> None:
+        """Сливает накопленные хэши с индексом на диске"""
+        with self._lock:
+            if self._pending:
+                self._merge()
+
+    def _merge(self) -> None:
+        with self._file_lock():
+            # Сливаем с массивами на диске: их могли обновить другие процессы
+            current = self._current()
+            stored = self._read_arrays(current)
+            hashes = np.concatenate([stored[0]] + [p[0] for p in self._pending])
+            ids = np.concatenate([stored[1]] + [p[1] for p in self._pending])
+            offsets = np.concatenate([stored[2]] + [p[2] for p in self._pending])
+            order = np.argsort(hashes, kind="stable")
+            del stored
+
+            generation = f"gen-{int(current[4:]) + 1 if current else 1:08d}"
+            os.makedirs(self._file(generation), exist_ok=True)
+            for name, array in (("hashes", hashes[order]), ("ids", ids[order]), ("offsets", offsets[order])):
+                np.save(os.path.join(self._file(generation), f"{name}.npy"), array)
+            tmp = self._file("current.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(generation)
+            os.replace(tmp, self._file("current"))
+            self._sync()
+
+            # Предыдущее поколение оставляем читателям, которые успели прочитать старый указатель
+            for name in os.listdir(self.path):
+                if name.startswith("gen-") and name not in (generation, current):
+                    shutil.rmtree(self._file(name), ignore_errors=True)  # Под Windows открытые mmap не удалятся — до следующего слияния
+
+        self._pending = []
+        self._pending_count = 0
+        self._pending_view = None
+        logger.info(f"Индекс отпечатков слит: {len(self._hashes)} хэшей")
+
+    def _pending_arrays(self) -> tuple:
+        if self._pending_view is None:
+            if self._pending:
+                hashes = np.concatenate([p[0] for p in self._pending])
+                order = np.argsort(hashes, kind="stable")
+                self._pending_view = (
+                    hashes[order],
+                    np.concatenate([p[1] for p in self._pending])[order],
+                    np.concatenate([p[2] for p in self._pending])[order],
+                )
+            else:
+                empty = np.empty(0, dtype=np.uint32)
+                self._pending_view = (empty, empty, empty)
+        return self._pending_view
+
+    @staticmethod
+    def _candidates(hashes, ids, offsets, query_hashes, query_offsets) -> tuple:
+        """Все записи индекса с хэшами из запроса: (id треков, сдвиги db - query)"""
+        left = np.searchsorted(hashes, query_hashes, side="left")
+        right = np.searchsorted(hashes, query_hashes, side="right")
+        counts = right - left
+        keep = (counts > 0) & (counts <= MAX_HASH_BUCKET)
+        left, counts, query_offsets = left[keep], counts[keep], query_offsets[keep]
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        # Разворачиваем диапазоны [left, right) в плоский массив индексов без цикла
+        starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+        positions = starts + np.arange(total)
+        deltas = offsets[positions].astype(np.int64) - np.repeat(query_offsets, counts).astype(np.int64)
+        return ids[positions].astype(np.int64), deltas
+
+    def lookup(self, hashes: np.ndarray, offsets: np.ndarray):
+        """Ищет трек по отпечатку; возвращает словарь трека или None"""
+        with self._lock:
+            self.load()
+            self._sync()
+            if len(hashes) == 0 or self.size == 0:
+                self.misses += 1
+                return None
+            parts = [self._candidates(self._hashes, self._ids, self._offsets, hashes, offsets)]
+            parts.append(self._candidates(*self._pending_arrays(), hashes, offsets))
+
+        ids = np.concatenate([p[0] for p in parts])
+        deltas = np.concatenate([p[1] for p in parts])
+        if len(ids) == 0:
+            self.misses += 1
+            return None
+
+        # Голосование: совпадения одного трека с одинаковым сдвигом во времени
+        votes, counts = np.unique((ids << 32) | (deltas + (1 << 31)), return_counts=True)
+        best = int(np.argmax(counts))
+        if counts[best] < MIN_MATCHES:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        track = dict(self.tracks[int(votes[best] >> 32)])
+        track["score"] = track.get("score") or 100
+        track["provider"] = "fingerprint"
+        track["matches"] = int(counts[best])
+        return track
+
+    def stats(self) -> dict:
+        return {"tracks": len(self.tracks), "hashes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+index = FingerprintIndex()
+
+observe("fingerprint_lookups_total", "Поиски в локальном индексе отпечатков",
+        lambda: {"hit": index.hits, "miss": index.misses}, ("outcome",), "counter")
+observe("fingerprint_index_hashes", "Хэшей в локальном индексе отпечатков", lambda: index.size)
@@ -0,0 +1,485 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация очереди заданий
+JOBS_DB_PATH = "jobs.sqlite3"
+LEASE_SECONDS = 120  # Аренда задания: если воркер не продлил её, задание достанется другому
+POLL_INTERVAL = 1.0  # Как часто свободный воркер проверяет очередь (сек)
+MAX_ATTEMPTS = 3  # После стольких неудачных попыток задание уходит в dead-letter
+RETRY_DELAY = 30  # Задержка перед повтором (сек), удваивается с каждой попыткой
+JOB_RETENTION = 7 * 24 * 3600  # Сколько хранятся завершённые и мёртвые задания (сек)
+
+JOBS = counter("jobs_total", "Задания, обработанные воркерами", ("outcome",))
+
+
+class RetryLater(Exception):
+    """Задание нельзя выполнить сейчас (перегрузка); вернуть в очередь, не тратя попытку"""
+
+    def __init__(self, delay: float = RETRY_DELAY):
+        super().__init__(f"повтор через {delay} с")
+        self.delay = delay
+
+
+class Job:
+    """Задание из очереди: payload задаёт работу, state — прогресс, переживающий повторы"""
+    __slots__ = ("id", "key", "payload", "state", "status", "attempts", "owner", "error")
+
+    def __init__(self, id, key, payload, state=None, status="queued", attempts=0, owner=None, error=None):
+        self.id = id
+        self.key = key
+        self.payload = payload
+        self.state = state or {}
+        self.status = status  # queued, running, done или dead
+        self.attempts = attempts
+        self.owner = owner
+        self.error = error
+
+
+def _backoff(attempts: int, delay: float) -> float:
+    return delay * 2 ** max(0, attempts - 1)
+
+
+class MemoryJobQueue:
+    """Очередь в памяти процесса: для отладки и нагрузочных тестов, перезапуск не переживает"""
+
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS, retry_delay: float = RETRY_DELAY):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._jobs = {}  # id -> [задание, доступно с, аренда до, доставлено]
+        self._keys = {}  # ключ -> id
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _copy(job: Job) -> Job:
+        # Воркер получает копию: чужой захват не меняет его экземпляр
+        return Job(job.id, job.key, job.payload, dict(job.state), job.status, job.attempts, job.owner, job.error)
+
+    def enqueue(self, key: str, payload: dict) -> Job:
+        """Ставит задание в очередь; повтор с тем же ключом возвращает существующее"""
+        with self._lock:
+            if key not in self._keys:
+                job = Job(self._next_id, key, payload)
+                self._next_id += 1
+                self._jobs[job.id] = [job, time.time(), 0.0, False]
+                self._keys[key] = job.id
+            return self._copy(self._jobs[self._keys[key]][0])
+
+    def find(self, key: str) -> Job:
+        with self._lock:
+            item = self._jobs.get(self._keys.get(key))
+            return self._copy(item[0]) if item else None
+
+    def claim(self, owner: str, lease: float = LEASE_SECONDS) -> Job:
+        """Берёт готовое задание (или задание с истёкшей арендой) в аренду"""
+        now = time.time()
+        with self._lock:
+            for item in self._jobs.values():
+                job, available_at, lease_until, _ = item
+                if (job.status == "queued" and available_at <= now) or \
+                        (job.status == "running" and lease_until < now):
+                    job.status, job.owner = "running", owner
+                    job.attempts += 1
+                    item[2] = now + lease
+                    return self._copy(job)
+            return None
+
+    def _owned(self, job: Job):
+        item = self._jobs.get(job.id)
+        if item is None or item[0].status != "running" or item[0].owner != job.owner:
+            return None
+        return item
+
+    def extend(self, job: Job, lease: float = LEASE_SECONDS) -> bool:
+        """Продлевает аренду; False — задание уже забрал другой воркер"""
+        with self._lock:
+            item = self._owned(job)
+            if item is None:
+                return False
+            item[2] = time.time() + lease
+            return True
+
+    def save_state(self, job: Job) -> None:
+        """Сохраняет job.state, чтобы повтор продолжил с того же места"""
+        with self._lock:
+            item = self._owned(job)
+            if item is not None:
+                item[0].state = dict(job.state)
+
+    def complete(self, job: Job) -> None:
+        with self._lock:
+            item = self._owned(job)
+            if item is not None:
+                item[0].status = job.status = "done"
+                item[0].owner = job.owner = None
+
+    def fail(self, job: Job, error: str) -> str:
+        """Неудачная попытка: задание ждёт повтора или уходит в dead-letter; возвращает новый статус"""
+        with self._lock:
+            item = self._owned(job)
+            if item is None:
+                return job.status
+            status = "dead" if job.attempts >= self.max_attempts else "queued"
+            item[0].status = job.status = status
+            item[0].error = job.error = error
+            item[0].owner = job.owner = None
+            item[1] = time.time() + _backoff(job.attempts, self.retry_delay)
+            return status
+
+    def release(self, job: Job, delay: float = 0) -> None:
+        """Возвращает задание в очередь, не засчитывая попытку"""
+        with self._lock:
+            item = self._owned(job)
+            if item is not None:
+                item[0].status = job.status = "queued"
+                item[0].owner = job.owner = None
+                item[0].attempts = job.attempts = job.attempts - 1
+                item[1] = time.time() + delay
+
+    def mark_delivered(self, job: Job) -> bool:
+        """Отмечает отправку результата; False — результат уже отправлен"""
+        with self._lock:
+            item = self._jobs[job.id]
+            if item[3]:
+                return False
+            item[3] = True
+            return True
+
+    def unmark_delivered(self, job: Job) -> None:
+        """Отправка не удалась — результат можно отправить при повторе"""
+        with self._lock:
+            self._jobs[job.id][3] = False
+
+    def dead_letters(self, limit: int = 100) -> list:
+        with self._lock:
+            return [self._copy(item[0]) for item in self._jobs.values() if item[0].status == "dead"][:limit]
+
+    def requeue(self, job_id: int) -> bool:
+        """Возвращает мёртвое задание в очередь с новыми попытками"""
+        with self._lock:
+            item = self._jobs.get(job_id)
+            if item is None or item[0].status != "dead":
+                return False
+            item[0].status, item[0].attempts, item[1] = "queued", 0, time.time()
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "done": 0, "dead": 0}
+            for item in self._jobs.values():
+                counts[item[0].status] += 1
+            return counts
+
+
+class SQLiteJobQueue:
+    """Очередь в SQLite: переживает перезапуск и общая для нескольких процессов-воркеров на одном томе"""
+
+    def __init__(self, path: str = JOBS_DB_PATH, max_attempts: int = MAX_ATTEMPTS, retry_delay: float = RETRY_DELAY,
+                 retention: float = JOB_RETENTION):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention = retention
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, payload TEXT NOT NULL, "
+                "state TEXT NOT NULL DEFAULT '{}', status TEXT NOT NULL DEFAULT 'queued', "
+                "attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL, owner TEXT, "
+                "lease_until REAL NOT NULL DEFAULT 0, delivered INTEGER NOT NULL DEFAULT 0, error TEXT, "
+                "updated REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs(status, available_at)")
+        return self._db
+
+    def _transaction(self, body):
+        # BEGIN IMMEDIATE: два воркера не заберут одно задание
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = body(db)
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            return result
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        with self._lock:
+            return self._connect().execute(sql, params).rowcount
+
+    @staticmethod
+    def _job(row) -> Job:
+        id, key, payload, state, status, attempts, owner, error = row
+        return Job(id, key, json.loads(payload), json.loads(state), status, attempts, owner, error)
+
+    _COLUMNS = "id, key, payload, state, status, attempts, owner, error"
+
+    def enqueue(self, key: str, payload: dict) -> Job:
+        now = time.time()
+
+        def body(db):
+            db.execute(
+                "INSERT OR IGNORE INTO jobs (key, payload, available_at, updated) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            # Попутно чистим старые завершённые задания
+            db.execute("DELETE FROM jobs WHERE status IN ('done', 'dead') AND updated < ?", (now - self.retention,))
+            return db.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE key = ?", (key,)).fetchone()
+
+        return self._job(self._transaction(body))
+
+    def find(self, key: str) -> Job:
+        with self._lock:
+            row = self._connect().execute(f"SELECT {self._COLUMNS} FROM jobs WHERE key = ?", (key,)).fetchone()
+        return self._job(row) if row else None
+
+    def claim(self, owner: str, lease: float = LEASE_SECONDS) -> Job:
+        now = time.time()
+
+        def body(db):
+            row = db.execute(
+                f"SELECT {self._COLUMNS} FROM jobs "
+                "WHERE (status = 'queued' AND available_at <= ?) OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY available_at, id LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, attempts = attempts + 1, "
+                "updated = ? WHERE id = ?",
+                (owner, now + lease, now, row[0])
+            )
+            job = self._job(row)
+            job.status, job.owner, job.attempts = "running", owner, job.attempts + 1
+            return job
+
+        return self._transaction(body)
+
+    def extend(self, job: Job, lease: float = LEASE_SECONDS) -> bool:
+        return self._execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (time.time() + lease, job.id, job.owner)
+        ) == 1
+
+    def save_state(self, job: Job) -> None:
+        self._execute(
+            "UPDATE jobs SET state = ?, updated = ? WHERE id = ? AND owner = ?",
+            (json.dumps(job.state, ensure_ascii=False), time.time(), job.id, job.owner)
+        )
+
+    def complete(self, job: Job) -> None:
+        if self._execute(
+            "UPDATE jobs SET status = 'done', owner = NULL, updated = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (time.time(), job.id, job.owner)
+        ):
+            job.status, job.owner = "done", None
+
+    def fail(self, job: Job, error: str) -> str:
+        now = time.time()
+        status = "dead" if job.attempts >= self.max_attempts else "queued"
+        if self._execute(
+            "UPDATE jobs SET status = ?, owner = NULL, available_at = ?, error = ?, updated = ? "
+            "WHERE id = ? AND owner = ? AND status = 'running'",
+            (status, now + _backoff(job.attempts, self.retry_delay), error, now, job.id, job.owner)
+        ):
+            job.status, job.owner, job.error = status, None, error
+        return job.status
+
+    def release(self, job: Job, delay: float = 0) -> None:
+        now = time.time()
+        if self._execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL, attempts = attempts - 1, available_at = ?, updated = ? "
+            "WHERE id = ? AND owner = ? AND status = 'running'",
+            (now + delay, now, job.id, job.owner)
+        ):
+            job.status, job.owner, job.attempts = "queued", None, job.attempts - 1
+
+    def mark_delivered(self, job: Job) -> bool:
+        return self._execute("UPDATE jobs SET delivered = 1 WHERE id = ? AND delivered = 0", (job.id,)) == 1
+
+    def unmark_delivered(self, job: Job) -> None:
+        self._execute("UPDATE jobs SET delivered = 0 WHERE id = ?", (job.id,))
+
+    def dead_letters(self, limit: int = 100) -> list:
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT {self._COLUMNS} FROM jobs WHERE status = 'dead' ORDER BY updated DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def requeue(self, job_id: int) -> bool:
+        now = time.time()
+        return self._execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, available_at = ?, updated = ? "
+            "WHERE id = ? AND status = 'dead'",
+            (now, now, job_id)
+        ) == 1
+
+    def stats(self) -> dict:
+        counts = {"queued": 0, "running": 0, "done": 0, "dead": 0}
+        with self._lock:
+            for status, count in self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+                counts[status] = count
+        return counts
+
+
+def create_queue(backend: str = "sqlite", **kwargs):
+    """Создаёт очередь заданий: memory или sqlite"""
+    if backend == "memory":
+        return MemoryJobQueue(**kwargs)
+    if backend == "sqlite":
+        return SQLiteJobQueue(**kwargs)
+    raise ValueError(f"Неизвестное хранилище очереди: {backend}")
+
+
+class JobWorker:
+    """Выполняет задания из очереди в concurrency параллельных слотах
+
+    Пока задание выполняется, аренда продлевается; если её перехватил другой
+    воркер, выполнение отменяется. Ошибка — повтор с растущей задержкой, после
+    MAX_ATTEMPTS — dead-letter и вызов on_dead(job). При остановке незавершённые
+    задания возвращаются в очередь без потери попытки.
+    """
+
+    def __init__(self, queue, handler, concurrency: int = 1, lease: float = LEASE_SECONDS,
+                 poll_interval: float = POLL_INTERVAL, on_dead=None, name: str = None):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.on_dead = on_dead
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self._slots = []
+        self._running = {}  # id задания -> задача обработчика
+        self._lost = set()  # id заданий, аренду которых перехватили
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    @property
+    def active(self) -> int:
+        return len(self._running)
+
+    def start(self) -> None:
+        self._slots = [asyncio.create_task(self._loop()) for _ in range(self.concurrency)]
+        logger.info(f"Воркер {self.name}: {self.concurrency} слотов")
+
+    def notify(self) -> None:
+        """Будит свободные слоты — в очереди новое задание"""
+        self._wakeup.set()
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Перестаёт брать задания, ждёт текущие до timeout и возвращает оставшиеся в очередь"""
+        self._stopping = True
+        self._wakeup.set()
+        done, pending = await asyncio.wait(self._slots, timeout=timeout) if self._slots else (set(), set())
+        if pending:
+            logger.warning(f"Не дождались {len(self._running)} заданий, возвращаем их в очередь")
+            for task in list(self._running.values()):
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _loop(self) -> None:
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                job = self.queue.claim(self.name, self.lease)
+            except Exception as e:
+                logger.error(f"Ошибка очереди заданий: {str(e)}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(job)
+
+    async def _heartbeat(self, job: Job, task: asyncio.Task) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not self.queue.extend(job, self.lease):
+                logger.warning(f"Аренда задания {job.id} перехвачена, выполнение прервано")
+                self._lost.add(job.id)
+                task.cancel()
+                return
+
+    async def _process(self, job: Job) -> None:
+        if job.attempts > self.queue.max_attempts:
+            # Воркеры падали на этом задании, не успевая сообщить об ошибке
+            await self._fail(job, "аренда истекала слишком много раз")
+            return
+
+        task = asyncio.create_task(self.handler(job))
+        self._running[job.id] = task
+        heartbeat = asyncio.create_task(self._heartbeat(job, task))
+        try:
+            await task
+        except asyncio.CancelledError:
+            if job.id in self._lost:
+                JOBS.inc(outcome="lost")
+            else:
+                self.queue.release(job)
+                JOBS.inc(outcome="released")
+        except RetryLater as e:
+            self.queue.release(job, e.delay)
+            JOBS.inc(outcome="postponed")
+        except Exception as e:
+            logger.error(f"Задание {job.id} (попытка {job.attempts}) завершилось ошибкой: {str(e)}")
+            await self._fail(job, f"{type(e).__name__}: {e}")
+        else:
+            self.queue.complete(job)
+            JOBS.inc(outcome="done")
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job.id, None)
+            self._lost.discard(job.id)
+
+    async def _fail(self, job: Job, error: str) -> None:
+        if self.queue.fail(job, error) != "dead":
+            JOBS.inc(outcome="retry")
+            return
+        JOBS.inc(outcome="dead")
+        logger.error(f"Задание {job.id} перемещено в dead-letter: {error}")
+        if self.on_dead is not None:
+            try:
+                await self.on_dead(job)
+            except Exception as e:
+                logger.warning(f"Не удалось сообщить о задании {job.id}: {str(e)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Задания в dead-letter очереди")
+    parser.add_argument("--db", default=JOBS_DB_PATH)
+    parser.add_argument("--requeue", type=int, nargs="*", metavar="ID", help="вернуть задания в очередь")
+    args = parser.parse_args()
+
+    queue = SQLiteJobQueue(args.db)
+    if args.requeue:
+        for job_id in args.requeue:
+            print(f"{job_id}: {'возвращено' if queue.requeue(job_id) else 'не найдено среди мёртвых'}")
+    else:
+        print(queue.stats())
+        for job in queue.dead_letters():
+            print(f"{job.id}\t{job.key}\tпопыток: {job.attempts}\t{job.error}")
@@ -0,0 +1,282 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация метрик и трассировки (через переменные окружения)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100") or 0)  # 0 — не поднимать /metrics
+TRACE_PATH = os.getenv("TRACE_PATH")  # Файл JSON Lines для спанов; пусто — без трассировки
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Общая часть метрик: имя, описание и значения по наборам меток"""
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name}: ожидались метки {self.labels}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """(суффикс имени, метки, значение) для вывода"""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "", dict(zip(self.labels, key)), value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, total, count) in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", dict(labels, le=_format_value(bound)), cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class CallbackMetric(Metric):
+    """Метрика, значения которой снимаются при каждом запросе /metrics
+
+    function возвращает число либо словарь {значение метки или кортеж значений: число}.
+    """
+
+    def __init__(self, name: str, description: str, function, labels: tuple = (), kind: str = "gauge"):
+        super().__init__(name, description, labels)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        try:
+            values = self.function()
+        except Exception as e:
+            logger.warning(f"Метрика {self.name} не собрана: {str(e)}")
+            return
+        if not isinstance(values, dict):
+            yield "", {}, values
+            return
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            yield "", dict(zip(self.labels, key)), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, description: str, labels: tuple = ()) -> Counter:
+    return registry.register(Counter(name, description, labels))
+
+
+def gauge(name: str, description: str, labels: tuple = ()) -> Gauge:
+    return registry.register(Gauge(name, description, labels))
+
+
+def histogram(name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, description, labels, buckets))
+
+
+def observe(name: str, description: str, function, labels: tuple = (), kind: str = "gauge") -> CallbackMetric:
+    """Регистрирует метрику, которая читает текущее значение из функции"""
+    return registry.register(CallbackMetric(name, description, function, labels, kind))
+
+
+# Метрики конвейера распознавания
+STAGE_SECONDS = histogram("recognition_stage_seconds", "Длительность этапа обработки файла", ("stage",))
+STAGE_ERRORS = counter("recognition_errors_total", "Ошибки по этапам и типам", ("stage", "type"))
+API_SECONDS = histogram("recognition_api_seconds", "Длительность запроса к провайдеру", ("provider",))
+API_CALLS = counter("recognition_api_calls_total", "Запросы к провайдерам", ("provider", "outcome"))
+FILES = counter("recognition_files_total", "Обработанные файлы", ("outcome",))
+
+
+# Трассировка: спаны одного запроса связаны trace_id из контекста задачи
+_trace = contextvars.ContextVar("trace", default=None)
+_trace_lock = threading.Lock()
+_trace_file = None
+
+
+def _write_span(span: dict) -> None:
+    global _trace_file
+    with _trace_lock:
+        if _trace_file is None:
+            _trace_file = open(TRACE_PATH, "a", encoding="utf-8", buffering=1)
+        _trace_file.write(json.dumps(span, ensure_ascii=False) + "\n")
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """Корневой спан запроса (например, одного файла); без TRACE_PATH ничего не пишет"""
+    if not TRACE_PATH:
+        yield None
+        return
+    token = _trace.set({"trace_id": uuid.uuid4().hex})
+    try:
+        with span(name, **attributes) as current:
+            yield current
+    finally:
+        _trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Спан внутри текущей трассы; вне трассы — no-op"""
+    context = _trace.get()
+    if context is None:
+        yield attributes
+        return
+    started = time.time()
+    status = "ok"
+    try:
+        yield attributes
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _write_span({
+            "trace_id": context["trace_id"],
+            "name": name,
+            "start": started,
+            "duration": time.time() - started,
+            "status": status,
+            **attributes,
+        })
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """Замер этапа конвейера: гистограмма, счётчик ошибок и спан трассы"""
+    started = time.perf_counter()
+    try:
+        with span(name, **attributes) as current:
+            yield current
+    except Exception as e:
+        STAGE_ERRORS.inc(stage=name, type=type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=name)
+
+
+def close_trace() -> None:
+    global _trace_file
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+            _trace_file = None
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Поднимает локальный HTTP-сервер с /metrics; возвращает runner для остановки (или None)"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
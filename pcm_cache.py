@@ -0,0 +1,168 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+import numpy as np
+
+from audio_stream import SAMPLE_WIDTH, Segment, read_pcm_blocks
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация кэша декодированного аудио
+PCM_CACHE_DIR = "pcm_cache"
+PCM_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Предел кэша на диске; давно не использованные файлы вытесняются (байт)
+PCM_SAMPLE_RATE = 22050  # Вдвое выше ANALYSIS_RATE: признаки считаются прореживанием, профилям 16 кГц хватает
+DECODE_BLOCK = 30  # Порция записи при декодировании (сек)
+STALE_TEMP_SECONDS = 3600  # Через сколько удалять временные файлы, оставшиеся после сбоя (сек)
+
+_temp_ids = itertools.count()
+
+
+class DecodedAudio:
+    """Моно-сигнал файла (s16le), открытый через memory map
+
+    Фрагменты читаются срезом массива: ни ffmpeg, ни чтения всего файла в память.
+    """
+    __slots__ = ("samples", "sample_rate")
+    channels = 1
+
+    def __init__(self, samples: np.ndarray, sample_rate: int = PCM_SAMPLE_RATE):
+        self.samples = samples
+        self.sample_rate = sample_rate
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+    def clip(self, start: float, duration: float) -> bytes:
+        """PCM фрагмента [start, start + duration)"""
+        first = max(0, int(start * self.sample_rate))
+        return self.samples[first:first + int(duration * self.sample_rate)].tobytes()
+
+    async def segments(self, segment_duration: float, max_segments: int = None, every: int = 1):
+        """Фиксированные окна — как stream_segments, но без декодирования"""
+        windows = itertools.count(0, every)
+        for index in itertools.islice(windows, max_segments):
+            pcm = self.clip(index * segment_duration, segment_duration)
+            if not pcm:
+                return
+            yield Segment(index, index * segment_duration, pcm, sample_rate=self.sample_rate, channels=self.channels)
+
+
+class PCMCache:
+    """Декодированные файлы на локальном диске по file_unique_id с LRU-вытеснением по размеру
+
+    Повтор задания берёт сигнал отсюда, не скачивая и не декодируя файл заново.
+    Файлы — сырой PCM, открываются через np.memmap; время использования — mtime.
+    """
+
+    def __init__(self, path: str = PCM_CACHE_DIR, max_bytes: int = PCM_CACHE_MAX_BYTES,
+                 sample_rate: int = PCM_SAMPLE_RATE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, file_unique_id: str) -> str:
+        return os.path.join(self.path, f"{file_unique_id}.{self.sample_rate}.pcm")
+
+    def _open(self, path: str) -> DecodedAudio:
+        if os.path.getsize(path) < SAMPLE_WIDTH:
+            return DecodedAudio(np.empty(0, dtype=np.int16), self.sample_rate)
+        return DecodedAudio(np.memmap(path, dtype=np.int16, mode="r"), self.sample_rate)
+
+    def get(self, file_unique_id: str):
+        """Декодированный файл или None"""
+        path = self._file(file_unique_id)
+        try:
+            os.utime(path)  # Отметка использования для LRU
+            audio = self._open(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return audio
+
+    async def decode(self, source, file_unique_id: str = None) -> DecodedAudio:
+        """Декодирует файл одним проходом ffmpeg в моно PCM и сохраняет его
+
+        source — путь, буфер или поток порций (декодирование идёт по мере скачивания).
+        Без file_unique_id файл не кэшируется и удаляется сразу после открытия.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        temp = os.path.join(self.path, f"{file_unique_id or 'decode'}.{os.getpid()}.{next(_temp_ids)}.tmp")
+        try:
+            with open(temp, "wb") as f:
+                async for block in read_pcm_blocks(source, DECODE_BLOCK, sample_rate=self.sample_rate, channels=1):
+                    await asyncio.to_thread(f.write, block)
+            if file_unique_id is None:
+                return self._open(temp)
+            path = self._file(file_unique_id)
+            try:
+                os.replace(temp, path)
+            except OSError:
+                return self._open(temp)  # Windows: прежний файл открыт другим процессом — этот не кэшируем
+            audio = self._open(path)
+        finally:
+            try:
+                os.remove(temp)  # Открытая карта остаётся рабочей, данные удалятся вместе с ней
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.debug(f"Временный файл удалится при вытеснении: {str(e)}")
+
+        await asyncio.to_thread(self.evict)
+        return audio
+
+    def evict(self) -> None:
+        """Удаляет давно не использованные файлы, пока кэш не уложится в max_bytes"""
+        now = time.time()
+        files = []
+        try:
+            entries = list(os.scandir(self.path))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith(".tmp"):
+                if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                    self._remove(entry.path)
+            elif entry.name.endswith(".pcm"):
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if self._remove(path):
+                total -= size
+                removed += 1
+        if removed:
+            logger.info(f"Кэш PCM: вытеснено файлов: {removed}, осталось {total} байт")
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError as e:
+            # В Windows файл, открытый другим процессом через memmap, не удаляется — попробуем позже
+            logger.debug(f"Файл кэша PCM не удалён: {str(e)}")
+            return False
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+decoded = PCMCache()
+
+observe("pcm_cache_total", "Обращения к кэшу декодированного аудио",
+        lambda: {"hit": decoded.hits, "miss": decoded.misses}, ("outcome",), "counter")
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация живого статуса
+EDIT_INTERVAL = 1.5  # Минимальный интервал между правками одного сообщения (сек)
+
+
+class LiveStatus:
+    """Статусное сообщение, которое обновляется по ходу обработки
+
+    Частые обновления склеиваются: между правками проходит не меньше
+    EDIT_INTERVAL, отправляется только последний текст, а неизменённый
+    текст не отправляется вовсе.
+    """
+
+    def __init__(self, bot, chat_id: int, interval: float = EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message_id = None
+        self._sent = None  # (текст, клавиатура) последней успешной правки
+        self._pending = None
+        self._last_edit = 0.0
+        self._task = None
+
+    async def start(self, text: str) -> None:
+        """Отправляет исходное статусное сообщение"""
+        message = await self.bot.send_message(self.chat_id, text)
+        self.message_id = message.message_id
+        self._sent = (text, None)
+        self._last_edit = time.monotonic()
+
+    def attach(self, message_id: int) -> None:
+        """Продолжает обновлять уже отправленное сообщение (например, созданное до постановки в очередь)"""
+        self.message_id = message_id
+
+    def update(self, text: str, reply_markup=None) -> None:
+        """Запоминает новый текст; правка уйдёт не раньше, чем позволит интервал"""
+        self._pending = (text, reply_markup)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def finish(self, text: str, reply_markup=None) -> None:
+        """Немедленно выставляет финальный текст и отменяет отложенные правки"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._pending = (text, reply_markup)
+        await self._flush()
+
+    async def _flush_later(self) -> None:
+        delay = self._last_edit + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._flush()
+
+    async def _flush(self) -> None:
+        if self.message_id is None or self._pending is None or self._pending == self._sent:
+            return
+
+        text, reply_markup = pending = self._pending
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.message_id, reply_markup=reply_markup
+            )
+            self._sent = pending
+        except RetryAfter as e:
+            # Telegram просит подождать — откладываем правку, новые обновления её заменят
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logger.warning(f"Ограничение правок, ждём {retry_after} с")
+            self._last_edit = time.monotonic() + retry_after
+            self._task = asyncio.create_task(self._flush_later())
+            return
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"Ошибка обновления статуса: {str(e)}")
+        self._last_edit = time.monotonic()
+
+
+class ThrottledEdit:
+    """Правка сообщения, содержимое которого берётся в момент отправки
+
+    Как и в LiveStatus, частые запросы склеиваются: между правками проходит
+    не меньше EDIT_INTERVAL. edit — корутина без аргументов, которая правит сообщение.
+    """
+
+    def __init__(self, edit, interval: float = EDIT_INTERVAL):
+        self.edit = edit
+        self.interval = interval
+        self._requested = False
+        self._last_edit = time.monotonic()
+        self._task = None
+
+    def request(self) -> None:
+        """Просит обновить сообщение; правка уйдёт не раньше, чем позволит интервал"""
+        self._requested = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while self._requested:
+            delay = self._last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._requested = False
+            try:
+                await self.edit()
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self._requested = True
+                self._last_edit = time.monotonic() + retry_after
+                continue
+            except Exception as e:
+                logger.debug(f"Сообщение не обновлено: {str(e)}")
+            self._last_edit = time.monotonic()
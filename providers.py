@@ -0,0 +1,293 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import time
+from collections import Counter, deque
+
+from aiohttp import FormData
+
+from audio_stream import DEFAULT_PROFILE, get_profile
+from metrics import API_CALLS, API_SECONDS, span
+from recognition import AUDD_API_URL, RecognitionError, post_with_retries
+from session_store import TrackRecord
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация маршрутизации
+STATS_WINDOW = 200  # Сколько последних запросов учитывать в статистике провайдера
+HEDGE_MIN_DELAY = 0.5  # Минимальная задержка перед хеджирующим запросом (сек)
+HEDGE_DEFAULT_DELAY = 3.0  # Задержка, пока по провайдеру нет статистики (сек)
+UNHEALTHY_ERROR_RATE = 0.5  # Провайдер с такой долей ошибок уходит в конец очереди
+STRATEGIES = ("primary", "fastest", "merge", "hedged")
+
+
+class ProviderStats:
+    """Скользящая статистика задержек и ошибок провайдера"""
+
+    def __init__(self, window: int = STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)  # True — успех, False — ошибка
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, latency: float, ok: bool) -> None:
+        self.calls += 1
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "error_rate": self.error_rate,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+        }
+
+
+class RecognitionProvider:
+    """Общий интерфейс сервиса распознавания; результаты — словари полей TrackRecord"""
+    name = "base"
+    passthrough_formats = frozenset({"mp3", "ogg", "wav"})  # Контейнеры, которые сервис принимает без перекодирования
+
+    def __init__(self, encoding: str = DEFAULT_PROFILE):
+        self.stats = ProviderStats()
+        self.encoding = get_profile(encoding).name  # Профиль кодирования загрузок (audio_stream.PROFILES)
+
+    async def identify(self, data: bytes, filename: str, content_type: str) -> list:
+        raise NotImplementedError
+
+    async def recognize(self, data: bytes, filename: str = "segment.mp3", content_type: str = "audio/mpeg",
+                        usage: Counter = None) -> list:
+        """Запрос к сервису с учётом статистики и метрик
+
+        usage["api"] считает отправленные (платные) запросы — и отменённые хеджированием, и неудачные.
+        """
+        if usage is not None:
+            usage["api"] += 1
+        started = time.monotonic()
+        try:
+            with span("api", provider=self.name, bytes=len(data)):
+                results = await self.identify(data, filename, content_type)
+        except asyncio.CancelledError:
+            API_CALLS.inc(provider=self.name, outcome="cancelled")
+            raise
+        except Exception as e:
+            self.stats.record(time.monotonic() - started, False)
+            API_CALLS.inc(provider=self.name, outcome=type(e).__name__)
+            raise
+        elapsed = time.monotonic() - started
+        self.stats.record(elapsed, True)
+        API_SECONDS.observe(elapsed, provider=self.name)
+        API_CALLS.inc(provider=self.name, outcome="ok" if results else "empty")
+        return results
+
+
+class AudDProvider(RecognitionProvider):
+    name = "audd"
+
+    def __init__(self, api_token: str, api_url: str = AUDD_API_URL, encoding: str = DEFAULT_PROFILE):
+        super().__init__(encoding)
+        self.api_token = api_token
+        self.api_url = api_url
+
+    async def identify(self, data: bytes, filename: str, content_type: str) -> list:
+        def build_form() -> FormData:
+            form = FormData()
+            form.add_field("api_token", self.api_token)
+            form.add_field("return", "apple_music,spotify")
+            form.add_field("include_alternatives", "true")
+            form.add_field("file", data, filename=filename, content_type=content_type)
+            return form
+
+        response = await post_with_retries(self.name, self.api_url, build_form)
+        if response.get("status") != "success":
+            raise RecognitionError(f"AudD вернул ошибку: {response.get('error')}")
+
+        raw = []
+        if response.get("result"):
+            raw.append(response["result"])
+        if response.get("alternatives"):
+            raw.extend(dict(track, alternative=True) for track in response["alternatives"])
+        return [dict(TrackRecord.from_audd(track).to_dict(), provider=self.name,
+                     alternative=bool(track.get("alternative"))) for track in raw]
+
+
+class ACRCloudProvider(RecognitionProvider):
+    name = "acrcloud"
+
+    def __init__(self, access_key: str, secret_key: str, host: str, multi: int = 5,
+                 encoding: str = DEFAULT_PROFILE):
+        super().__init__(encoding)
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.host = host
+        self.multi = multi
+
+    def signature(self, timestamp: str) -> str:
+        """Подпись запроса по протоколу ACRCloud v1"""
+        string_to_sign = f"POST\n/v1/identify\n{self.access_key}\naudio\n1\n{timestamp}"
+        return base64.b64encode(
+            hmac.new(self.secret_key.encode(), string_to_sign.encode(), hashlib.sha1).digest()
+        ).decode()
+
+    async def identify(self, data: bytes, filename: str, content_type: str) -> list:
+        def build_form() -> FormData:
+            # Подпись пересчитывается на каждую попытку: у неё ограничен срок жизни
+            timestamp = str(int(time.time()))
+            form = FormData()
+            form.add_field("access_key", self.access_key)
+            form.add_field("data_type", "audio")
+            form.add_field("signature_version", "1")
+            form.add_field("timestamp", timestamp)
+            form.add_field("signature", self.signature(timestamp))
+            form.add_field("sample_bytes", str(len(data)))
+            form.add_field("sample", data, filename=filename, content_type=content_type)
+            form.add_field("multi", str(self.multi))
+            return form
+
+        base = self.host if "://" in self.host else f"https://{self.host}"  # Схема в host — для тестовых серверов
+        response = await post_with_retries(self.name, f"{base}/v1/identify", build_form)
+        code = response.get("status", {}).get("code")
+        if code == 1001:  # No result
+            return []
+        if code != 0:
+            raise RecognitionError(f"ACRCloud: {response.get('status', {}).get('msg', 'Неизвестная ошибка')}")
+
+        music = response.get("metadata", {}).get("music", [])
+        return [dict(TrackRecord.from_acrcloud(track).to_dict(), provider=self.name, alternative=i > 0)
+                for i, track in enumerate(music)]
+
+
+class ProviderRouter:
+    """Выбор провайдеров по стратегии
+
+    primary — по очереди, следующий только при ошибке;
+    fastest — все сразу, побеждает первый непустой ответ;
+    merge — все сразу, результаты объединяются;
+    hedged — основной, а если он не ответил за свой p95 — ещё и следующий.
+    """
+
+    def __init__(self, providers: list, strategy: str = "primary"):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Неизвестная стратегия: {strategy}")
+        self.providers = [provider for provider in providers if provider is not None]
+        self.strategy = strategy
+
+    def ordered(self) -> list:
+        """Провайдеры по здоровью: сначала с низкой долей ошибок, затем по медианной задержке"""
+        def health(item):
+            index, provider = item
+            p50 = provider.stats.percentile(0.5)
+            return (provider.stats.error_rate >= UNHEALTHY_ERROR_RATE, p50 if p50 is not None else 0.0, index)
+        return [provider for _, provider in sorted(enumerate(self.providers), key=health)]
+
+    def stats(self) -> dict:
+        return {provider.name: provider.stats.snapshot() for provider in self.providers}
+
+    def profiles(self) -> list:
+        """Профили кодирования, нужные настроенным провайдерам (без повторов)"""
+        return list(dict.fromkeys(provider.encoding for provider in self.providers))
+
+    def accepts(self, fmt: str) -> bool:
+        """Все настроенные провайдеры принимают файл в этом контейнере как есть"""
+        return all(fmt in provider.passthrough_formats for provider in self.providers)
+
+    async def recognize(self, data: bytes, filename: str = "segment.mp3", content_type: str = "audio/mpeg",
+                        usage: Counter = None) -> list:
+        """Отправляет всем провайдерам одни и те же данные; usage["api"] — сколько запросов ушло"""
+        return await self._route(lambda provider: provider.recognize(data, filename, content_type, usage))
+
+    async def recognize_uploads(self, uploads: dict, usage: Counter = None) -> list:
+        """Каждому провайдеру — данные в его профиле: uploads = {профиль: (данные, имя файла, content-type)}
+
+        Стратегии merge и hedged могут обратиться к нескольким провайдерам: каждый
+        запрос учитывается в usage["api"].
+        """
+        return await self._route(lambda provider: provider.recognize(*uploads[provider.encoding], usage=usage))
+
+    async def _route(self, call) -> list:
+        providers = self.ordered()
+        if not providers:
+            raise RecognitionError("Не настроен ни один провайдер распознавания")
+
+        if self.strategy == "merge":
+            return await self._merge(providers, call)
+        if self.strategy == "fastest":
+            return await self._race(providers, call, delays=[0.0] * len(providers))
+        if self.strategy == "hedged":
+            delays = [0.0]
+            for provider in providers[:-1]:
+                p95 = provider.stats.percentile(0.95)
+                delays.append(delays[-1] + (max(p95, HEDGE_MIN_DELAY) if p95 is not None else HEDGE_DEFAULT_DELAY))
+            # Пустой ответ первого провайдера — тоже ответ: на тишине и речи второй запрос не нужен
+            return await self._race(providers, call, delays, empty_final=True)
+        return await self._primary(providers, call)
+
+    async def _primary(self, providers, call) -> list:
+        last_error = None
+        for provider in providers:
+            try:
+                return await call(provider)
+            except Exception as e:
+                last_error = e
+                logger.warning(f"{provider.name} недоступен, пробуем следующий: {str(e)}")
+        raise RecognitionError(f"Все провайдеры вернули ошибку: {last_error}")
+
+    async def _merge(self, providers, call) -> list:
+        outcomes = await asyncio.gather(*(call(provider) for provider in providers), return_exceptions=True)
+        if all(isinstance(outcome, BaseException) for outcome in outcomes):
+            raise RecognitionError(f"Все провайдеры вернули ошибку: {outcomes[0]}")
+        return [track for outcome in outcomes if not isinstance(outcome, BaseException) for track in outcome]
+
+    async def _race(self, providers, call, delays: list, empty_final: bool = False) -> list:
+        """Запускает провайдеров с задержками; первый непустой ответ (с empty_final — любой) отменяет остальных
+
+        Если все запущенные провайдеры уже ответили ошибкой или пустым списком,
+        следующий запускается сразу, не дожидаясь своей задержки.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        running = set()
+        launched = 0
+        empty = None
+        last_error = None
+        try:
+            while launched < len(providers) or running:
+                if launched < len(providers) and (not running or loop.time() - started >= delays[launched]):
+                    running.add(asyncio.create_task(call(providers[launched])))
+                    launched += 1
+                    continue
+                timeout = started + delays[launched] - loop.time() if launched < len(providers) else None
+                done, running = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        results = task.result()
+                    except Exception as e:
+                        last_error = e
+                        continue
+                    if results or empty_final:
+                        return results
+                    empty = results
+        finally:
+            for task in running:
+                task.cancel()
+
+        if empty is not None:
+            return empty
+        raise RecognitionError(f"Все провайдеры вернули ошибку: {last_error}")
@@ -0,0 +1,223 @@
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация ограничений
+USER_BURST = 3  # Сколько файлов пользователь может отправить подряд
+USER_REFILL_SECONDS = 20  # ... и как часто возвращается одна попытка (сек)
+GLOBAL_BURST = 30  # То же для всего бота
+GLOBAL_REFILL_SECONDS = 0.5
+DAILY_API_BUDGET = 2000  # Запросов к платным API в сутки (UTC) на весь бот
+USER_DAILY_API_BUDGET = 150  # ... и на одного пользователя
+TIGHT_SHARE = 0.5  # Когда остаток суточного бюджета меньше этой доли, файлы анализируются меньшим числом проб
+LIMITS_DB_PATH = "limits.sqlite3"
+
+LIMITED = counter("rate_limited_total", "Файлы, отклонённые ограничителем", ("reason",))
+
+
+def today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class MemoryLimiterBackend:
+    """Состояние ограничителей в памяти процесса"""
+
+    def __init__(self):
+        self._buckets = {}  # ключ -> (токены, время обновления)
+        self._usage = {}  # (день, ключ) -> потрачено
+        self._lock = threading.Lock()
+
+    def take(self, buckets: list, cost: float = 1) -> float:
+        """Списывает cost из всех корзин [(ключ, ёмкость, токенов в секунду)] разом;
+        возвращает 0, если списано, иначе сколько ждать (сек)"""
+        now = time.time()
+        with self._lock:
+            states = [self._buckets.get(key, (capacity, now)) for key, capacity, _ in buckets]
+            retry_after, refilled = _refill(buckets, states, cost, now)
+            if retry_after:
+                return retry_after
+            for (key, _, _), tokens in zip(buckets, refilled):
+                self._buckets[key] = (tokens - cost, now)
+            return 0.0
+
+    def reserve(self, day: str, limits: dict, decide) -> int:
+        """Резервирует decide(остатки по ключам) единиц суточного бюджета во всех ключах"""
+        with self._lock:
+            remaining = {key: limit - self._usage.get((day, key), 0) for key, limit in limits.items()}
+            granted = max(0, decide(remaining))
+            for key in limits:
+                self._usage[(day, key)] = self._usage.get((day, key), 0) + granted
+            # Прошлые дни больше не нужны
+            for stale in [item for item in self._usage if item[0] != day]:
+                del self._usage[stale]
+            return granted
+
+    def refund(self, day: str, keys, amount: int) -> None:
+        with self._lock:
+            for key in keys:
+                if (day, key) in self._usage:
+                    self._usage[(day, key)] = max(0, self._usage[(day, key)] - amount)
+
+
+class SQLiteLimiterBackend:
+    """Состояние ограничителей в SQLite: общее для нескольких процессов и инстансов на одном томе"""
+
+    def __init__(self, path: str = LIMITS_DB_PATH):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "day TEXT NOT NULL, key TEXT NOT NULL, used INTEGER NOT NULL, PRIMARY KEY (day, key))"
+            )
+        return self._db
+
+    def _transaction(self, body):
+        # BEGIN IMMEDIATE: чтение и запись состояния атомарны между процессами
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = body(db)
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            return result
+
+    def take(self, buckets: list, cost: float = 1) -> float:
+        now = time.time()
+
+        def body(db):
+            states = []
+            for key, capacity, _ in buckets:
+                row = db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                states.append(row or (capacity, now))
+            retry_after, refilled = _refill(buckets, states, cost, now)
+            if retry_after:
+                return retry_after
+            db.executemany(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                [(key, tokens - cost, now) for (key, _, _), tokens in zip(buckets, refilled)]
+            )
+            return 0.0
+
+        return self._transaction(body)
+
+    def reserve(self, day: str, limits: dict, decide) -> int:
+        def body(db):
+            remaining = {}
+            for key, limit in limits.items():
+                row = db.execute("SELECT used FROM usage WHERE day = ? AND key = ?", (day, key)).fetchone()
+                remaining[key] = limit - (row[0] if row else 0)
+            granted = max(0, decide(remaining))
+            db.executemany(
+                "INSERT INTO usage (day, key, used) VALUES (?, ?, ?) "
+                "ON CONFLICT (day, key) DO UPDATE SET used = used + excluded.used",
+                [(day, key, granted) for key in limits]
+            )
+            db.execute("DELETE FROM usage WHERE day < ?", (day,))
+            return granted
+
+        return self._transaction(body)
+
+    def refund(self, day: str, keys, amount: int) -> None:
+        def body(db):
+            db.executemany(
+                "UPDATE usage SET used = MAX(0, used - ?) WHERE day = ? AND key = ?",
+                [(amount, day, key) for key in keys]
+            )
+
+        self._transaction(body)
+
+
+def _refill(buckets: list, states: list, cost: float, now: float) -> tuple:
+    """Пополняет корзины по прошедшему времени; (сколько ждать, токены после пополнения)"""
+    refilled = []
+    retry_after = 0.0
+    for (_, capacity, rate), (tokens, updated) in zip(buckets, states):
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        refilled.append(tokens)
+        if tokens < cost:
+            retry_after = max(retry_after, (cost - tokens) / rate)
+    return retry_after, refilled
+
+
+class RateLimiter:
+    """Частота файлов (token bucket на пользователя и на весь бот) и суточный бюджет запросов к API
+
+    Бюджет файла резервируется заранее и уменьшается, когда суточный остаток
+    подходит к концу; неиспользованная часть возвращается после анализа.
+    """
+
+    def __init__(self, backend=None, user_burst: int = USER_BURST, user_refill: float = USER_REFILL_SECONDS,
+                 global_burst: int = GLOBAL_BURST, global_refill: float = GLOBAL_REFILL_SECONDS,
+                 daily_budget: int = DAILY_API_BUDGET, user_daily_budget: int = USER_DAILY_API_BUDGET):
+        self.backend = backend or MemoryLimiterBackend()
+        self.user_burst = user_burst
+        self.user_rate = 1 / user_refill
+        self.global_burst = global_burst
+        self.global_rate = 1 / global_refill
+        self.daily_budget = daily_budget
+        self.user_daily_budget = user_daily_budget
+
+    def check_file(self, user_id) -> float:
+        """Можно ли принять файл сейчас; 0 — да, иначе через сколько секунд"""
+        retry_after = self.backend.take([
+            (f"user:{user_id}", self.user_burst, self.user_rate),
+            ("global", self.global_burst, self.global_rate),
+        ])
+        if retry_after:
+            LIMITED.inc(reason="rate")
+        return retry_after
+
+    def _limits(self, user_id) -> dict:
+        return {"global": self.daily_budget, f"user:{user_id}": self.user_daily_budget}
+
+    def reserve(self, user_id, wanted: int) -> int:
+        """Резервирует до wanted запросов к API; при тающем бюджете — меньше, при исчерпанном — 0"""
+        limits = self._limits(user_id)
+
+        def decide(remaining: dict) -> int:
+            share = min(remaining[key] / limit for key, limit in limits.items())
+            allowed = wanted if share >= TIGHT_SHARE else int(wanted * share / TIGHT_SHARE)
+            return min(max(allowed, 1), *remaining.values())
+
+        granted = self.backend.reserve(today(), limits, decide)
+        if granted == 0:
+            LIMITED.inc(reason="budget")
+        elif granted < wanted:
+            logger.info(f"Суточный бюджет API заканчивается: вместо {wanted} проб выделено {granted}")
+        return granted
+
+    def refund(self, user_id, unused: int) -> None:
+        """Возвращает в суточный бюджет запросы, которые не понадобились
+
+        Отрицательное unused — запросов ушло больше, чем зарезервировано (например,
+        merge обращается к нескольким провайдерам): разница списывается.
+        """
+        if unused:
+            self.backend.refund(today(), self._limits(user_id), unused)
+
+
+def create_limiter(backend: str = "sqlite", **kwargs) -> RateLimiter:
+    """Создаёт ограничитель с хранилищем состояния: memory или sqlite"""
+    if backend == "memory":
+        return RateLimiter(MemoryLimiterBackend(), **kwargs)
+    if backend == "sqlite":
+        return RateLimiter(SQLiteLimiterBackend(), **kwargs)
+    raise ValueError(f"Неизвестное хранилище ограничителя: {backend}")
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import random
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация HTTP-пула
+AUDD_API_URL = "https://api.audd.io/"
+REQUEST_TIMEOUT = 20  # Таймаут одного запроса (сек)
+MAX_RETRIES = 3  # Количество повторов при сетевых ошибках и 429/5xx
+RETRY_BACKOFF = 0.5  # Базовая задержка экспоненциального backoff (сек)
+POOL_SIZE = 32  # Общий лимит соединений пула
+PROVIDER_CONCURRENCY = {  # Максимум одновременных запросов к каждому провайдеру
+    "audd": 4,
+    "acrcloud": 2,
+}
+
+_session = None
+_semaphores = {}
+
+
+class RecognitionError(Exception):
+    """Ошибка запроса к API распознавания"""
+
+
+def configure_provider(provider: str, concurrency: int) -> None:
+    """Меняет лимит одновременных запросов к провайдеру"""
+    PROVIDER_CONCURRENCY[provider] = concurrency
+    _semaphores.pop(provider, None)
+
+
+def get_semaphore(provider: str) -> asyncio.Semaphore:
+    """Возвращает семафор, ограничивающий параллелизм для провайдера"""
+    if provider not in _semaphores:
+        _semaphores[provider] = asyncio.Semaphore(PROVIDER_CONCURRENCY.get(provider, 1))
+    return _semaphores[provider]
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Общая HTTP-сессия с пулом соединений (создаётся лениво)"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=POOL_SIZE))
+    return _session
+
+
+async def close_session() -> None:
+    """Закрывает общую HTTP-сессию"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def post_with_retries(provider: str, url: str, build_form, headers=None, timeout: float = None) -> dict:
+    """POST с лимитом параллелизма, таймаутом и повторами; возвращает JSON ответа
+
+    build_form вызывается на каждую попытку: FormData нельзя отправить дважды.
+    """
+    session = await get_session()
+    client_timeout = aiohttp.ClientTimeout(total=timeout or REQUEST_TIMEOUT)
+    last_error = None
+
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+        try:
+            async with get_semaphore(provider):
+                headers_value = headers() if callable(headers) else headers
+                async with session.post(url, data=build_form(), headers=headers_value,
+                                        timeout=client_timeout) as response:
+                    if response.status == 429 or response.status >= 500:
+                        last_error = RecognitionError(f"HTTP {response.status}")
+                        logger.warning(f"{provider}: статус {response.status}, попытка {attempt + 1}")
+                        continue
+                    return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_error = e
+            logger.warning(f"{provider}: ошибка запроса ({type(e).__name__}), попытка {attempt + 1}")
+
+    raise RecognitionError(f"{provider}: запрос не удался после {MAX_RETRIES + 1} попыток: {last_error}")
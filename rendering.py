@@ -0,0 +1,186 @@
+import logging
+import re
+import secrets
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация рендеринга
+MAX_MESSAGE_LENGTH = 4096  # Ограничение Telegram на текст сообщения
+PAGE_RESERVE = 600  # Запас до лимита: Telegram считает длину в UTF-16, эмодзи занимают по два знака
+PAGE_LENGTH = MAX_MESSAGE_LENGTH - PAGE_RESERVE  # Размер страницы списка треков вместе с заголовком
+RENDER_CACHE_SESSIONS = 500  # Сколько сессий держать отрендеренными (LRU)
+SHOWN_CACHE_SIZE = 5000  # Сколько сообщений помнить, чтобы не отправлять неизменённые правки
+
+
+def new_version() -> str:
+    """Метка набора результатов: сессия получает новую, когда список треков заменён"""
+    return secrets.token_hex(4)
+
+
+_HTML_TOKENS = re.compile(r"<[^>]*>|&[#\w]+;|[^<&]+|[<&]")
+
+
+def truncate_text(text: str, limit: int) -> str:
+    """Обрезает простой текст до limit знаков"""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def truncate_html(text: str, limit: int) -> str:
+    """Обрезает HTML до limit знаков, не разрывая теги и сущности; открытые теги закрываются"""
+    if len(text) <= limit:
+        return text
+    parts, open_tags, size = [], [], 0
+    for token in _HTML_TOKENS.findall(text):
+        if token.startswith("</"):
+            # Место под закрывающий тег уже оставлено
+            if open_tags:
+                open_tags.pop()
+            parts.append(token)
+            size += len(token)
+            continue
+        room = limit - 1 - size - sum(len(tag) + 3 for tag in open_tags)  # 1 — под «…»
+        if token.startswith("<") and token.endswith(">"):
+            name = token[1:-1].split()[0].lower()
+            if len(token) + len(name) + 3 > room:
+                break
+            open_tags.append(name)
+        elif token.startswith("&") and len(token) > 1:
+            if len(token) > room:
+                break
+        elif len(token) > room:
+            parts.append(token[:room])
+            break
+        parts.append(token)
+        size += len(token)
+    return "".join(parts) + "…" + "".join(f"</{tag}>" for tag in reversed(open_tags))
+
+
+def paginate(entries: list, header: str = "", limit: int = PAGE_LENGTH, truncate=truncate_text) -> list:
+    """Собирает записи в страницы не длиннее limit, не разрывая запись между страницами
+
+    Запись длиннее страницы обрезается функцией truncate (для HTML — truncate_html).
+    """
+    room = limit - len(header)
+    pages, current, size = [], [], 0
+    for entry in entries:
+        if len(entry) > room:
+            entry = truncate(entry, room)
+        if current and size + len(entry) + 2 > room:
+            pages.append(header + "\n\n".join(current))
+            current, size = [], 0
+        current.append(entry)
+        size += len(entry) + 2
+    if current:
+        pages.append(header + "\n\n".join(current))
+    return pages
+
+
+class RenderedResults:
+    """Отрендеренные карточки и страницы одного набора результатов"""
+    __slots__ = ("key", "cards", "pages")
+
+    def __init__(self, key: tuple):
+        self.key = key  # (версия, число треков): карточки содержат «N из M», поэтому зависят от M
+        self.cards = {}  # индекс -> (текст, клавиатура)
+        self.pages = None
+
+
+class RenderCache:
+    """Карточки треков, отрендеренные один раз на набор результатов сессии
+
+    Нажатие кнопки берёт готовую карточку вместо форматирования, поэтому его
+    стоимость не зависит от числа найденных треков. Запоминается и то, что уже
+    показано в каждом сообщении: правка с тем же содержимым не отправляется.
+    """
+
+    def __init__(self, render_card, render_entry=None, max_sessions: int = RENDER_CACHE_SESSIONS,
+                 max_shown: int = SHOWN_CACHE_SIZE, truncate=truncate_text):
+        self.render_card = render_card  # (треки, индекс) -> (текст, клавиатура)
+        self.render_entry = render_entry  # (трек, индекс) -> строка списка «все результаты»
+        self.truncate = truncate  # Обрезка слишком длинной строки списка: truncate_text или truncate_html
+        self.max_sessions = max_sessions
+        self.max_shown = max_shown
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self._sessions = OrderedDict()  # chat_id -> RenderedResults
+        self._shown = OrderedDict()  # (chat_id, message_id) -> (текст, клавиатура)
+
+    def _results(self, chat_id: int, session: dict) -> RenderedResults:
+        key = (session.get('version'), len(session['tracks']))
+        results = self._sessions.get(chat_id)
+        if results is None or results.key != key:
+            results = self._sessions[chat_id] = RenderedResults(key)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(chat_id)
+        return results
+
+    def card(self, chat_id: int, session: dict, index: int = None) -> tuple:
+        """(текст, клавиатура) карточки трека index (по умолчанию — текущего)"""
+        results = self._results(chat_id, session)
+        index = session['current_index'] if index is None else index
+        card = results.cards.get(index)
+        if card is None:
+            self.misses += 1
+            card = results.cards[index] = self.render_card(session['tracks'], index)
+        else:
+            self.hits += 1
+        return card
+
+    def pages(self, chat_id: int, session: dict, header: str = "") -> list:
+        """Список всех треков, разбитый на страницы не длиннее PAGE_LENGTH"""
+        results = self._results(chat_id, session)
+        if results.pages is None:
+            self.misses += 1
+            entries = [self.render_entry(track, i) for i, track in enumerate(session['tracks'])]
+            results.pages = paginate(entries, header, truncate=self.truncate)
+        else:
+            self.hits += 1
+        return results.pages
+
+    def unchanged(self, chat_id: int, message_id: int, content: tuple) -> bool:
+        """True — сообщение уже показывает это содержимое и править его не нужно; иначе запоминает новое"""
+        key = (chat_id, message_id)
+        if self._shown.get(key) == content:
+            self.skipped += 1
+            return True
+        self._shown[key] = content
+        self._shown.move_to_end(key)
+        while len(self._shown) > self.max_shown:
+            self._shown.popitem(last=False)
+        return False
+
+    def forget(self, chat_id: int, message_id: int) -> None:
+        """Правка не удалась: содержимое сообщения неизвестно"""
+        self._shown.pop((chat_id, message_id), None)
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "hits": self.hits, "misses": self.misses,
+                "skipped_edits": self.skipped}
+
+
+def register_metrics(cache: RenderCache) -> None:
+    observe("render_cache_total", "Обращения к кэшу карточек",
+            lambda: {"hit": cache.hits, "miss": cache.misses}, ("outcome",), "counter")
+    observe("render_skipped_edits_total", "Правки, не отправленные из-за неизменного содержимого",
+            lambda: cache.skipped, kind="counter")
+
+
+def page_keyboard(page: int, total: int) -> InlineKeyboardMarkup:
+    """Листание страниц списка треков; для одной страницы клавиатура не нужна"""
+    if total <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"page:{page - 1}"))
+    # Счётчик страниц — не кнопка навигации: у него свои данные, нажатие ничего не меняет
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data="page_position"))
+    if page < total - 1:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=f"page:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация кэша результатов
+CACHE_PATH = "recognition_cache.sqlite3"
+CACHE_TTL = 7 * 24 * 3600  # Время жизни записи (сек)
+CACHE_MAX_ENTRIES = 100_000  # При превышении вытесняются давно не использованные записи
+EVICT_FRACTION = 0.1  # Какую долю записей удалять за одно вытеснение
+RECOUNT_INTERVAL = 1000  # Раз в столько записей число строк пересчитывается (его меняют и другие процессы)
+KEY_VERSION = "v2"  # Меняется при смене формата сохраняемых результатов
+
+
+def file_key(file_unique_id: str) -> str:
+    """Ключ по file_unique_id Telegram — одинаков для пересланных копий файла"""
+    return f"file:{KEY_VERSION}:{file_unique_id}"
+
+
+def pcm_key(pcm: bytes) -> str:
+    """Ключ по хэшу декодированного PCM — совпадает для одного звука в разных контейнерах"""
+    return f"pcm:{KEY_VERSION}:{hashlib.blake2b(pcm, digest_size=20).hexdigest()}"
+
+
+class ResultCache:
+    """Кэш результатов распознавания в SQLite с TTL и LRU-вытеснением
+
+    Методы блокирующие: из event loop их вызывают через asyncio.to_thread.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = {}
+        self.misses = {}
+        self._db = None
+        self._lock = threading.Lock()
+        self._count = 0  # Оценка числа записей сверху: без COUNT(*) на каждую запись
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results(accessed)")
+            self._count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return self._db
+
+    def get(self, key: str):
+        """Возвращает сохранённый результат или None"""
+        kind = key.split(":", 1)[0]
+        now = time.time()
+        with self._lock:
+            try:
+                db = self._connect()
+                row = db.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] <= self.ttl:
+                    db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+                    self.hits[kind] = self.hits.get(kind, 0) + 1
+                    return json.loads(row[0])
+                if row:
+                    db.execute("DELETE FROM results WHERE key = ?", (key,))
+                    self._count -= 1
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка чтения кэша: {str(e)}")
+
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            return None
+
+    def set(self, key: str, value) -> None:
+        """Сохраняет результат и при необходимости вытесняет старые записи"""
+        now = time.time()
+        with self._lock:
+            try:
+                db = self._connect()
+                db.execute(
+                    "INSERT OR REPLACE INTO results (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), now, now)
+                )
+                # Замена записи тоже считается новой: оценка растёт быстрее, чем таблица
+                self._count += 1
+                self._writes += 1
+                if self._count > self.max_entries or self._writes % RECOUNT_INTERVAL == 0:
+                    self._count = db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+                    if self._count > self.max_entries:
+                        self._evict(db, now)
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка записи в кэш: {str(e)}")
+
+    def _evict(self, db: sqlite3.Connection, now: float) -> None:
+        expired = db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,)).rowcount
+        self._count -= expired
+        overflow = self._count - self.max_entries + int(self.max_entries * EVICT_FRACTION)
+        if overflow > 0:
+            self._count -= db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)",
+                (overflow,)
+            ).rowcount
+        logger.info(f"Кэш результатов: вытеснено {expired} просроченных и до {max(overflow, 0)} давних записей")
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов по типам ключей"""
+        hits = sum(self.hits.values())
+        total = hits + sum(self.misses.values())
+        return {
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+
+cache = ResultCache()
+
+observe("result_cache_hits_total", "Попадания в кэш результатов", lambda: dict(cache.hits), ("kind",), "counter")
+observe("result_cache_misses_total", "Промахи кэша результатов", lambda: dict(cache.misses), ("kind",), "counter")
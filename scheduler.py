@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+import numpy as np
+
+from aggregation import normalized_key
+from segmentation import PROBE_DURATION, Probe
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация планировщика проб
+MAX_API_CALLS_PER_FILE = 30  # Бюджет проб (запросов к API) на один файл
+COARSE_SHARE = 0.5  # Доля бюджета на грубый проход, остальное — на уточнение
+MIN_REFINE_GAP = 30  # Не уточнять между пробами, если промежуток меньше (сек)
+
+
+def track_key(track: dict) -> str:
+    """Ключ трека для сравнения соседних проб: версии одного трека («feat.», remaster) совпадают"""
+    return normalized_key(track)
+
+
+class SamplingScheduler:
+    """Распределяет бюджет запросов по файлу любой длины
+
+    Сначала распознаются грубые пробы по всему файлу, затем пробы добавляются
+    в середину промежутков, где соседние результаты различаются. Уточнение
+    останавливается, когда соседи согласны или кончился бюджет.
+    """
+
+    def __init__(self, probes: list, duration: float, budget: int = MAX_API_CALLS_PER_FILE,
+                 probe_duration: float = PROBE_DURATION, spent=None):
+        self.probes = probes
+        self.duration = duration
+        self.budget = budget
+        self.probe_duration = probe_duration
+        self.used = 0
+        self.spent = spent  # () -> сколько запросов к API уже ушло: проба может стоить больше одного
+        self.results = {}  # Probe -> ключ главного трека (None, если совпадений нет)
+
+    def remaining(self) -> int:
+        """Сколько проб ещё можно запустить: бюджет ограничивает и пробы, и запросы к API"""
+        spent = self.spent() if self.spent is not None else 0
+        return max(0, self.budget - max(self.used, spent))
+
+    def coarse_probes(self) -> list:
+        """Равномерная выборка из начальных проб в пределах доли бюджета"""
+        limit = max(1, int(self.budget * COARSE_SHARE)) if len(self.probes) > self.budget else self.budget
+        if len(self.probes) <= limit:
+            return list(self.probes)
+        indices = np.unique(np.linspace(0, len(self.probes) - 1, limit).round().astype(int))
+        return [self.probes[i] for i in indices]
+
+    def refinement_probes(self) -> list:
+        """Пробы в серединах промежутков между несогласными соседями, широкие — первыми"""
+        done = sorted(self.results, key=lambda p: p.start)
+        gaps = []
+        for left, right in zip(done[:-1], done[1:]):
+            gap_start = left.start + left.duration
+            gap = right.start - gap_start
+            if self.results[left] != self.results[right] and gap >= MIN_REFINE_GAP:
+                gaps.append((gap, gap_start, right.start))
+
+        gaps.sort(reverse=True)
+        probes = []
+        for gap, gap_start, gap_end in gaps[:self.remaining()]:
+            length = min(self.probe_duration, gap)
+            start = gap_start + (gap - length) / 2
+            probes.append(Probe(start, length, gap_start, gap_end))
+        return probes
+
+    async def run(self, recognize_probe, on_result=None) -> list:
+        """Запускает пробы волнами; возвращает [(проба, треки)] в порядке времени
+
+        recognize_probe(probe) -> list треков; on_result(probe, tracks) вызывается
+        сразу по готовности каждой пробы.
+        """
+        collected = []
+
+        async def run_probe(probe: Probe) -> None:
+            tracks = await recognize_probe(probe)
+            self.results[probe] = track_key(tracks[0]) if tracks else None
+            collected.append((probe, tracks))
+            if on_result is not None:
+                await on_result(probe, tracks)
+
+        wave = self.coarse_probes()
+        while wave:
+            wave = wave[:self.remaining()]
+            self.used += len(wave)
+            await asyncio.gather(*(run_probe(probe) for probe in wave))
+            wave = self.refinement_probes() if self.remaining() > 0 else []
+
+        logger.info(f"Проб выполнено: {self.used} из бюджета {self.budget}, длительность {self.duration:.0f} с")
+        collected.sort(key=lambda item: item[0].start)
+        return collected
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+
+import numpy as np
+
+from audio_features import ANALYSIS_RATE, HOP_SIZE, band_energies, frame_signal
+from audio_stream import read_pcm_blocks
+from pcm_cache import DecodedAudio
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация адаптивной сегментации
+FEATURE_HOP = 0.5  # Шаг кривой признаков (сек)
+ANALYSIS_BLOCK = 20  # Размер блока при потоковом анализе (сек)
+NOVELTY_WINDOW = 8  # Полуширина окна сравнения «до/после» (сек)
+NOVELTY_THRESHOLD = 1.0  # Порог пика: среднее + k * std кривой новизны
+MIN_TRACK_DURATION = 45  # Минимальное расстояние между границами треков (сек)
+MAX_REGION_DURATION = 360  # Более длинные регионы делятся, чтобы не пропустить треки (сек)
+PROBE_DURATION = 12  # Длина пробы, отправляемой в API (сек)
+
+
+class Probe:
+    """Короткий фрагмент для распознавания, представляющий регион файла"""
+    __slots__ = ("start", "duration", "region_start", "region_end")
+
+    def __init__(self, start: float, duration: float, region_start: float, region_end: float):
+        self.start = start
+        self.duration = duration
+        self.region_start = region_start
+        self.region_end = region_end
+
+
+def _block_features(signal: np.ndarray, frames_per_hop: int):
+    """Средние энергии полос по шагам кривой признаков для одного блока сигнала"""
+    energies = np.log(band_energies(frame_signal(signal)))
+    usable = len(energies) - len(energies) % frames_per_hop
+    if usable:
+        return energies[:usable].reshape(-1, frames_per_hop, energies.shape[1]).mean(axis=1)
+    return None
+
+
+def _decoded_features(audio: DecodedAudio, frames_per_hop: int, max_duration: float = None) -> list:
+    """Признаки по уже декодированному сигналу: прореживание до ANALYSIS_RATE усреднением соседних отсчётов"""
+    step = max(1, audio.sample_rate // ANALYSIS_RATE)
+    samples = audio.samples
+    if max_duration:
+        samples = samples[:int(max_duration * audio.sample_rate)]
+    block = ANALYSIS_BLOCK * ANALYSIS_RATE * step
+    rows = []
+    for offset in range(0, len(samples), block):
+        chunk = samples[offset:offset + block]
+        chunk = chunk[:len(chunk) - len(chunk) % step].reshape(-1, step)
+        features = _block_features(chunk.mean(axis=1, dtype=np.float32) / 32768.0, frames_per_hop)
+        if features is not None:
+            rows.append(features)
+    return rows
+
+
+async def feature_curve(source, max_duration: float = None) -> tuple:
+    """Потоково считает спектральные признаки файла; возвращает (признаки, шаг в секундах)
+
+    source — путь, буфер, поток или DecodedAudio (тогда без ffmpeg).
+    """
+    frames_per_hop = max(1, int(round(FEATURE_HOP * ANALYSIS_RATE / HOP_SIZE)))
+    rows = []
+
+    if isinstance(source, DecodedAudio):
+        rows = await asyncio.to_thread(_decoded_features, source, frames_per_hop, max_duration)
+    else:
+        async for block in read_pcm_blocks(source, ANALYSIS_BLOCK, sample_rate=ANALYSIS_RATE,
+                                           channels=1, duration=max_duration):
+            signal = np.frombuffer(block, dtype=np.int16).astype(np.float32) / 32768.0
+            features = _block_features(signal, frames_per_hop)
+            if features is not None:
+                rows.append(features)
+
+    features = np.vstack(rows) if rows else np.empty((0, 0), dtype=np.float32)
+    return features, frames_per_hop * HOP_SIZE / ANALYSIS_RATE
+
+
+def novelty_curve(features: np.ndarray, window: int) -> np.ndarray:
+    """Кривая новизны: расстояние между средними признаками окон до и после каждой точки
+
+    Средние считаются через кумулятивные суммы, поэтому сложность линейна по длине файла.
+    """
+    n = len(features)
+    novelty = np.zeros(n)
+    if n < 2 * window + 1:
+        return novelty
+
+    std = features.std(axis=0)
+    normalized = (features - features.mean(axis=0)) / np.where(std > 0, std, 1)
+    cumulative = np.vstack([np.zeros(normalized.shape[1]), np.cumsum(normalized, axis=0)])
+
+    t = np.arange(window, n - window)
+    before = (cumulative[t] - cumulative[t - window]) / window
+    after = (cumulative[t + window] - cumulative[t]) / window
+    novelty[t] = np.linalg.norm(after - before, axis=1)
+    return novelty
+
+
+def pick_boundaries(novelty: np.ndarray, min_gap: int, threshold: float = NOVELTY_THRESHOLD) -> np.ndarray:
+    """Индексы пиков новизны выше порога, не ближе min_gap друг к другу"""
+    if not novelty.any():
+        return np.empty(0, dtype=int)
+
+    padded = np.pad(novelty, min_gap, mode="constant")
+    local_max = np.lib.stride_tricks.sliding_window_view(padded, 2 * min_gap + 1).max(axis=1)
+    limit = novelty.mean() + threshold * novelty.std()
+    peaks = np.flatnonzero((novelty == local_max) & (novelty > limit))
+
+    # Плато дают соседние равные максимумы — оставляем первый
+    if len(peaks) > 1:
+        peaks = peaks[np.concatenate([[True], np.diff(peaks) >= min_gap])]
+    return peaks
+
+
+def regions_from_boundaries(boundaries: list, duration: float) -> list:
+    """Регионы между границами; слишком длинные делятся на равные части"""
+    edges = [0.0] + [b for b in boundaries if 0 < b < duration] + [duration]
+    regions = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        parts = max(1, int(np.ceil((end - start) / MAX_REGION_DURATION)))
+        step = (end - start) / parts
+        regions.extend((start + i * step, start + (i + 1) * step) for i in range(parts))
+    return regions
+
+
+def probes_for_regions(regions: list, probe_duration: float = PROBE_DURATION) -> list:
+    """Одна проба из середины каждого региона — подальше от переходов между треками"""
+    probes = []
+    for start, end in regions:
+        length = min(probe_duration, end - start)
+        probe_start = start + (end - start - length) / 2
+        probes.append(Probe(probe_start, length, start, end))
+    return probes
+
+
+def fixed_probes(duration: float, segment_duration: float) -> list:
+    """Запасной вариант: фиксированные окна подряд"""
+    return [
+        Probe(start, min(segment_duration, duration - start), start, min(start + segment_duration, duration))
+        for start in np.arange(0, duration, segment_duration)
+    ]
+
+
+async def plan_probes(source, segment_duration: float, max_probes: int = None,
+                      max_duration: float = None, probe_duration: float = PROBE_DURATION,
+                      adaptive: bool = True) -> tuple:
+    """Находит границы треков и возвращает (пробы, длительность); иначе — фиксированные окна"""
+    features, hop = await feature_curve(source, max_duration)
+    duration = len(features) * hop
+
+    if duration == 0:
+        return [], 0.0
+
+    if not adaptive or duration < 2 * probe_duration:
+        probes = fixed_probes(duration, segment_duration)
+    else:
+        window = max(1, int(NOVELTY_WINDOW / hop))
+        boundaries = pick_boundaries(novelty_curve(features, window), int(MIN_TRACK_DURATION / hop))
+        regions = regions_from_boundaries([b * hop for b in boundaries], duration)
+        probes = probes_for_regions(regions, probe_duration)
+        logger.info(f"Найдено границ треков: {len(boundaries)}, регионов: {len(regions)}")
+
+    if max_probes and len(probes) > max_probes:
+        # Оставляем самые длинные регионы: у них больше шансов быть отдельными треками
+        probes = sorted(probes, key=lambda p: p.region_end - p.region_start, reverse=True)[:max_probes]
+        probes.sort(key=lambda p: p.start)
+    return probes, duration
@@ -0,0 +1,279 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Sequence
+
+from aggregation import normalized_key
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация хранилища сессий
+SESSION_TTL = 24 * 3600  # Сколько хранится сессия после последнего обращения (сек)
+SESSION_MAX = 10_000  # Максимум сессий в памяти
+SESSION_DB_PATH = "sessions.sqlite3"
+
+
+class TrackRecord:
+    """Компактная запись о треке: только поля, нужные для карточки"""
+    __slots__ = ("title", "artist", "album", "release_date", "score",
+                 "spotify_url", "apple_music_url", "youtube_url", "start", "end", "votes")
+
+    def __init__(self, title=None, artist=None, album=None, release_date=None, score=None,
+                 spotify_url=None, apple_music_url=None, youtube_url=None, start=None, end=None, votes=None):
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.release_date = release_date
+        self.score = score
+        self.spotify_url = spotify_url
+        self.apple_music_url = apple_music_url
+        self.youtube_url = youtube_url
+        self.start = start  # Смещение в исходном файле (сек)
+        self.end = end
+        self.votes = votes  # Сколько сегментов файла распознали этот трек
+
+    @property
+    def key(self) -> str:
+        """Ключ для сравнения треков (нормализованные artist + title)"""
+        return normalized_key({"artist": self.artist, "title": self.title})
+
+    @classmethod
+    def from_audd(cls, track: dict) -> "TrackRecord":
+        """Запись из ответа AudD"""
+        return cls(
+            title=track.get('title'),
+            artist=track.get('artist'),
+            album=track.get('album'),
+            release_date=track.get('release_date'),
+            score=track.get('score'),
+            spotify_url=(track.get('spotify') or {}).get('external_urls', {}).get('spotify'),
+            apple_music_url=(track.get('apple_music') or {}).get('url'),
+            start=track.get('start'),
+            end=track.get('end'),
+        )
+
+    @classmethod
+    def from_acrcloud(cls, track: dict) -> "TrackRecord":
+        """Запись из ответа ACRCloud"""
+        external = track.get('external_metadata') or {}
+        spotify_id = (external.get('spotify') or {}).get('track', {}).get('id')
+        youtube_id = (external.get('youtube') or {}).get('vid')
+        return cls(
+            title=track.get('title'),
+            artist=', '.join(a.get('name', '') for a in track.get('artists', [])) or None,
+            album=(track.get('album') or {}).get('name'),
+            release_date=track.get('release_date'),
+            score=track.get('score'),
+            spotify_url=f"https://open.spotify.com/track/{spotify_id}" if spotify_id else None,
+            youtube_url=f"https://youtu.be/{youtube_id}" if youtube_id else None,
+            start=track.get('start'),
+            end=track.get('end'),
+        )
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TrackRecord":
+        return cls(**{name: data.get(name) for name in cls.__slots__})
+
+
+def dump_session(session: dict) -> str:
+    return json.dumps({
+        'tracks': [track.to_dict() for track in session.get('tracks', [])],
+        'current_index': session.get('current_index', 0),
+        'version': session.get('version'),
+    }, ensure_ascii=False)
+
+
+def load_session(raw: str) -> dict:
+    data = json.loads(raw)
+    return {
+        'tracks': [TrackRecord.from_dict(track) for track in data.get('tracks', [])],
+        'current_index': data.get('current_index', 0),
+        'version': data.get('version'),  # Метка набора треков (rendering.new_version)
+    }
+
+
+class StoredTracks(Sequence):
+    """Треки сессии в SQLite, которые читаются по одному при обращении
+
+    Для карточки нужен один трек и их число, поэтому весь список не разбирается.
+    """
+
+    def __init__(self, store: "SQLiteSessionStore", chat_id: int, count: int):
+        self.store = store
+        self.chat_id = chat_id
+        self.count = count
+        self._records = {}  # индекс -> TrackRecord
+        self._all = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        if self._all is not None and index < len(self._all):
+            return self._all[index]
+        record = self._records.get(index)
+        if record is None:
+            record = self._records[index] = self.store.load_track(self.chat_id, index)
+        return record
+
+    def __iter__(self):
+        # Весь список (страницы «все треки») — одним запросом, а не по треку
+        if self._all is None:
+            self._all = self.store.load_tracks(self.chat_id)[:self.count]
+        return iter(self._all)
+
+
+class MemorySessionStore:
+    """Сессии в памяти процесса с LRU-вытеснением и TTL (обращения из потоков — под блокировкой)"""
+
+    def __init__(self, max_sessions: int = SESSION_MAX, ttl: float = SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # chat_id -> (время обращения, сессия)
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int) -> dict:
+        with self._lock:
+            item = self._sessions.get(chat_id)
+            if item is None:
+                return None
+            if time.monotonic() - item[0] > self.ttl:
+                del self._sessions[chat_id]
+                return None
+            self._sessions[chat_id] = (time.monotonic(), item[1])
+            self._sessions.move_to_end(chat_id)
+            return item[1]
+
+    def view(self, chat_id: int) -> dict:
+        """Сессия для показа карточки: в памяти она уже разобрана, это то же, что get"""
+        return self.get(chat_id)
+
+    def set(self, chat_id: int, session: dict) -> None:
+        with self._lock:
+            self._sessions[chat_id] = (time.monotonic(), session)
+            self._sessions.move_to_end(chat_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def set_index(self, chat_id: int, index: int) -> None:
+        """Меняет только текущий трек, не перезаписывая список"""
+        with self._lock:
+            item = self._sessions.get(chat_id)
+            if item is not None:
+                item[1]['current_index'] = index
+                self._sessions[chat_id] = (time.monotonic(), item[1])
+                self._sessions.move_to_end(chat_id)
+
+    def delete(self, chat_id: int) -> None:
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+
+
+class SQLiteSessionStore:
+    """Сессии в SQLite: переживают перезапуск и доступны нескольким процессам"""
+
+    def __init__(self, path: str = SESSION_DB_PATH, ttl: float = SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions(accessed)")
+        return self._db
+
+    def _execute(self, sql: str, params: tuple) -> list:
+        # Соединение общее для потоков (обращения идут через asyncio.to_thread)
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _touch(self, chat_id: int, accessed: float) -> bool:
+        """Продлевает сессию; False — она просрочена и удалена"""
+        if time.time() - accessed > self.ttl:
+            self.delete(chat_id)
+            return False
+        self._execute("UPDATE sessions SET accessed = ? WHERE chat_id = ?", (time.time(), chat_id))
+        return True
+
+    def get(self, chat_id: int) -> dict:
+        rows = self._execute("SELECT data, accessed FROM sessions WHERE chat_id = ?", (chat_id,))
+        if not rows or not self._touch(chat_id, rows[0][1]):
+            return None
+        return load_session(rows[0][0])
+
+    def view(self, chat_id: int) -> dict:
+        """Сессия для показа карточки: текущий индекс, версия и число треков без разбора списка
+
+        Треки (StoredTracks) читаются по одному, только когда карточки нет в кэше рендеринга.
+        """
+        rows = self._execute(
+            "SELECT json_extract(data, '$.current_index'), json_extract(data, '$.version'), "
+            "json_array_length(data, '$.tracks'), accessed FROM sessions WHERE chat_id = ?",
+            (chat_id,)
+        )
+        if not rows or not self._touch(chat_id, rows[0][3]):
+            return None
+        row = rows[0]
+        return {
+            'tracks': StoredTracks(self, chat_id, row[2] or 0),
+            'current_index': row[0] or 0,
+            'version': row[1],
+        }
+
+    def load_track(self, chat_id: int, index: int) -> TrackRecord:
+        rows = self._execute(
+            "SELECT json_extract(data, '$.tracks[' || ? || ']') FROM sessions WHERE chat_id = ?",
+            (index, chat_id)
+        )
+        # Сессию могли заменить между чтениями — пустая запись вместо ошибки
+        return TrackRecord.from_dict(json.loads(rows[0][0]) if rows and rows[0][0] else {})
+
+    def load_tracks(self, chat_id: int) -> list:
+        rows = self._execute("SELECT json_extract(data, '$.tracks') FROM sessions WHERE chat_id = ?", (chat_id,))
+        return [TrackRecord.from_dict(track) for track in json.loads(rows[0][0])] if rows and rows[0][0] else []
+
+    def set(self, chat_id: int, session: dict) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO sessions (chat_id, data, accessed) VALUES (?, ?, ?)",
+            (chat_id, dump_session(session), time.time())
+        )
+        # Попутно чистим просроченные сессии
+        self._execute("DELETE FROM sessions WHERE accessed < ?", (time.time() - self.ttl,))
+
+    def set_index(self, chat_id: int, index: int) -> None:
+        """Меняет только текущий трек: json_set в SQLite вместо разбора и сериализации всего списка"""
+        self._execute(
+            "UPDATE sessions SET data = json_set(data, '$.current_index', ?), accessed = ? WHERE chat_id = ?",
+            (index, time.time(), chat_id)
+        )
+
+    def delete(self, chat_id: int) -> None:
+        self._execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+
+
+def create_store(backend: str = "sqlite", **kwargs):
+    """Создаёт хранилище сессий: memory или sqlite"""
+    if backend == "memory":
+        return MemorySessionStore(**kwargs)
+    if backend == "sqlite":
+        return SQLiteSessionStore(**kwargs)
+    raise ValueError(f"Неизвестное хранилище сессий: {backend}")
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация пула транскодирования
+POOL_SIZE = os.cpu_count() or 2  # Сколько файлов декодируется одновременно
+MAX_QUEUE = 50  # Максимум ожидающих задач во всей очереди
+MAX_QUEUED_PER_USER = 3  # Максимум ожидающих задач одного пользователя
+WAIT_SAMPLES = 200  # Сколько последних времён ожидания хранить для статистики
+
+
+class QueueFullError(Exception):
+    """Очередь транскодирования переполнена"""
+
+
+class TranscodePool:
+    """Ограничивает число одновременных процессов ffmpeg
+
+    Свободные слоты раздаются пользователям по кругу, поэтому один человек
+    с пачкой файлов не блокирует остальных.
+    """
+
+    def __init__(self, size: int = POOL_SIZE, max_queue: int = MAX_QUEUE,
+                 max_queued_per_user: int = MAX_QUEUED_PER_USER):
+        self.size = size
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.active = 0
+        self._queues = OrderedDict()  # user_id -> deque[Future]
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self.jobs_total = 0
+        self.rejected_total = 0
+        self.wait_seconds_total = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def position_for(self, user_id) -> int:
+        """Позиция, которую займёт новая задача пользователя при круговой раздаче"""
+        own = len(self._queues.get(user_id, ()))
+        others = sum(min(len(queue), own + 1) for uid, queue in self._queues.items() if uid != user_id)
+        return others + own + 1
+
+    async def acquire(self, user_id, on_queued=None) -> None:
+        """Ждёт свободный слот; on_queued(position) вызывается, если придётся ждать"""
+        started = time.monotonic()
+
+        if self.active < self.size and not self._queues:
+            self.active += 1
+            self._record_wait(started)
+            return
+
+        queue = self._queues.get(user_id)
+        if self.queue_depth >= self.max_queue or (queue and len(queue) >= self.max_queued_per_user):
+            self.rejected_total += 1
+            raise QueueFullError("Очередь транскодирования переполнена")
+
+        position = self.position_for(user_id)
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(future)
+        logger.info(f"Задача пользователя {user_id} в очереди: позиция {position}, глубина {self.queue_depth}")
+
+        if on_queued is not None:
+            try:
+                await on_queued(position)
+            except Exception as e:
+                logger.warning(f"Ошибка уведомления об очереди: {str(e)}")
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но задача отменена — возвращаем его
+                self.release()
+            else:
+                self._remove(user_id, future)
+            raise
+
+        self._record_wait(started)
+
+    def release(self) -> None:
+        """Освобождает слот и передаёт его следующему пользователю по кругу"""
+        while self._queues:
+            user_id, queue = self._queues.popitem(last=False)
+            future = queue.popleft()
+            if queue:
+                self._queues[user_id] = queue  # пользователь уходит в конец круга
+            if not future.done():
+                future.set_result(None)  # слот переходит к ожидающему, active не меняется
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id, on_queued=None):
+        await self.acquire(user_id, on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        """Метрики очереди: глубина, загрузка и время ожидания"""
+        waits = sorted(self._waits)
+        return {
+            "active": self.active,
+            "size": self.size,
+            "queue_depth": self.queue_depth,
+            "jobs_total": self.jobs_total,
+            "rejected_total": self.rejected_total,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_p50": waits[len(waits) // 2] if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+        }
+
+    def _remove(self, user_id, future) -> None:
+        queue = self._queues.get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._queues[user_id]
+
+    def _record_wait(self, started: float) -> None:
+        waited = time.monotonic() - started
+        self.jobs_total += 1
+        self.wait_seconds_total += waited
+        self._waits.append(waited)
+
+
+pool = TranscodePool()
+
+observe("transcode_active", "Процессы ffmpeg, выполняющиеся сейчас", lambda: pool.active)
+observe("transcode_queue_depth", "Задачи в очереди на ffmpeg", lambda: pool.queue_depth)
+observe("transcode_jobs_total", "Задачи, получившие слот ffmpeg", lambda: pool.jobs_total, kind="counter")
+observe("transcode_rejected_total", "Задачи, отклонённые из-за переполнения очереди",
+        lambda: pool.rejected_total, kind="counter")
+observe("transcode_wait_seconds_total", "Суммарное ожидание слота ffmpeg", lambda: pool.wait_seconds_total,
+        kind="counter")
@@ -0,0 +1,138 @@
+import asyncio
+import functools
+import logging
+import os
+import signal
+
+from aiohttp import web
+from telegram import Update
+
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация webhook (через переменные окружения)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://bot.example.com; пусто — long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"  # За балансировщиком регистрирует один инстанс
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "120"))  # Сколько ждать незавершённые распознавания (сек)
+
+
+class InflightTracker:
+    """Считает выполняющиеся обработчики, чтобы дождаться их при остановке"""
+
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def tracked(self, handler):
+        """Декоратор для обработчиков, которые нельзя прерывать при остановке"""
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            self.count += 1
+            self._idle.clear()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                self.count -= 1
+                if self.count == 0:
+                    self._idle.set()
+        return wrapper
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Ждёт завершения всех обработчиков; False, если не дождались"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+inflight = InflightTracker()
+
+observe("bot_inflight_jobs", "Выполняющиеся обработчики файлов", lambda: inflight.count)
+
+
+def create_web_app(application, state: dict, secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH) -> web.Application:
+    """aiohttp-приложение: приём обновлений, /healthz и /readyz"""
+
+    async def telegram_update(request: web.Request) -> web.Response:
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=403)
+        if not state["ready"]:
+            # Во время остановки не принимаем новые обновления — Telegram повторит их другому инстансу
+            return web.Response(status=503)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logger.warning(f"Некорректное обновление: {str(e)}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response(text="ok")
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def readyz(request: web.Request) -> web.Response:
+        if state["ready"]:
+            return web.json_response({"ready": True, "inflight": inflight.count})
+        return web.json_response({"ready": False, "inflight": inflight.count}, status=503)
+
+    app = web.Application()
+    app.router.add_post(path, telegram_update)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    return app
+
+
+async def run_webhook(application, url: str = WEBHOOK_URL, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                      path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET) -> None:
+    """Запускает бота в режиме webhook со встроенным HTTP-сервером и мягкой остановкой"""
+    state = {"ready": False}
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остаётся KeyboardInterrupt
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    runner = web.AppRunner(create_web_app(application, state, secret, path))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    if WEBHOOK_REGISTER and url:
+        await application.bot.set_webhook(url.rstrip("/") + path, secret_token=secret,
+                                          allowed_updates=Update.ALL_TYPES)
+    state["ready"] = True
+    logger.info(f"Webhook слушает {host}:{port}{path}")
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Остановка: новые обновления не принимаются, ждём текущие распознавания...")
+        state["ready"] = False
+
+        # Сначала дожидаемся разбора очереди, затем — самих обработчиков
+        deadline = loop.time() + DRAIN_TIMEOUT
+        while not application.update_queue.empty() and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if not await inflight.wait_idle(max(0.0, deadline - loop.time())):
+            logger.warning(f"Не дождались {inflight.count} обработчиков за {DRAIN_TIMEOUT} с")
+
+        await application.stop()
+        await runner.cleanup()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)